@@ -0,0 +1,74 @@
+# Parse-and-extract throughput for json provider pages, before and after
+# compiling the keylists into a provider.JsonExtractor.
+#
+# run from the root of the repo, with the providers' environment variables set:
+#   python extras/profiling/json_extraction_benchmark.py [number_of_runs]
+#
+# "before" is simplejson plus a _lookup_json per keylist, the way
+# _extract_from_json used to work.  "after" is what the providers do now, so
+# it decodes with ujson when that is installed.  The keylists are the
+# providers' own.  Plosalm walks its sources instead of using keylists, so
+# its big page only appears in the decoding table.
+
+import os, sys, timeit
+import simplejson
+from totalimpact.providers import provider, github, figshare, topsy
+
+sampledir = os.path.join(os.path.split(__file__)[0], "../sample_provider_pages/")
+
+# (sample page, the provider's extractor, keys down to the record it extracts from)
+SAMPLES = [
+    ("github/metrics", github.Github.metrics_json_extractor, []),
+    ("github/biblio", github.Github.biblio_json_extractor, []),
+    ("figshare/metrics", figshare.Figshare.metrics_json_extractor, ["items", 0]),
+    ("topsy/metrics", topsy.Topsy.metrics_json_extractor, [])
+]
+
+DECODE_SAMPLES = ["github/biblio", "figshare/metrics", "topsy/metrics", "plosalm/metrics"]
+
+def extract_before(page, dict_of_keylists, record_keylist):
+    data = provider._lookup_json(simplejson.loads(page), record_keylist)
+    return_dict = {}
+    for (metric, keylist) in dict_of_keylists.iteritems():
+        value = provider._lookup_json(data, keylist)
+        if value:
+            return_dict[metric] = value
+    return return_dict
+
+def extract_after(page, extractor, record_keylist):
+    data = provider._lookup_json(provider._load_json(page), record_keylist)
+    return extractor.extract_from_data(data)
+
+def read_sample(sample_name):
+    return open(os.path.join(sampledir, sample_name)).read()
+
+def main(number):
+    print "json decoder: %s" % ("ujson" if provider.ujson else "simplejson")
+    print
+    print "%-18s %8s %12s %12s %8s" % ("page", "bytes", "before/s", "after/s", "gain")
+    for (sample_name, extractor, record_keylist) in SAMPLES:
+        page = read_sample(sample_name)
+        assert extract_after(page, extractor, record_keylist) == \
+            extract_before(page, extractor.dict_of_keylists, record_keylist)
+
+        before = min(timeit.repeat(lambda: extract_before(page, extractor.dict_of_keylists, record_keylist),
+            number=number, repeat=3))
+        after = min(timeit.repeat(lambda: extract_after(page, extractor, record_keylist),
+            number=number, repeat=3))
+        print "%-18s %8i %12.0f %12.0f %7.2fx" % (sample_name, len(page),
+            number/before, number/after, before/after)
+
+    print
+    print "%-18s %8s %12s %12s %8s" % ("decode only", "bytes", "simplejson/s", "_load_json/s", "gain")
+    for sample_name in DECODE_SAMPLES:
+        page = read_sample(sample_name)
+        before = min(timeit.repeat(lambda: simplejson.loads(page), number=number, repeat=3))
+        after = min(timeit.repeat(lambda: provider._load_json(page), number=number, repeat=3))
+        print "%-18s %8i %12.0f %12.0f %7.2fx" % (sample_name, len(page),
+            number/before, number/after, before/after)
+
+if __name__ == "__main__":
+    number = 2000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    main(number)
@@ -1,10 +1,12 @@
 from totalimpact.providers import provider
 from totalimpact.providers.provider import Provider, ProviderFactory
-from nose.tools import assert_equals, nottest
+from totalimpact import tiredis, cache
+from totalimpact.cache import Cache
+from nose.tools import assert_equals, nottest, raises
 from xml.dom import minidom 
 
 import simplejson, BeautifulSoup
-import os
+import os, time, threading, BaseHTTPServer
 
 sampledir = os.path.join(os.path.split(__file__)[0], "../../../extras/sample_provider_pages/")
 
@@ -60,6 +62,23 @@ class Test_Provider():
         response = provider._extract_from_json(page, dict_of_keylists)
         assert_equals(response, {'description': u'Git-based ToDo tool.', 'title': u'gtd'})
     
+    def test_json_extractor(self):
+        extractor = provider.JsonExtractor({
+            'title' : ['repository', 'name'],
+            'owner' : ['repository', 'owner'],
+            'missing' : ['repository', 'owner', 'login'],
+            'forks' : ['repository', 'forks'],
+            'long' : ['a', 'b', 'c', 1]})
+        response = extractor.extract(self.TEST_JSON)
+        # forks is 0, so like _extract_from_json it is left out
+        assert_equals(response, {'owner': u'egonw', 'title': u'gtd'})
+        response = extractor.extract_from_data({"a": {"b": {"c": ["zero", "one"]}}})
+        assert_equals(response, {'long': "one"})
+
+    @raises(provider.ProviderContentMalformedError)
+    def test_json_extractor_malformed(self):
+        provider.JsonExtractor({'title' : ['repository', 'name']}).extract("{not json")
+
     def test_lookup_xml_from_dom(self):
         page = self.TEST_XML
         doc = minidom.parseString(page.strip())
@@ -80,6 +99,28 @@ class Test_Provider():
         response = provider._extract_from_xml(page, dict_of_keylists)
         assert_equals(response, {'count': 17})
 
+    def test_xml_extractor_matches_dom_lookup(self):
+        page = "<a><b><c>first c in the first b</c></b><b><d>d in the second b</d></b><c> 3 </c></a>"
+        extractor = provider.XmlExtractor(
+            {"c": ["b", "c"], "d": ["a", "b", "d"], "any_c": ["a", "c"], "nested": ["b"]},
+            {"all_c": "c"})
+        response = extractor.extract(page)
+        # like _lookup_xml_from_dom, keys match at any depth, and only inside the first match
+        # of the key before, so d isn't found. The first b starts with an element, not text.
+        assert_equals(response, {"c": u"first c in the first b", "any_c": u"first c in the first b", 
+            "all_c": [u"first c in the first b", u" 3 "]})
+
+    def test_xml_extractor_falls_back_to_soup(self):
+        page = "<a><b>1</b><b>2</b><c>not closed</a>"
+        extractor = provider.XmlExtractor({"b": ["a", "b"]}, {"all_b": "b"})
+        response = extractor.extract(page)
+        assert_equals(response, {"b": 1, "all_b": [u"1", u"2"]})
+
+    def test_count_in_xml(self):
+        page = "<posts><post><id>1</id></post><post/><other><post>x</post></other></posts>"
+        assert_equals(provider._count_in_xml(page, "post"), 3)
+        assert_equals(provider._count_in_xml(page, "missing"), 0)
+
     def test_doi_from_url_string(self):
         test_url = "https://knb.ecoinformatics.org/knb/d1/mn/v1/object/doi:10.5063%2FAA%2Fnrs.373.1"
         expected = "10.5063/AA/nrs.373.1"
@@ -109,3 +150,259 @@ class TestProviderFactory():
         print md["pubmed"]
         assert_equals(md["pubmed"]['url'], 'http://pubmed.gov')
 
+    def test_get_registry_builds_providers_once(self):
+        registry = ProviderFactory.get_registry(self.TEST_PROVIDER_CONFIG)
+        assert_equals([provider.provider_name for provider in registry], ["pubmed", "wikipedia", "mendeley"])
+        assert ProviderFactory.get_registry(self.TEST_PROVIDER_CONFIG) is registry
+
+    def test_get_provider_names(self):
+        response = ProviderFactory.get_provider_names(self.TEST_PROVIDER_CONFIG, "biblio")
+        assert_equals(response, ["pubmed"])
+
+    def test_num_providers_with_metrics(self):
+        response = ProviderFactory.num_providers_with_metrics(self.TEST_PROVIDER_CONFIG)
+        assert_equals(response, 3)
+
+
+
+class TestTokenBucket():
+
+    def setUp(self):
+        self.r = tiredis.from_url("redis://localhost:6379", db=8)
+        self.r.flushdb()
+
+    def teardown(self):
+        self.r.flushdb()
+        provider.use_redis_for_rate_limits(None)
+
+    def test_consume_within_capacity(self):
+        bucket = provider.TokenBucket("myfakeprovider", 1, 2)
+        bucket.consume(max_wait=0)
+        bucket.consume(max_wait=0)
+
+    @raises(provider.ProviderRateLimitError)
+    def test_consume_raises_after_max_wait(self):
+        bucket = provider.TokenBucket("myfakeprovider", 0.1, 1)
+        bucket.consume(max_wait=0)
+        bucket.consume(max_wait=1)  # next token is 10 seconds away
+
+    def test_consume_waits_for_refill(self):
+        bucket = provider.TokenBucket("myfakeprovider", 20, 1)
+        start = time.time()
+        bucket.consume(max_wait=1)
+        bucket.consume(max_wait=1)
+        assert time.time() - start >= 0.04
+
+    def test_redis_bucket_shared_between_instances(self):
+        bucket = provider.RedisTokenBucket("myfakeprovider", 0.1, 2, self.r)
+        other_process_bucket = provider.RedisTokenBucket("myfakeprovider", 0.1, 2, self.r)
+        assert_equals(bucket._take(), 0)
+        assert_equals(other_process_bucket._take(), 0)
+        assert other_process_bucket._take() > 0
+
+    def test_get_rate_limiter(self):
+        limiter = provider.get_rate_limiter("myfakeprovider", (3, 1))
+        assert_equals(limiter.__class__.__name__, "TokenBucket")
+        assert_equals(limiter.rate, 3)
+        assert limiter is provider.get_rate_limiter("myfakeprovider", (3, 1))
+
+        provider.use_redis_for_rate_limits(self.r)
+        limiter = provider.get_rate_limiter("myfakeprovider", (3, 1))
+        assert_equals(limiter.__class__.__name__, "RedisTokenBucket")
+
+
+class TestHttpSession():
+
+    def setUp(self):
+        provider.reset_http_session()
+
+    def teardown(self):
+        provider.reset_http_session()
+
+    def test_get_http_session_is_shared(self):
+        session = provider.get_http_session()
+        assert_equals(session.__class__.__name__, "SharedSession")
+        assert session is provider.get_http_session()
+        assert_equals(session.poolmanager.connection_pool_kw["maxsize"], 10)
+
+    def test_http_session_does_not_store_cookies(self):
+        # serves one page that sets a cookie
+        class CookieHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Set-Cookie", "session=abc")
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write("hi")
+            def log_message(self, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer(("localhost", 0), CookieHandler)
+        server_thread = threading.Thread(target=server.handle_request)
+        server_thread.start()
+        session = provider.get_http_session()
+        session.get("http://localhost:%i/" % server.server_port, prefetch=True)
+        server_thread.join()
+        assert_equals(len(session.cookies), 0)
+
+    def test_get_http_session_stats_empty(self):
+        stats = provider.get_http_session_stats()
+        assert_equals(stats, {"hosts": {}, "requests": 0, "connections": 0, "reused": 0})
+
+    def test_connections_are_reused(self):
+        # couchdb is running locally for the other tests, so use it as a keep-alive server
+        session = provider.get_http_session()
+        for i in range(3):
+            r = session.get("http://localhost:5984/", prefetch=True)
+            assert_equals(r.status_code, 200)
+        stats = provider.get_http_session_stats()
+        assert_equals(stats["requests"], 3)
+        assert_equals(stats["connections"], 1)
+        assert_equals(stats["reused"], 2)
+        assert_equals(stats["hosts"].keys(), ["http://localhost:5984"])
+
+
+class TestHttpGetCaching():
+
+    def setUp(self):
+        self.provider = Provider()
+        Cache().flush_cache()
+
+    def test_get_cache_duration(self):
+        assert_equals(self.provider._get_cache_duration(200), 60*60)
+        assert_equals(self.provider._get_cache_duration(404), 60*15)
+        assert_equals(self.provider._get_cache_duration(410), 60*60)
+        assert_equals(self.provider._get_cache_duration(500), None)
+
+    def test_get_cache_duration_negative_no_longer_than_positive(self):
+        self.provider.max_cache_duration = 60*10
+        assert_equals(self.provider._get_cache_duration(404), 60*10)
+        assert_equals(self.provider._get_cache_duration(403), 60*5)
+
+    def test_http_get_caches_not_found(self):
+        # couchdb is running locally for the other tests, and 404s a missing database
+        url = "http://localhost:5984/ti_no_such_database"
+        r = self.provider.http_get(url)
+        assert_equals(r.status_code, 404)
+        r = self.provider.http_get(url)
+        assert_equals(r.status_code, 404)
+        assert_equals(r.__class__.__name__, "CachedResponse")
+
+    def test_cache_empty_metrics(self):
+        url = "http://localhost:5984/"
+        r = self.provider.http_get(url)
+        self.provider._cache_empty_metrics(r)
+        hash_key = Cache()._build_hash_key(r.cache_key)
+        (expires, size, data) = cache.get_local_cache().entries[hash_key]
+        # shorter than the hour a response with metrics gets
+        assert time.time() + 60*14 < expires <= time.time() + 60*15
+        assert_equals(data["status_code"], 200)
+
+    def test_cache_empty_metrics_ignores_responses_not_from_http_get(self):
+        class DummyResponse:
+            status_code = 200
+            text = ""
+        self.provider._cache_empty_metrics(DummyResponse())
+        assert_equals(len(cache.get_local_cache().entries), 0)
+
+    def test_http_get_revalidates_stale_entry(self):
+        # serves one page with an ETag, and 304s requests that already have it
+        requests_seen = []
+        class EtagHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append(self.headers.get("If-None-Match"))
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    self.send_response(200)
+                    self.send_header("ETag", '"v1"')
+                    self.send_header("Content-Length", "5")
+                    self.end_headers()
+                    self.wfile.write("hello")
+            def log_message(self, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer(("localhost", 0), EtagHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = "http://localhost:%i/page" %(server.server_port)
+            self.provider.max_cache_duration = 1
+            r = self.provider.http_get(url)
+            assert_equals(r.text, "hello")
+            hash_key = Cache()._build_hash_key(r.cache_key)
+            (expires, size, data) = cache.get_local_cache().entries[hash_key]
+            # kept for as long again as it was fresh, to be revalidated
+            assert time.time() + 1 < expires <= time.time() + 2
+            time.sleep(1.1)
+
+            r = self.provider.http_get(url)
+            assert_equals(r.__class__.__name__, "CachedResponse")
+            assert_equals(r.text, "hello")
+            assert_equals(requests_seen, [None, '"v1"'])
+        finally:
+            server.shutdown()
+
+
+class TestSingleFlight():
+
+    def test_do_returns_result(self):
+        flights = provider.SingleFlight()
+        assert_equals(flights.do("key", lambda x: x*2, 21), 42)
+        assert_equals(flights.calls, {})
+
+    def test_concurrent_callers_share_one_call(self):
+        flights = provider.SingleFlight()
+        calls = []
+        def slow_call():
+            calls.append(1)
+            time.sleep(0.2)
+            return "result"
+        results = []
+        def caller():
+            results.append(flights.do("key", slow_call))
+        threads = [threading.Thread(target=caller) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equals(len(calls), 1)
+        assert_equals(results, ["result"]*5)
+
+    def test_followers_get_the_exception(self):
+        flights = provider.SingleFlight()
+        def failing_call():
+            time.sleep(0.2)
+            raise provider.ProviderTimeout("too slow")
+        errors = []
+        def caller():
+            try:
+                flights.do("key", failing_call)
+            except provider.ProviderTimeout as e:
+                errors.append(e)
+        threads = [threading.Thread(target=caller) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equals(len(errors), 3)
+        assert_equals(flights.calls, {})
+
+
+class TestRunConcurrently():
+
+    def test_returns_results_in_order(self):
+        def slow_double(x, delay):
+            time.sleep(delay)
+            return x*2
+        start = time.time()
+        results = provider.run_concurrently([(slow_double, (1, 0.3)), (slow_double, (2, 0.1)), (slow_double, (3, 0.2))])
+        assert_equals(results, [2, 4, 6])
+        assert time.time() - start < 0.5
+
+    @raises(provider.ProviderTimeout)
+    def test_reraises_exception(self):
+        def failing_call():
+            raise provider.ProviderTimeout("too slow")
+        provider.run_concurrently([(time.sleep, (0.1,)), (failing_call, ())])
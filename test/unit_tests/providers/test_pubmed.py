@@ -3,7 +3,7 @@ from test.unit_tests.providers.common import ProviderTestCase
 from test.utils import http
 from totalimpact.providers.provider import Provider, ProviderContentMalformedError
 
-import os
+import os, re
 import collections
 from nose.tools import assert_equals, raises, nottest
 
@@ -53,6 +53,92 @@ class TestPubmed(ProviderTestCase):
         aliases = self.provider.aliases([self.testitem_aliases])
         assert_equals(aliases, [("url", 'http://www.ncbi.nlm.nih.gov/pubmed/16060722')])
 
+    def _article_set_page(self):
+        # the sample efetch pages are for two different pmids, 17593900 and 16060722
+        article_pattern = re.compile("<PubmedArticle>.*</PubmedArticle>", re.DOTALL)
+        articles = [article_pattern.search(open(filename, "r").read()).group(0) 
+            for filename in [SAMPLE_EXTRACT_ALIASES_FROM_PMID_PAGE, SAMPLE_EXTRACT_BIBLIO_PAGE]]
+        return "<PubmedArticleSet>" + "".join(articles) + "</PubmedArticleSet>"
+
+    def test_split_article_set(self):
+        pmid_pages = self.provider._split_article_set(self._article_set_page())
+        assert_equals(sorted(pmid_pages.keys()), ["16060722", "17593900"])
+        aliases = self.provider._extract_aliases_from_pmid(pmid_pages["17593900"], "17593900")
+        assert_equals(aliases, [('doi', u'10.1371/journal.pmed.0040215')])
+        biblio = self.provider._extract_biblio(pmid_pages["16060722"])
+        assert_equals(biblio["title"], u'Why most published research findings are false.')
+
+    @raises(ProviderContentMalformedError)
+    def test_split_article_set_malformed(self):
+        self.provider._split_article_set("<PubmedArticleSet><PubmedArticle></PubmedArticleSet>")
+
+    def test_aliases_batch(self):
+        article_set_page = self._article_set_page()
+        urls = []
+        def fake_http_get(url, headers=None, timeout=None, cache_enabled=True, allow_redirects=False):
+            urls.append(url)
+            if "esearch" in url:
+                return common.DummyResponse(200, "<eSearchResult><IdList><Id>17593900</Id></IdList></eSearchResult>")
+            return common.DummyResponse(200, article_set_page)
+        self.provider.http_get = fake_http_get
+
+        response = self.provider.aliases_batch([
+                [("doi", "10.1371/JOURNAL.PMED.0040215")], 
+                [("pmid", "16060722")], 
+                [("doi", "10.1/not.in.pubmed")]], 
+            cache_enabled=False)
+        assert_equals(response[0], [("pmid", "17593900")])
+        assert_equals(response[1][1:], [('doi', u'10.1371/journal.pmed.0020124'), ('url', 'http://www.ncbi.nlm.nih.gov/pubmed/16060722')])
+        assert_equals(response[2], [])
+        # one esearch for the dois, one efetch to match them up, one efetch for the pmids
+        assert_equals(len(urls), 3)
+        assert "10.1/not.in.pubmed%5Bdoi%5D" in urls[0]
+
+    def test_biblio_batch(self):
+        article_set_page = self._article_set_page()
+        urls = []
+        def fake_http_get(url, headers=None, timeout=None, cache_enabled=True, allow_redirects=False):
+            urls.append(url)
+            return common.DummyResponse(200, article_set_page)
+        self.provider.http_get = fake_http_get
+
+        response = self.provider.biblio_batch([[("pmid", "16060722")], [("url", "http://a")], [("pmid", "17593900")]], 
+            cache_enabled=False)
+        assert_equals(response[0]["title"], u'Why most published research findings are false.')
+        assert_equals(response[1], None)
+        assert "title" in response[2]
+        assert_equals(len(urls), 1)
+        assert "id=16060722,17593900&" in urls[0]
+
+    def test_metrics_builds_provenance_urls_without_more_requests(self):
+        metrics_page = open(SAMPLE_EXTRACT_METRICS_PAGE, "r").read()
+        urls = []
+        def fake_http_get(url, headers=None, timeout=None, cache_enabled=True, allow_redirects=False):
+            urls.append(url)
+            if "entrez2pmcciting" in url:
+                return common.DummyResponse(200, metrics_page)
+            if "elink" in url:
+                return common.DummyResponse(200, "<a>http://f1000.com/pubmed/16060722</a>")
+            if "review" in url:
+                return common.DummyResponse(200, "<eSearchResult><IdList><Id>111</Id><Id>222</Id></IdList></eSearchResult>")
+            return common.DummyResponse(200, "<eSearchResult><IdList><Id>333</Id></IdList></eSearchResult>")
+        self.provider.http_get = fake_http_get
+
+        metrics_dict = self.provider.metrics([self.testitem_metrics], cache_enabled=False)
+        assert_equals(metrics_dict["pubmed:f1000"], ("Yes", "http://f1000.com/pubmed/16060722"))
+        assert_equals(metrics_dict["pubmed:pmc_citations"][0], 149)
+        assert_equals(metrics_dict["pubmed:pmc_citations_reviews"], 
+            (2, "http://www.ncbi.nlm.nih.gov/pubmed?term=111%2520OR%2520222&cmd=DetailsSearch"))
+        assert_equals(metrics_dict["pubmed:pmc_citations_editorials"], 
+            (1, "http://www.ncbi.nlm.nih.gov/pubmed?term=333&cmd=DetailsSearch"))
+        # f1000, citations, and the two filters; the drilldown urls come from the same responses
+        assert_equals(len(urls), 4)
+
+        # on its own, provenance_url still looks up what it needs
+        url = self.provider.provenance_url("pubmed:pmc_citations_editorials", [self.testitem_metrics])
+        assert_equals(url, "http://www.ncbi.nlm.nih.gov/pubmed?term=333&cmd=DetailsSearch")
+        assert_equals(len(urls), 6)
+
     def test_extract_citing_pmcids(self):
         f = open(SAMPLE_EXTRACT_METRICS_PAGE, "r")
         pmcids = self.provider._extract_citing_pmcids(f.read())
@@ -1,7 +1,9 @@
-import json, os, Queue, datetime
+import json, os, Queue, datetime, copy, socket, time, threading
 
-from totalimpact import dao, tiredis, backend, default_settings
-from totalimpact.providers.provider import Provider, ProviderTimeout, ProviderFactory
+from totalimpact import dao, tiredis, backend, default_settings, stats
+from totalimpact import item as item_module
+from totalimpact.providers.provider import Provider, ProviderTimeout, ProviderFactory, ProviderRateLimitError
+from totalimpact.providers.provider import ProviderHttpError, ProviderServerError
 from nose.tools import raises, assert_equals, nottest
 from test.utils import slow
 from test import mocks
@@ -23,6 +25,9 @@ class TestBackend():
         self.r = tiredis.from_url("redis://localhost:6379", db=8)
         self.r.flushdb()
 
+        # tests that make providers fail shouldn't leave their circuits open for the next test
+        backend.circuit_breakers.clear()
+
         provider_queues = {}
         providers = ProviderFactory.get_providers(self.TEST_PROVIDER_CONFIG)
         for provider in providers:
@@ -50,13 +55,335 @@ class TestBackend():
         self.r.flushdb()
 
 
+class TestReliableRedisQueue(TestBackend):
+    def test_pop_and_ack(self):
+        test_queue = backend.ReliableRedisQueue("test_queue", self.r)
+        test_queue.push(["tiid1", {"doi":["10.1"]}, []])
+        message = test_queue.pop()
+        assert_equals(message, ["tiid1", {"doi":["10.1"]}, []])
+
+        # kept in redis until it is acked
+        assert_equals(self.r.llen("test_queue_processing"), 1)
+        assert_equals(self.r.zcard("test_queue_claims"), 1)
+
+        test_queue.ack(message)
+        assert_equals(self.r.llen("test_queue_processing"), 0)
+        assert_equals(self.r.zcard("test_queue_claims"), 0)
+
+    def test_ack_identical_messages_separately(self):
+        test_queue = backend.ReliableRedisQueue("test_queue", self.r)
+        test_queue.push(["tiid1", {}, []])
+        test_queue.push(["tiid1", {}, []])
+        first = test_queue.pop()
+        second = test_queue.pop()
+        assert first.claim != second.claim
+
+        test_queue.ack(second)
+        assert_equals(self.r.zrange("test_queue_claims", 0, -1), [first.claim])
+        # acking twice doesn't take another message's claim with it
+        test_queue.ack(second)
+        assert_equals(self.r.zcard("test_queue_claims"), 1)
+        test_queue.ack(first)
+        assert_equals(self.r.zcard("test_queue_claims"), 0)
+        assert_equals(self.r.llen("test_queue_processing"), 0)
+
+    def test_ack_through_weighted_fair_queue(self):
+        lanes = {"high": backend.ReliableRedisQueue("test_queue", self.r), 
+            "low": backend.ReliableRedisQueue("test_queue_low", self.r)}
+        test_queue = backend.WeightedFairQueue("test_queue", lanes, {"high":4, "low":1}, priority_index=3)
+        test_queue.push(["tiid1", {}, [], "low"])
+        message = test_queue.pop()
+        test_queue.ack(message)
+        assert_equals(self.r.zcard("test_queue_low_claims"), 0)
+        assert_equals(self.r.llen("test_queue_low_processing"), 0)
+
+    def test_touch(self):
+        test_queue = backend.ReliableRedisQueue("test_queue", self.r, visibility_timeout=60)
+        test_queue.push(["tiid1", {}, []])
+        message = test_queue.pop()
+        self.r.zadd("test_queue_claims", **{message.claim: time.time() - 1})
+        assert_equals(test_queue.touch(message), True)
+        assert self.r.zscore("test_queue_claims", message.claim) > time.time() + 50
+        assert_equals(test_queue.requeue_expired(), 0)
+
+    def test_touch_after_requeued(self):
+        test_queue = backend.ReliableRedisQueue("test_queue", self.r, visibility_timeout=0)
+        test_queue.push(["tiid1", {}, []])
+        message = test_queue.pop()
+        assert_equals(test_queue.requeue_expired(), 1)
+        assert_equals(test_queue.touch(message), False)
+        assert_equals(self.r.zcard("test_queue_claims"), 0)
+
+    def test_pop_empty_queue(self):
+        test_queue = backend.ReliableRedisQueue("test_queue", self.r)
+        assert_equals(test_queue.pop(timeout=0.1), None)
+
+    def test_requeue_expired(self):
+        test_queue = backend.ReliableRedisQueue("test_queue", self.r, visibility_timeout=0)
+        test_queue.push(["tiid1", {}, []])
+        test_queue.push(["tiid1", {}, []])
+        first = test_queue.pop()
+        second = test_queue.pop()
+
+        # a second process would see the same expired claims, but each is only requeued once
+        other_process_queue = backend.ReliableRedisQueue("test_queue", self.r, visibility_timeout=0)
+        assert_equals(other_process_queue.requeue_expired(), 2)
+        assert_equals(test_queue.requeue_expired(), 0)
+
+        assert_equals(self.r.llen("test_queue_processing"), 0)
+        assert_equals(other_process_queue.pop(), ["tiid1", {}, []])
+
+
+class TestBufferedQueue(TestBackend):
+    def test_pop_through_buffer_and_ack(self):
+        test_queue = backend.ReliableRedisQueue("test_queue", self.r)
+        buffered_queue = backend.BufferedQueue(test_queue)
+        test_queue.push(["tiid1", {"doi":["10.1"]}, []])
+        assert_equals(buffered_queue.pop(timeout=0.1), None)
+
+        buffered_queue.run()
+        message = buffered_queue.pop(timeout=0.1)
+        assert_equals(message, ["tiid1", {"doi":["10.1"]}, []])
+        buffered_queue.ack(message)
+        assert_equals(self.r.zcard("test_queue_claims"), 0)
+        assert_equals(self.r.llen("test_queue_processing"), 0)
+
+
+class TestWorker(TestBackend):
+    def test_run_in_loop_survives_errors(self):
+        class FlakyWorker(backend.Worker):
+            name = "flaky_worker"
+            error_backoff = 0
+            runs = 0
+            def run(self):
+                self.runs += 1
+                if self.runs == 1:
+                    raise Exception("redis went away")
+                raise KeyboardInterrupt  # to get out of the loop
+        worker = FlakyWorker()
+        try:
+            worker.run_in_loop()
+        except KeyboardInterrupt:
+            pass
+        assert_equals(worker.runs, 2)
+
+
+class TestRedisSemaphore(TestBackend):
+    def test_limit(self):
+        semaphore = backend.RedisSemaphore("myfakeprovider", self.r, 2)
+        first = semaphore.try_acquire()
+        second = semaphore.try_acquire()
+        assert first and second
+        assert_equals(semaphore.try_acquire(), None)
+
+        semaphore.release(first)
+        assert semaphore.try_acquire()
+
+    def test_expired_lease_is_dropped(self):
+        semaphore = backend.RedisSemaphore("myfakeprovider", self.r, 1, lease_timeout=-1)
+        assert semaphore.try_acquire()
+        assert semaphore.try_acquire()
+
+
+class TestQueueStats(TestBackend):
+    def setUp(self):
+        TestBackend.setUp(self)
+        stats.backend_stats.reset()
+
+    def test_python_queue_records_wait(self):
+        test_queue = backend.PythonQueue("test_queue")
+        test_queue.push(("tiid1",))
+        assert_equals(test_queue.depth(), 1)
+        assert_equals(test_queue.pop(), ("tiid1",))
+
+        snapshot = stats.backend_stats.snapshot()
+        assert_equals(snapshot["counters"]["queue:test_queue:pushed"], 1)
+        assert_equals(snapshot["counters"]["queue:test_queue:popped"], 1)
+        assert_equals(snapshot["histograms"]["queue:test_queue:wait"]["count"], 1)
+
+    def test_redis_queue_records_wait(self):
+        test_queue = backend.RedisQueue("test_queue", self.r)
+        test_queue.push(["tiid1", {}, []])
+        assert_equals(test_queue.depth(), 1)
+        assert_equals(test_queue.pop(), ["tiid1", {}, []])
+        assert_equals(stats.backend_stats.snapshot()["histograms"]["queue:test_queue:wait"]["count"], 1)
+
+    def test_redis_queue_pops_messages_without_envelope(self):
+        self.r.add_to_alias_queue("abcd", {"doi":["10.1"]})
+        test_queue = backend.RedisQueue("aliasqueue", self.r)
+        assert_equals(test_queue.pop(), ["abcd", {"doi":["10.1"]}, []])
+        assert_equals(stats.backend_stats.snapshot()["histograms"], {})
+
+    def test_wrapper_records_service_time(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.exception_to_raise = ProviderTimeout
+        backend.ProviderWorker.wrapper("123", {"doi":["10.1"]}, provider, "biblio", [], lambda *args: None)
+
+        snapshot = stats.backend_stats.snapshot()
+        assert_equals(snapshot["counters"]["provider:myfakeprovider:biblio:errors"], 1)
+        assert_equals(snapshot["histograms"]["provider:myfakeprovider:biblio:service"]["count"], 1)
+
+    def test_stats_dumper(self):
+        test_queue = backend.PythonQueue("test_queue")
+        test_queue.push(("tiid1",))
+        dumper = backend.StatsDumper([test_queue], self.r, interval=0)
+        dumper.run()
+
+        dumped = self.r.get_backend_stats()[dumper.process_name]
+        assert_equals(dumped["gauges"]["queue:test_queue:depth"], 1)
+        assert_equals(dumped["counters"]["queue:test_queue:pushed"], 1)
+
+
+class TestAdaptiveLimiter():
+    def setUp(self):
+        self.limiter = backend.AdaptiveLimiter("myfakeprovider", 4, max_limit=6, cooldown=60)
+
+    def test_increases_additively(self):
+        # about one more slot per limit's worth of calls
+        for i in range(5):
+            self.limiter.record(0.1)
+        assert_equals(int(self.limiter.limit), 5)
+        for i in range(100):
+            self.limiter.record(0.1)
+        assert_equals(self.limiter.limit, 6)
+
+    def test_backs_off_on_overload_once_per_cooldown(self):
+        self.limiter.record(0.1, overloaded=True)
+        assert_equals(self.limiter.limit, 2)
+        self.limiter.record(0.1, overloaded=True)
+        assert_equals(self.limiter.limit, 2)
+
+    def test_backs_off_when_much_slower_than_usual(self):
+        self.limiter.record(1)
+        self.limiter.record(2.5)  # slower, but not 3 times usual
+        assert self.limiter.limit > 4
+        self.limiter.record(20)
+        assert_equals(int(self.limiter.limit), 2)
+
+    def test_never_below_min(self):
+        limiter = backend.AdaptiveLimiter("myfakeprovider", 1, cooldown=0)
+        limiter.record(0.1, overloaded=True)
+        assert_equals(limiter.limit, 1)
+
+    def test_acquire_and_release(self):
+        for i in range(4):
+            self.limiter.acquire()
+        assert_equals(self.limiter.in_use, 4)
+        self.limiter.release()
+        self.limiter.acquire()
+        assert_equals(self.limiter.in_use, 4)
+
+
+class TestCircuitBreaker():
+    def setUp(self):
+        self.breaker = backend.CircuitBreaker("myfakeprovider", failure_threshold=3, reset_timeout=60)
+
+    def test_opens_after_failures_in_a_row(self):
+        for i in range(2):
+            self.breaker.record(True)
+        self.breaker.record(False)  # a success resets the count
+        for i in range(2):
+            self.breaker.record(True)
+        assert self.breaker.allow()
+        self.breaker.record(True)
+        assert_equals(self.breaker.state, "open")
+        assert not self.breaker.allow()
+
+    def test_half_open_probe(self):
+        for i in range(3):
+            self.breaker.record(True)
+        self.breaker.opened_at -= 60
+
+        assert self.breaker.allow()  # the probe
+        assert_equals(self.breaker.state, "half_open")
+        assert not self.breaker.allow()  # only one probe at a time
+
+        self.breaker.record(True)
+        assert_equals(self.breaker.state, "open")
+        self.breaker.opened_at -= 60
+        assert self.breaker.allow()
+        self.breaker.record(False)
+        assert_equals(self.breaker.state, "closed")
+        assert self.breaker.allow()
+
+
+class TestCouchShard():
+    def test_couch_shard_is_stable(self):
+        assert_equals(backend.couch_shard("abcd", 8), backend.couch_shard(u"abcd", 8))
+        assert_equals(backend.couch_shard("abcd", 1), 0)
+
+    def test_couch_shard_spreads_tiids(self):
+        # tiids that share a first letter used to all land on one writer
+        shards = set([backend.couch_shard("a" + str(i), 8) for i in range(100)])
+        assert_equals(len(shards), 8)
+
+
+class TestFrozenAliases():
+    def setUp(self):
+        self.aliases_dict = {"doi":["10.1", "10.2"], "biblio":[{"title":"a"}], "last_modified":"2012-01-01"}
+        self.frozen = backend.FrozenAliases(self.aliases_dict)
+
+    def test_equals_original(self):
+        assert_equals(self.frozen, self.aliases_dict)
+        assert_equals(self.frozen["doi"], ("10.1", "10.2"))
+        assert_equals(self.frozen["last_modified"], "2012-01-01")
+
+    @raises(TypeError)
+    def test_cant_change(self):
+        self.frozen["pmid"] = ["123"]
+
+    def test_deepcopy_is_mutable(self):
+        thawed = copy.deepcopy(self.frozen)
+        thawed["doi"].append("10.3")
+        assert_equals(self.frozen["doi"], ("10.1", "10.2"))
+
+    def test_merge_alias_dicts(self):
+        merged = item_module.merge_alias_dicts(self.frozen, {"doi":["10.3"]})
+        assert_equals(merged["doi"], ["10.1", "10.2", "10.3"])
+
+    def test_json(self):
+        assert_equals(json.loads(json.dumps(self.frozen)), self.aliases_dict)
+
+
+class TestWeightedFairQueue(TestBackend):
+    def setUp(self):
+        TestBackend.setUp(self)
+        self.lanes = {
+            tiredis.HIGH_PRIORITY: backend.PythonQueue("test_queue"),
+            tiredis.LOW_PRIORITY: backend.PythonQueue("test_queue_low")}
+        self.weights = {tiredis.HIGH_PRIORITY: 3, tiredis.LOW_PRIORITY: 1}
+        self.queue = backend.WeightedFairQueue("test_queue", self.lanes, self.weights, priority_index=1)
+
+    def test_push_routes_on_priority(self):
+        self.queue.push(("tiid1", tiredis.LOW_PRIORITY))
+        self.queue.push(("tiid2", tiredis.HIGH_PRIORITY))
+        self.queue.push(("tiid3",))  # no priority means the default lane
+        assert_equals(self.lanes[tiredis.LOW_PRIORITY].queue.qsize(), 1)
+        assert_equals(self.lanes[tiredis.HIGH_PRIORITY].queue.qsize(), 2)
+
+    def test_pop_is_weighted(self):
+        for i in range(8):
+            self.queue.push(("high"+str(i), tiredis.HIGH_PRIORITY))
+            self.queue.push(("low"+str(i), tiredis.LOW_PRIORITY))
+        popped = [self.queue.pop()[1] for i in range(8)]
+        assert_equals(popped.count(tiredis.HIGH_PRIORITY), 6)
+        assert_equals(popped.count(tiredis.LOW_PRIORITY), 2)
+
+    def test_pop_uses_leftover_capacity(self):
+        for i in range(3):
+            self.queue.push(("low"+str(i), tiredis.LOW_PRIORITY))
+        popped = [self.queue.pop()[0] for i in range(3)]
+        assert_equals(popped, ["low0", "low1", "low2"])
+        assert_equals(self.queue.pop(timeout=0.1), None)
+
+
 class TestProviderWorker(TestBackend):
     # warning: calls live provider right now
     def test_add_to_couch_queue_if_nonzero(self):    
         test_couch_queue = backend.PythonQueue("test_couch_queue")
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, {"a": test_couch_queue}, None, self.r)  
-        response = provider_worker.add_to_couch_queue_if_nonzero("aaatiid", #start fake tiid with "a" so in first couch queue
+                                        None, None, None, [test_couch_queue], None, self.r)  
+        response = provider_worker.add_to_couch_queue_if_nonzero("aaatiid", #only one couch queue, so every tiid goes to it
                 {"doi":["10.5061/dryad.3td2f"]}, 
                 "aliases", 
                 "dummy")
@@ -66,14 +393,25 @@ class TestProviderWorker(TestBackend):
         expected = ('aaatiid', {'doi': ['10.5061/dryad.3td2f']}, 'aliases')
         assert_equals(in_queue, expected)
 
+    def test_add_to_couch_queue_if_nonzero_routes_by_shard(self):    
+        test_couch_queues = [backend.PythonQueue("couch_queue_"+str(i)) for i in range(4)]
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        None, None, None, test_couch_queues, None, self.r)  
+        for i in range(2):
+            provider_worker.add_to_couch_queue_if_nonzero("bbbtiid", {"title":"fake item"}, "biblio")
+
+        shard = backend.couch_shard("bbbtiid", 4)
+        assert_equals(test_couch_queues[shard].queue.qsize(), 2)
+        assert_equals(sum([q.queue.qsize() for q in test_couch_queues]), 2)
+
     def test_add_to_couch_queue_if_nonzero_given_metrics(self):    
         test_couch_queue = backend.PythonQueue("test_couch_queue")
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, {"a": test_couch_queue}, None, self.r)  
+                                        None, None, None, [test_couch_queue], None, self.r)  
         metrics_method_response = {'dryad:package_views': (361, 'http://dx.doi.org/10.5061/dryad.7898'), 
                     'dryad:total_downloads': (176, 'http://dx.doi.org/10.5061/dryad.7898'), 
                     'dryad:most_downloaded_file': (65, 'http://dx.doi.org/10.5061/dryad.7898')}        
-        response = provider_worker.add_to_couch_queue_if_nonzero("aaatiid", #start fake tiid with "a" so in first couch queue
+        response = provider_worker.add_to_couch_queue_if_nonzero("aaatiid", #only one couch queue, so every tiid goes to it
                 metrics_method_response,
                 "metrics", 
                 "dummy")
@@ -91,9 +429,9 @@ class TestProviderWorker(TestBackend):
     def test_add_to_couch_queue_if_nonzero_given_empty_metrics_response(self):    
         test_couch_queue = backend.PythonQueue("test_couch_queue")
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, {"a": test_couch_queue}, None, self.r)  
+                                        None, None, None, [test_couch_queue], None, self.r)  
         metrics_method_response = {}
-        response = provider_worker.add_to_couch_queue_if_nonzero("aaatiid", #start fake tiid with "a" so in first couch queue
+        response = provider_worker.add_to_couch_queue_if_nonzero("aaatiid", #only one couch queue, so every tiid goes to it
                 metrics_method_response,
                 "metrics", 
                 "dummy")
@@ -121,6 +459,386 @@ class TestProviderWorker(TestBackend):
         expected = {'url': ['http://somewhere'], 'doi': ['10.1', '10.123']}
         assert_equals(response, expected)
 
+    def test_wrapper_leaves_shared_message_alone(self):     
+        callback_args = []
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run):
+            callback_args.append(aliases_providers_run)
+
+        alias_dict = backend.FrozenAliases({'url': ['http://somewhere'], 'doi': ['10.123']})
+        aliases_providers_run = ("pubmed",)
+        response = backend.ProviderWorker.wrapper("123", alias_dict,
+                mocks.ProviderMock("myfakeprovider"), "aliases", aliases_providers_run, fake_callback)
+        assert_equals(response, {'url': ['http://somewhere'], 'doi': ['10.1', '10.123']})
+        assert_equals(callback_args, [["pubmed", "myfakeprovider"]])
+        assert_equals(aliases_providers_run, ("pubmed",))
+        assert_equals(alias_dict, {'url': ['http://somewhere'], 'doi': ['10.123']})
+
+    def test_pooled_worker_run_calls_wrapper_in_same_thread(self):
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_provider_queue = backend.PythonQueue("test_provider_queue", maxsize=2)
+        provider_worker = backend.PooledProviderWorker(mocks.ProviderMock("myfakeprovider"),
+                                        None, None, test_provider_queue, [test_couch_queue],
+                                        backend.ProviderWorker.wrapper, self.r)
+        assert_equals(provider_worker.pool_size, 20)
+
+        test_provider_queue.push(("aaatiid", {"doi":["10.5061/dryad.3td2f"]}, "biblio", []))
+        provider_worker.run()
+
+        # no thread spawned, so the biblio is already waiting on the couch queue
+        in_queue = test_couch_queue.pop()
+        expected = ('aaatiid', {"title": "fake item"}, 'biblio')
+        assert_equals(in_queue, expected)
+
+    def test_pooled_worker_run_survives_provider_exception(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.exception_to_raise = ValueError
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.PooledProviderWorker(provider,
+                                        None, None, test_provider_queue, {},
+                                        backend.ProviderWorker.wrapper, self.r)
+
+        test_provider_queue.push(("aaatiid", {"doi":["10.5061/dryad.3td2f"]}, "biblio", []))
+        response = provider_worker.run()
+        assert_equals(response, None)
+
+    def test_pooled_worker_releases_claim_when_wrapper_raises(self):
+        def broken_wrapper(*args, **kwargs):
+            raise ValueError("bug in the wrapper")
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.PooledProviderWorker(mocks.ProviderMock("myfakeprovider"),
+                                        None, None, test_provider_queue, [backend.PythonQueue("test_couch_queue")],
+                                        broken_wrapper, self.r)
+        self.r.set_num_providers_left("aaatiid", 1)
+        self.r.claim_in_flight("aaatiid", "metrics", "myfakeprovider", 60)
+
+        test_provider_queue.push(("aaatiid", {"doi":["10.5061/dryad.3td2f"]}, "metrics", []))
+        provider_worker.run()
+
+        # counted off and free to run again, rather than looking like it is updating for an hour
+        assert_equals(self.r.get_num_providers_left("aaatiid"), 0)
+        assert_equals(self.r.claim_in_flight("aaatiid", "metrics", "myfakeprovider", 60), True)
+
+    def test_pooled_worker_acks_redis_message_and_releases_semaphore(self):
+        test_provider_queue = backend.ReliableRedisQueue("test_provider_queue", self.r)
+        semaphore = backend.RedisSemaphore("myfakeprovider", self.r, 1)
+        provider_worker = backend.PooledProviderWorker(mocks.ProviderMock("myfakeprovider"),
+                                        0.01, None, test_provider_queue, [backend.PythonQueue("test_couch_queue")],
+                                        backend.ProviderWorker.wrapper, self.r, semaphore=semaphore)
+
+        test_provider_queue.push(("aaatiid", {"doi":["10.5061/dryad.3td2f"]}, "biblio", []))
+        provider_worker.run()
+
+        assert_equals(self.r.llen("test_provider_queue_processing"), 0)
+        assert semaphore.try_acquire()
+
+    def test_pooled_worker_waits_for_work_without_holding_semaphore(self):
+        test_provider_queue = backend.ReliableRedisQueue("test_provider_queue", self.r)
+        semaphore = backend.RedisSemaphore("myfakeprovider", self.r, 1)
+        provider_worker = backend.PooledProviderWorker(mocks.ProviderMock("myfakeprovider"),
+                                        0.01, None, test_provider_queue, [backend.PythonQueue("test_couch_queue")],
+                                        backend.ProviderWorker.wrapper, self.r, semaphore=semaphore)
+        other_process_token = semaphore.acquire()
+
+        # nothing to do, so it returns rather than waiting for a slot
+        provider_worker.run()
+        assert_equals(self.r.zcard("semaphore:myfakeprovider"), 1)
+        semaphore.release(other_process_token)
+
+    def test_pooled_worker_drops_message_requeued_while_waiting_for_slot(self):
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_provider_queue = backend.ReliableRedisQueue("test_provider_queue", self.r, visibility_timeout=0)
+        class ReapingLimiter(object):
+            # the wait for a slot outlasts the visibility timeout, and the reaper runs meanwhile
+            max_limit = 1
+            def acquire(self):
+                test_provider_queue.requeue_expired()
+            def release(self):
+                pass
+            def record(self, latency, overloaded=False):
+                pass
+        provider_worker = backend.PooledProviderWorker(mocks.ProviderMock("myfakeprovider"),
+                                        None, None, test_provider_queue, [test_couch_queue],
+                                        backend.ProviderWorker.wrapper, self.r, limiter=ReapingLimiter())
+        test_provider_queue.push(["aaatiid", {"doi":["10.1"]}, "biblio", []])
+        provider_worker.run()
+
+        # whoever pops it next runs it, not this worker as well
+        assert_equals(test_couch_queue.depth(), 0)
+        assert_equals(self.r.llen("test_provider_queue"), 1)
+
+    def test_greenlet_worker_runs_messages_in_greenlets(self):
+        import gevent
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.GreenletProviderWorker(mocks.ProviderMock("myfakeprovider"),
+                                        None, None, test_provider_queue, [test_couch_queue],
+                                        backend.ProviderWorker.wrapper, self.r, pool_size=1000)
+        assert_equals(provider_worker.pool_size, 1000)
+
+        test_provider_queue.push(("aaatiid", {"doi":["10.5061/dryad.3td2f"]}, "biblio", []))
+        gevent.spawn(provider_worker.run).join()
+
+        in_queue = test_couch_queue.pop()
+        expected = ('aaatiid', {"title": "fake item"}, 'biblio')
+        assert_equals(in_queue, expected)
+
+    def test_greenlet_worker_pool_runs_calls_concurrently(self):
+        import gevent, gevent.queue
+        class SlowProvider(mocks.ProviderMock):
+            def biblio(self, aliases, url=None, cache_enabled=True):
+                gevent.sleep(0.5)
+                return self.biblio_returns
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        # what Queue.Queue becomes once the gevent engine has monkeypatched it
+        test_provider_queue.queue = gevent.queue.JoinableQueue()
+        provider_worker = backend.GreenletProviderWorker(SlowProvider("myfakeprovider"),
+                                        None, None, test_provider_queue, [test_couch_queue],
+                                        backend.ProviderWorker.wrapper, self.r, pool_size=50)
+        for i in range(50):
+            test_provider_queue.push(("tiid%i" %i, {"doi":["10.5061/dryad.3td2f"]}, "biblio", []))
+
+        started = time.time()
+        provider_worker.spawn_and_loop()
+        try:
+            while test_couch_queue.depth() < 50 and time.time() - started < 10:
+                gevent.sleep(0.05)
+        finally:
+            gevent.killall(provider_worker.greenlets)
+
+        # one after another these would take 25 seconds
+        assert_equals(test_couch_queue.depth(), 50)
+        assert time.time() - started < 5, time.time() - started
+
+    def test_wrapper_fails_fast_when_circuit_open(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.exception_to_raise = ProviderTimeout
+        responses = []
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run):
+            responses.append(new_content)
+
+        for i in range(backend.get_circuit_breaker("myfakeprovider").failure_threshold):
+            backend.ProviderWorker.wrapper("123", {"doi":["10.1"]}, provider, "metrics", [], fake_callback)
+        provider.exception_to_raise = None  # would succeed now, but the circuit is open
+        backend.ProviderWorker.wrapper("123", {"doi":["10.1"]}, provider, "metrics", [], fake_callback)
+
+        assert_equals(responses[-1], None)
+        snapshot = stats.backend_stats.snapshot()
+        assert_equals(snapshot["gauges"]["provider:myfakeprovider:circuit"], "open")
+        assert snapshot["counters"]["provider:myfakeprovider:metrics:short_circuited"] >= 1
+
+    def test_wrapper_opens_circuit_on_http_and_server_errors(self):
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run):
+            pass
+
+        for exception in [ProviderHttpError("connection refused"), ProviderServerError(None, "503")]:
+            backend.circuit_breakers.clear()
+            provider = mocks.ProviderMock("myfakeprovider")
+            provider.exception_to_raise = exception
+            for i in range(backend.get_circuit_breaker("myfakeprovider").failure_threshold):
+                backend.ProviderWorker.wrapper("123", {"doi":["10.1"]}, provider, "metrics", [], fake_callback)
+            assert_equals(backend.get_circuit_breaker("myfakeprovider").state, backend.CircuitBreaker.OPEN)
+
+    def test_pooled_worker_feeds_limiter(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.exception_to_raise = ProviderTimeout
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        limiter = backend.AdaptiveLimiter("myfakeprovider", 20, max_limit=40)
+        provider_worker = backend.PooledProviderWorker(provider,
+                                        None, None, test_provider_queue, [backend.PythonQueue("test_couch_queue")],
+                                        backend.ProviderWorker.wrapper, self.r, limiter=limiter)
+        assert_equals(provider_worker.pool_size, 40)
+
+        test_provider_queue.push(("aaatiid", {"doi":["10.5061/dryad.3td2f"]}, "biblio", []))
+        provider_worker.run()
+        assert_equals(limiter.limit, 10)
+        assert_equals(limiter.in_use, 0)
+
+    def test_pooled_worker_batches_metrics(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.metrics_batch_size = 3
+        batch_calls = []
+        def fake_metrics_batch(list_of_aliases):
+            batch_calls.append(list_of_aliases)
+            return [{"mock:pdf": (i, "http://drilldownurl.org")} for i in range(len(list_of_aliases))]
+        provider.metrics_batch = fake_metrics_batch
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.PooledProviderWorker(provider,
+                                        None, None, test_provider_queue, [test_couch_queue],
+                                        backend.ProviderWorker.wrapper, self.r, batch_window=0.1)
+
+        test_provider_queue.push(("aaatiid", {"doi":["10.1"]}, "metrics", []))
+        test_provider_queue.push(("bbbtiid", {"doi":["10.2"]}, "biblio", []))
+        test_provider_queue.push(("ccctiid", {"doi":["10.3"]}, "metrics", []))
+        provider_worker.run()
+
+        assert_equals(len(batch_calls), 1)
+        assert_equals(batch_calls[0], [[("doi", "10.1")], [("doi", "10.3")]])
+        in_queue = [test_couch_queue.pop(timeout=0) for i in range(2)]
+        assert_equals(in_queue, [
+            ('aaatiid', {"mock:pdf": (0, "http://drilldownurl.org")}, 'metrics'),
+            ('ccctiid', {"mock:pdf": (1, "http://drilldownurl.org")}, 'metrics')])
+
+        # the biblio message went back on the queue for another pool thread, not run in this one
+        assert_equals(test_couch_queue.depth(), 0)
+        assert_equals(test_provider_queue.pop(timeout=0), ("bbbtiid", {"doi":["10.2"]}, "biblio", []))
+
+    def test_pooled_worker_metrics_batch_end_to_end(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.metrics_batch_size = 5
+        provider.metrics_batch = lambda list_of_aliases: [
+            {"myfakeprovider:views": (10+i, "http://drilldownurl.org")} for i in range(len(list_of_aliases))]
+        tiids = ["tiid1", "tiid2", "tiid3"]
+        for tiid in tiids:
+            item = copy.deepcopy(self.fake_item)
+            item["_id"] = tiid
+            self.d.save(item)
+            self.r.set_num_providers_left(tiid, 1)
+            self.r.claim_in_flight(tiid, "metrics", "myfakeprovider", 60)
+
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.PooledProviderWorker(provider,
+                                        None, None, test_provider_queue, [test_couch_queue],
+                                        backend.ProviderWorker.wrapper, self.r, batch_window=0.1)
+        for tiid in tiids:
+            test_provider_queue.push(backend.ProviderMessage(tiid, backend.FrozenAliases({"doi":["10.1/"+tiid]}), 
+                "metrics", (), tiredis.LOW_PRIORITY))
+        provider_worker.run()
+        couch_worker = backend.BatchingCouchWorker(test_couch_queue, self.r, self.d, batch_window=0.1)
+        couch_worker.run()
+
+        for (i, tiid) in enumerate(tiids):
+            couch_response = self.d.get(tiid)
+            assert_equals(couch_response["metrics"]["myfakeprovider:views"]["values"]["raw"], 10+i)
+            assert_equals(self.r.get_num_providers_left(tiid), 0)
+            assert_equals(self.r.claim_in_flight(tiid, "metrics", "myfakeprovider", 60), True)
+
+    def test_pooled_worker_retries_rate_limited_message(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.exception_to_raise = ProviderRateLimitError
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_provider_queue = backend.ReliableRedisQueue("test_provider_queue", self.r)
+        provider_worker = backend.PooledProviderWorker(provider,
+                                        None, None, test_provider_queue, [test_couch_queue],
+                                        backend.ProviderWorker.wrapper, self.r)
+        provider_worker.rate_limit_retry_delay = 0.1
+        self.r.claim_in_flight("aaatiid", "biblio", "myfakeprovider", 60)
+        test_provider_queue.push(["aaatiid", {"doi":["10.1"]}, "biblio", [], tiredis.LOW_PRIORITY])
+        provider_worker.run()
+
+        # not answered with nothing, but back on the queue once the delay is up, still claimed
+        assert_equals(test_couch_queue.depth(), 0)
+        assert_equals(self.r.claim_in_flight("aaatiid", "biblio", "myfakeprovider", 60), False)
+        time.sleep(0.3)
+        assert_equals(self.r.llen("test_provider_queue_processing"), 0)
+        assert_equals(test_provider_queue.pop(timeout=0), ["aaatiid", {"doi":["10.1"]}, "biblio", [], tiredis.LOW_PRIORITY])
+
+        provider.exception_to_raise = None
+        test_provider_queue.push(["aaatiid", {"doi":["10.1"]}, "biblio", [], tiredis.LOW_PRIORITY])
+        provider_worker.run()
+        assert_equals(test_couch_queue.pop(timeout=0), ('aaatiid', {"title": "fake item"}, 'biblio'))
+
+    def test_pooled_worker_retries_rate_limited_items_of_batch(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.metrics_batch_size = 2
+        provider.metrics_batch = lambda list_of_aliases: [{"mock:pdf": (1, "")}, ProviderRateLimitError("slow down")]
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.PooledProviderWorker(provider,
+                                        None, None, test_provider_queue, [test_couch_queue],
+                                        backend.ProviderWorker.wrapper, self.r, batch_window=0.1)
+        provider_worker.rate_limit_retry_delay = 0.1
+        self.r.set_num_providers_left("bbbtiid", 1)
+        test_provider_queue.push(("aaatiid", {"doi":["10.1"]}, "metrics", [], tiredis.HIGH_PRIORITY))
+        test_provider_queue.push(("bbbtiid", {"doi":["10.2"]}, "metrics", [], tiredis.HIGH_PRIORITY))
+        provider_worker.run()
+
+        assert_equals(test_couch_queue.pop(timeout=0), ('aaatiid', {"mock:pdf": (1, "")}, 'metrics'))
+        assert_equals(test_couch_queue.depth(), 0)
+        # still waiting on the retry, so not counted off
+        assert_equals(self.r.get_num_providers_left("bbbtiid"), 1)
+        assert_equals(test_provider_queue.pop(timeout=1), ("bbbtiid", {"doi":["10.2"]}, "metrics", [], tiredis.HIGH_PRIORITY))
+
+    def test_batch_wrapper_drops_failed_items(self):
+        stats.backend_stats.reset()
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.metrics_batch = lambda list_of_aliases: [{"mock:pdf": (1, "")}, ProviderTimeout("too slow")]
+        responses = []
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run):
+            responses.append((tiid, new_content))
+        provider_messages = [("aaatiid", {"doi":["10.1"]}, "metrics", [], tiredis.HIGH_PRIORITY),
+            ("bbbtiid", {"doi":["10.2"]}, "metrics", [], tiredis.HIGH_PRIORITY)]
+
+        backend.ProviderWorker.batch_wrapper(provider_messages, provider, "metrics", [fake_callback, fake_callback])
+        assert_equals(responses, [("aaatiid", {"mock:pdf": (1, "")}), ("bbbtiid", None)])
+        assert_equals(stats.backend_stats.counters["provider:myfakeprovider:metrics:errors"], 1)
+
+    def test_pooled_worker_batches_aliases_keeping_priority(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.aliases_batch_size = 2
+        provider.aliases_batch = lambda list_of_aliases: [[("doi", "10.1")], [("doi", "10.2")]]
+        test_alias_queue = backend.PythonQueue("test_alias_queue")
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.PooledProviderWorker(provider,
+                                        None, test_alias_queue, test_provider_queue, [backend.PythonQueue("test_couch_queue")],
+                                        backend.ProviderWorker.wrapper, self.r, batch_window=0.1)
+
+        test_provider_queue.push(("aaatiid", {"url":["http://a"]}, "aliases", [], tiredis.HIGH_PRIORITY))
+        test_provider_queue.push(("bbbtiid", {"url":["http://b"]}, "aliases", [], tiredis.LOW_PRIORITY))
+        provider_worker.run()
+
+        in_queue = [test_alias_queue.pop(timeout=0) for i in range(2)]
+        assert_equals(in_queue, [
+            ("aaatiid", {"url":["http://a"], "doi":["10.1"]}, ["myfakeprovider"], tiredis.HIGH_PRIORITY),
+            ("bbbtiid", {"url":["http://b"], "doi":["10.2"]}, ["myfakeprovider"], tiredis.LOW_PRIORITY)])
+
+    def test_pooled_worker_passes_aliases_on_when_batch_raises(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        provider.aliases_batch_size = 2
+        def broken_aliases_batch(list_of_aliases):
+            raise TypeError("not a ProviderError")
+        provider.aliases_batch = broken_aliases_batch
+        test_alias_queue = backend.PythonQueue("test_alias_queue")
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.PooledProviderWorker(provider,
+                                        None, test_alias_queue, test_provider_queue, [backend.PythonQueue("test_couch_queue")],
+                                        backend.ProviderWorker.wrapper, self.r, batch_window=0.1)
+
+        test_provider_queue.push(("aaatiid", {"url":["http://a"]}, "aliases", [], tiredis.HIGH_PRIORITY))
+        test_provider_queue.push(("bbbtiid", {"url":["http://b"]}, "aliases", [], tiredis.LOW_PRIORITY))
+        provider_worker.run()
+
+        # on to the next alias provider with the aliases they had, rather than stuck here
+        in_queue = [test_alias_queue.pop(timeout=0) for i in range(2)]
+        assert_equals(in_queue, [
+            ("aaatiid", {"url":["http://a"]}, ["myfakeprovider"], tiredis.HIGH_PRIORITY),
+            ("bbbtiid", {"url":["http://b"]}, ["myfakeprovider"], tiredis.LOW_PRIORITY)])
+
+    def test_default_metrics_batch_calls_metrics_per_item(self):
+        provider = mocks.ProviderMock("myfakeprovider")
+        response = provider.metrics_batch([[("doi", "10.1")], [("doi", "10.2")]])
+        assert_equals(response, [provider.metrics_returns, provider.metrics_returns])
+
+        provider.exception_to_raise = ProviderTimeout
+        response = provider.metrics_batch([[("doi", "10.1")]])
+        assert isinstance(response[0], ProviderTimeout)
+
+    def test_aliases_callback_keeps_priority(self):
+        test_alias_queue = backend.PythonQueue("test_alias_queue")
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        None, test_alias_queue, None, [backend.PythonQueue("test_couch_queue")], None, self.r)  
+        callback = provider_worker.callback_for("aliases", tiredis.LOW_PRIORITY)
+        callback("aaatiid", {"doi":["10.1"]}, "aliases", ["pubmed"])
+        assert_equals(test_alias_queue.pop(), ("aaatiid", {"doi":["10.1"]}, ["pubmed"], tiredis.LOW_PRIORITY))
+
+    @raises(Queue.Full)
+    def test_bounded_python_queue(self):
+        test_queue = backend.PythonQueue("test_queue", maxsize=1)
+        test_queue.push("first")
+        test_queue.queue.put("second", block=False)
+
 class TestCouchWorker(TestBackend):
     def test_update_item_with_new_aliases(self):
         response = backend.CouchWorker.update_item_with_new_aliases(self.fake_aliases_dict, self.fake_item)
@@ -167,9 +885,8 @@ class TestCouchWorker(TestBackend):
 
     def test_run_aliases_in_queue(self):
         test_couch_queue = backend.PythonQueue("test_couch_queue")
-        test_couch_queue_dict = {self.fake_item["_id"][0]:test_couch_queue}
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, test_couch_queue_dict, None, self.r)  
+                                        None, None, None, [test_couch_queue], None, self.r)  
         response = provider_worker.add_to_couch_queue_if_nonzero(self.fake_item["_id"], 
                 {"doi":["10.5061/dryad.3td2f"]}, 
                 "aliases", 
@@ -196,9 +913,8 @@ class TestCouchWorker(TestBackend):
 
     def test_run_metrics_in_queue(self):
         test_couch_queue = backend.PythonQueue("test_couch_queue")
-        test_couch_queue_dict = {self.fake_item["_id"][0]:test_couch_queue}
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, test_couch_queue_dict, None, self.r) 
+                                        None, None, None, [test_couch_queue], None, self.r) 
         metrics_method_response = {'dryad:package_views': (361, 'http://dx.doi.org/10.5061/dryad.7898'), 
                             'dryad:total_downloads': (176, 'http://dx.doi.org/10.5061/dryad.7898'), 
                             'dryad:most_downloaded_file': (65, 'http://dx.doi.org/10.5061/dryad.7898')}                                         
@@ -225,8 +941,203 @@ class TestCouchWorker(TestBackend):
         assert_equals(couch_response["last_modified"][0:10], now[0:10])
 
 
+class TestBatchingCouchWorker(TestBackend):
+    def test_group_by_tiid(self):
+        couch_messages = [
+            ("tiid1", {"doi":["10.1"]}, "aliases"),
+            ("tiid2", {"title":"a title"}, "biblio"),
+            ("tiid1", {}, "metrics"),
+            ("tiid1", {"mendeley:groups": (3, "http://provenance")}, "metrics")]
+        response = backend.BatchingCouchWorker.group_by_tiid(couch_messages)
+        expected = {
+            "tiid1": [("aliases", {"doi":["10.1"]}), ("metrics", {"mendeley:groups": (3, "http://provenance")})],
+            "tiid2": [("biblio", {"title":"a title"})]}
+        assert_equals(dict(response), expected)
+
+    def test_pop_batch_drains_queue(self):
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        for i in range(5):
+            test_couch_queue.push(("tiid"+str(i), {"title":"a title"}, "biblio"))
+        couch_worker = backend.BatchingCouchWorker(test_couch_queue, self.r, self.d, 
+            batch_window=0.1, max_batch_size=3)
+        assert_equals(len(couch_worker.pop_batch()), 3)
+        assert_equals(len(couch_worker.pop_batch()), 2)
+
+    def test_run_merges_updates_into_one_save(self):
+        self.d.save(self.fake_item)
+        self.r.set_num_providers_left(self.fake_item["_id"], 2)
+
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_couch_queue.push((self.fake_item["_id"], {"doi":["10.5061/dryad.3td2f"]}, "aliases"))
+        test_couch_queue.push((self.fake_item["_id"], {"title":"A very good paper"}, "biblio"))
+        test_couch_queue.push((self.fake_item["_id"], 
+            {'dryad:package_views': (361, 'http://dx.doi.org/10.5061/dryad.7898')}, "metrics"))
+        test_couch_queue.push((self.fake_item["_id"], 
+            {'mendeley:groups': (3, 'http://provenance')}, "metrics"))
+
+        couch_worker = backend.BatchingCouchWorker(test_couch_queue, self.r, self.d, batch_window=0.1)
+        couch_worker.run()
+
+        couch_response = self.d.get(self.fake_item["_id"])
+        assert_equals(couch_response["_rev"][0:2], "2-")  # one save on top of the initial one
+        assert_equals(couch_response["aliases"], {'pmid': ['111'], 'doi': ['10.5061/dryad.3td2f']})
+        assert_equals(couch_response["biblio"], {"title":"A very good paper"})
+        assert_equals(couch_response["metrics"]['dryad:package_views']['values']["raw"], 361)
+        assert_equals(couch_response["metrics"]['mendeley:groups']['values']["raw"], 3)
+
+        # both metrics messages were counted
+        assert_equals(self.r.get_num_providers_left(self.fake_item["_id"]), 0)
+
+    def test_run_retries_when_bulk_update_fails_once(self):
+        self.d.save(self.fake_item)
+        self.r.set_num_providers_left(self.fake_item["_id"], 1)
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_couch_queue.push((self.fake_item["_id"], 
+            {'mendeley:groups': (3, 'http://provenance')}, "metrics"))
+
+        real_update = self.d.db.update
+        calls = []
+        def flaky_update(docs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise socket.error("connection reset")
+            return real_update(docs)
+        self.d.db.update = flaky_update
+        try:
+            couch_worker = backend.BatchingCouchWorker(test_couch_queue, self.r, self.d, batch_window=0.1)
+            couch_worker.run()
+        finally:
+            self.d.db.update = real_update
+
+        assert_equals(len(calls), 2)
+        couch_response = self.d.get(self.fake_item["_id"])
+        assert_equals(couch_response["metrics"]['mendeley:groups']['values']["raw"], 3)
+        assert_equals(self.r.get_num_providers_left(self.fake_item["_id"]), 0)
+
+    def test_run_survives_failing_bulk_update(self):
+        self.d.save(self.fake_item)
+        self.r.set_num_providers_left(self.fake_item["_id"], 1)
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_couch_queue.push((self.fake_item["_id"], 
+            {'mendeley:groups': (3, 'http://provenance')}, "metrics"))
+
+        real_update = self.d.db.update
+        def failing_update(docs):
+            raise socket.error("connection refused")
+        self.d.db.update = failing_update
+        try:
+            couch_worker = backend.BatchingCouchWorker(test_couch_queue, self.r, self.d, batch_window=0.1)
+            couch_worker.run()  # doesn't raise
+        finally:
+            self.d.db.update = real_update
+
+        # the save is lost, but the item doesn't look like it is updating forever
+        assert_equals(self.r.get_num_providers_left(self.fake_item["_id"]), 0)
+        assert_equals(test_couch_queue.depth(), 0)
+
+    def test_run_missing_item_still_decrements(self):
+        self.r.set_num_providers_left("notintheDB", 1)
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_couch_queue.push(("notintheDB", {'mendeley:groups': (3, 'http://provenance')}, "metrics"))
+
+        couch_worker = backend.BatchingCouchWorker(test_couch_queue, self.r, self.d, batch_window=0.1)
+        couch_worker.run()
+        assert_equals(self.r.get_num_providers_left("notintheDB"), 0)
+
+
 class TestBackendClass(TestBackend):
 
+    def test_run_passes_priority_to_provider_queues(self):
+        self.r.add_to_alias_queue("abcd", {"unknownnamespace":["111"]}, priority=tiredis.LOW_PRIORITY)
+        self.b.alias_queue = backend.RedisQueue("aliasqueue_low", self.r)
+        self.b.provider_queues = {"webpage": backend.PythonQueue("webpage_queue")}
+        self.b.run()
+        provider_message = self.b.provider_queues["webpage"].pop()
+        assert_equals(provider_message, ("abcd", {"unknownnamespace":["111"]}, "aliases", (), tiredis.LOW_PRIORITY))
+
+    def test_high_priority_dispatched_while_low_lane_is_full(self):
+        lanes = {
+            tiredis.HIGH_PRIORITY: backend.PythonQueue("webpage_queue", maxsize=1), 
+            tiredis.LOW_PRIORITY: backend.PythonQueue("webpage_queue_low", maxsize=1)}
+        provider_queues = {"webpage": backend.WeightedFairQueue("webpage_queue", lanes, 
+            {tiredis.HIGH_PRIORITY: 4, tiredis.LOW_PRIORITY: 1}, priority_index=4)}
+        low_dispatcher = backend.Backend(backend.RedisQueue(tiredis.ALIAS_QUEUE_NAMES[tiredis.LOW_PRIORITY], self.r), 
+            provider_queues, [], self.r, name="Backend_low")
+        high_dispatcher = backend.Backend(backend.RedisQueue(tiredis.ALIAS_QUEUE_NAMES[tiredis.HIGH_PRIORITY], self.r), 
+            provider_queues, [], self.r)
+
+        # the second low priority item can't fit in the low lane, so its dispatcher blocks
+        for tiid in ["low1", "low2"]:
+            self.r.add_to_alias_queue(tiid, {"unknownnamespace":["111"]}, priority=tiredis.LOW_PRIORITY)
+        self.r.add_to_alias_queue("high1", {"unknownnamespace":["111"]}, priority=tiredis.HIGH_PRIORITY)
+        low_thread = threading.Thread(target=lambda: [low_dispatcher.run() for i in range(2)])
+        low_thread.daemon = True
+        low_thread.start()
+        time.sleep(0.2)
+        assert low_thread.is_alive()
+
+        high_dispatcher.run()
+        assert_equals(lanes[tiredis.HIGH_PRIORITY].pop(timeout=0)[0], "high1")
+
+        # draining the low lane lets the low priority dispatcher carry on
+        assert_equals(lanes[tiredis.LOW_PRIORITY].pop(timeout=0)[0], "low1")
+        low_thread.join(2)
+        assert not low_thread.is_alive()
+        assert_equals(lanes[tiredis.LOW_PRIORITY].pop(timeout=0)[0], "low2")
+
+    def test_run_skips_jobs_already_in_flight(self):
+        self.b.alias_queue = backend.RedisQueue("aliasqueue", self.r)
+        self.b.provider_queues = {"webpage": backend.PythonQueue("webpage_queue")}
+        for i in range(2):
+            self.r.add_to_alias_queue("abcd", {"unknownnamespace":["111"]})
+            self.b.run()
+        assert_equals(self.b.provider_queues["webpage"].depth(), 1)
+
+        # once the first one is done, a new request goes through
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("webpage"), 
+                                        None, None, None, [backend.PythonQueue("test_couch_queue")], None, self.r)  
+        provider_worker.add_to_couch_queue_if_nonzero("abcd", {"unknownnamespace":["111"]}, "aliases")
+        self.r.add_to_alias_queue("abcd", {"unknownnamespace":["111"]})
+        self.b.run()
+        assert_equals(self.b.provider_queues["webpage"].depth(), 2)
+
+    def test_high_priority_request_not_deduplicated_onto_low_priority_job(self):
+        self.b.provider_queues = {"webpage": backend.PythonQueue("webpage_queue")}
+        self.r.add_to_alias_queue("abcd", {"unknownnamespace":["111"]}, priority=tiredis.LOW_PRIORITY)
+        self.b.alias_queue = backend.RedisQueue("aliasqueue_low", self.r)
+        self.b.run()
+        self.r.add_to_alias_queue("abcd", {"unknownnamespace":["111"]}, priority=tiredis.HIGH_PRIORITY)
+        self.b.alias_queue = backend.RedisQueue("aliasqueue", self.r)
+        self.b.run()
+
+        in_queue = [self.b.provider_queues["webpage"].pop(timeout=0)[4] for i in range(2)]
+        assert_equals(in_queue, [tiredis.LOW_PRIORITY, tiredis.HIGH_PRIORITY])
+
+    def test_metrics_stay_in_flight_until_counted(self):
+        self.r.claim_in_flight("abcd", "metrics", "wikipedia", 60)
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("wikipedia"), 
+                                        None, None, None, [backend.PythonQueue("test_couch_queue")], None, self.r)  
+        provider_worker.add_to_couch_queue_if_nonzero("abcd", {"wikipedia:mentions": 1}, "metrics")
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "wikipedia", 60), False)
+
+        couch_worker = backend.CouchWorker(backend.PythonQueue("test_couch_queue"), self.r, self.d)
+        couch_worker.decr_num_providers_left("wikipedia:mentions", "abcd")
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "wikipedia", 60), True)
+
+    def test_sniffer_does_not_construct_providers(self):
+        backend.Backend.sniffer({"doi":["10.1371/journal.pcbi.1"]}, ["pubmed", "crossref"], self.TEST_PROVIDER_CONFIG)
+
+        def fail_if_called(*args, **kwargs):
+            raise AssertionError("sniffer constructed providers")
+        original_get_providers = ProviderFactory.get_providers
+        ProviderFactory.get_providers = classmethod(fail_if_called)
+        try:
+            response = backend.Backend.sniffer({"doi":["10.1371/journal.pcbi.1"]}, ["pubmed", "crossref"], 
+                self.TEST_PROVIDER_CONFIG)
+        finally:
+            ProviderFactory.get_providers = original_get_providers
+        assert_equals(response, {'metrics': ["wikipedia"], 'biblio': ["pubmed", "crossref"], 'aliases': []})
+
     def test_decide_who_to_call_next_unknown(self):
         aliases_dict = {"unknownnamespace":["111"]}
         prev_aliases = []
@@ -0,0 +1,163 @@
+from nose.tools import raises, assert_equals, nottest
+import pylibmc, time, os
+
+from totalimpact import cache
+from totalimpact.stats import backend_stats
+
+class TestCache():
+
+    def setUp(self):
+        self.cache = cache.Cache(60)
+        self.cache.flush_cache()
+
+    def test_set_and_get_cache_entry(self):
+        key = {"url": "http://example.com", "allow_redirects": False}
+        self.cache.set_cache_entry(key, {"status_code": 200, "text": "hi"})
+        assert_equals(self.cache.get_cache_entry(key), {"status_code": 200, "text": "hi"})
+
+    def test_get_cache_entry_missing(self):
+        assert_equals(self.cache.get_cache_entry({"url": "http://example.com/missing"}), None)
+
+    def test_get_cache_entry_counts_tiers(self):
+        key = {"url": "http://example.com"}
+        self.cache.set_cache_entry(key, {"status_code": 200, "text": "hi"})
+        backend_stats.reset()
+
+        self.cache.get_cache_entry(key)
+        assert_equals(backend_stats.counters["cache:local:hits"], 1)
+
+        # as if another process had stored it
+        cache.get_local_cache().clear()
+        self.cache.get_cache_entry(key)
+        assert_equals(backend_stats.counters["cache:local:misses"], 1)
+        assert_equals(backend_stats.counters["cache:memcached:hits"], 1)
+
+        # and now it is back in the local tier
+        self.cache.get_cache_entry(key)
+        assert_equals(backend_stats.counters["cache:local:hits"], 2)
+
+    def test_local_copy_keeps_memcached_expiry(self):
+        key = {"url": "http://example.com"}
+        self.cache.set_cache_entry(key, {"status_code": 200, "text": "hi"}, 10)
+        cache.get_local_cache().clear()
+        self.cache.get_cache_entry(key)
+        # the 10 seconds the entry was stored for, not the cache's 60
+        (expires, size, data) = cache.get_local_cache().entries[self.cache._build_hash_key(key)]
+        assert expires <= time.time() + 10
+
+    def test_memcached_down_is_a_miss(self):
+        class DownPool(object):
+            def reserve(self):
+                raise pylibmc.Error("memcached is down")
+        key = {"url": "http://example.com/down"}
+        real_pool = cache.get_memcached_pool()
+        cache.memcached_pool = DownPool()
+        try:
+            assert_equals(self.cache.get_cache_entry(key), None)
+            assert_equals(len(cache.get_local_cache().entries), 0)
+        finally:
+            cache.memcached_pool = real_pool
+
+    def test_compresses_large_entries(self):
+        key = {"url": "http://example.com/big"}
+        data = {"status_code": 200, "text": "<xml>" * 10000}
+        self.cache.set_cache_entry(key, data)
+        hash_key = self.cache._build_hash_key(key)
+        with cache.get_memcached_pool().reserve() as mc:
+            stored = mc.get(hash_key)
+        assert "_compressed" in stored
+        cache.get_local_cache().clear()
+        assert_equals(self.cache.get_cache_entry(key), data)
+
+    def test_chunks_entries_too_big_for_memcached(self):
+        self.cache.chunk_size = 1000
+        key = {"url": "http://example.com/huge"}
+        data = {"status_code": 200, "text": os.urandom(5000).encode("hex")}
+        self.cache.set_cache_entry(key, data)
+        hash_key = self.cache._build_hash_key(key)
+        with cache.get_memcached_pool().reserve() as mc:
+            stored = mc.get(hash_key)
+        assert len(stored["_chunks"]) > 5
+        cache.get_local_cache().clear()
+        assert_equals(self.cache.get_cache_entry(key), data)
+
+    def test_missing_chunk_is_a_miss(self):
+        self.cache.chunk_size = 1000
+        key = {"url": "http://example.com/huge"}
+        self.cache.set_cache_entry(key, {"status_code": 200, "text": os.urandom(5000).encode("hex")})
+        hash_key = self.cache._build_hash_key(key)
+        with cache.get_memcached_pool().reserve() as mc:
+            mc.delete(mc.get(hash_key)["_chunks"][2])
+        cache.get_local_cache().clear()
+        assert_equals(self.cache.get_cache_entry(key), None)
+
+    def test_memcached_calls_on_gevent_threadpool(self):
+        cache.use_threadpool_for_memcached()
+        try:
+            key = {"url": "http://example.com/gevent"}
+            self.cache.set_cache_entry(key, {"status_code": 200, "text": "hi"})
+            assert cache.memcached_threadpool.size > 0
+            cache.get_local_cache().clear()
+            assert_equals(self.cache.get_cache_entry(key), {"status_code": 200, "text": "hi"})
+        finally:
+            cache.memcached_threadpool = None
+
+
+class TestLocalCache():
+
+    def setUp(self):
+        self.local_cache = cache.LocalCache(max_bytes=1000, max_entries=3)
+
+    def test_set_and_get(self):
+        self.local_cache.set("a", {"text": "hi"}, 60)
+        assert_equals(self.local_cache.get("a"), {"text": "hi"})
+        assert_equals(self.local_cache.get("b"), None)
+
+    def test_get_expired(self):
+        self.local_cache.set("a", {"text": "hi"}, -1)
+        assert_equals(self.local_cache.get("a"), None)
+        assert_equals(self.local_cache.num_bytes, 0)
+
+    def test_evicts_least_recently_used_entry(self):
+        for key in ["a", "b", "c"]:
+            self.local_cache.set(key, key, 60)
+        self.local_cache.get("a")
+        self.local_cache.set("d", "d", 60)
+        assert_equals(self.local_cache.entries.keys(), ["c", "a", "d"])
+
+    def test_evicts_by_size(self):
+        self.local_cache.set("a", "x"*600, 60)
+        self.local_cache.set("b", "x"*600, 60)
+        assert_equals(self.local_cache.entries.keys(), ["b"])
+        assert_equals(self.local_cache.num_bytes, 600)
+
+    def test_does_not_store_entries_bigger_than_max_bytes(self):
+        self.local_cache.set("a", "x"*2000, 60)
+        assert_equals(self.local_cache.get("a"), None)
+
+
+class TestMemcachedPool():
+
+    def test_get_memcached_pool_is_shared(self):
+        pool = cache.get_memcached_pool()
+        assert pool is cache.get_memcached_pool()
+
+    def test_reserve_reuses_client(self):
+        pool = cache.MemcachedPool(1)
+        with pool.reserve() as mc:
+            mc.set("test_pool", "foo")
+            first_client = mc
+        with pool.reserve() as mc:
+            assert_equals(mc.get("test_pool"), "foo")
+            assert mc is first_client
+
+    def test_reserve_drops_client_after_error(self):
+        pool = cache.MemcachedPool(1)
+        try:
+            with pool.reserve() as mc:
+                first_client = mc
+                raise pylibmc.Error("connection lost")
+        except pylibmc.Error:
+            pass
+        with pool.reserve() as mc:
+            assert mc is not first_client
@@ -74,3 +74,21 @@ class TestDAO(unittest.TestCase):
 
 
              
+
+    def test_get_many(self):
+        self.d.save({"_id":"123", "type":"item"})
+        self.d.save({"_id":"456", "type":"item"})
+
+        docs = self.d.get_many(["123", "456", "notthere"])
+        assert_equals(sorted(docs.keys()), ["123", "456"])
+        assert_equals(docs["456"]["type"], "item")
+
+    def test_save_many(self):
+        self.d.save({"_id":"123", "type":"item"})
+        existing = self.d.get("123")
+        existing["type"] = "changed"
+
+        response = self.d.save_many([existing, {"_id":"456", "type":"item"}])
+        assert_equals([success for (success, id, rev) in response], [True, True])
+        assert_equals(self.d.get("123")["type"], "changed")
+        assert_equals(self.d.get("456")["type"], "item")
@@ -0,0 +1,50 @@
+from nose.tools import assert_equals
+
+from totalimpact import stats
+
+
+class TestHistogram():
+    def test_record(self):
+        histogram = stats.Histogram()
+        for value in [0.002, 0.003, 0.2, 7]:
+            histogram.record(value)
+        snapshot = histogram.snapshot()
+        assert_equals(snapshot["count"], 4)
+        assert_equals(snapshot["max"], 7)
+        assert_equals(round(snapshot["mean"], 4), 1.8013)
+        assert_equals(snapshot["buckets"], {"<=0.005": 2, "<=0.5": 1, "<=10": 1})
+
+    def test_percentile(self):
+        histogram = stats.Histogram()
+        for i in range(99):
+            histogram.record(0.02)
+        histogram.record(400)
+        assert_equals(histogram.percentile(0.5), 0.05)
+        assert_equals(histogram.percentile(0.99), 0.05)
+        assert_equals(histogram.percentile(1), 400)  # past the last bound, so the max
+
+    def test_empty(self):
+        snapshot = stats.Histogram().snapshot()
+        assert_equals(snapshot["count"], 0)
+        assert_equals(snapshot["mean"], None)
+        assert_equals(snapshot["p95"], None)
+
+
+class TestStats():
+    def setUp(self):
+        self.stats = stats.Stats()
+
+    def test_snapshot(self):
+        self.stats.incr("provider:pubmed:metrics:errors")
+        self.stats.incr("provider:pubmed:metrics:errors", 2)
+        self.stats.set_gauge("queue:pubmed_queue:depth", 12)
+        self.stats.record("provider:pubmed:metrics:service", 0.3)
+        snapshot = self.stats.snapshot()
+        assert_equals(snapshot["counters"], {"provider:pubmed:metrics:errors": 3})
+        assert_equals(snapshot["gauges"], {"queue:pubmed_queue:depth": 12})
+        assert_equals(snapshot["histograms"]["provider:pubmed:metrics:service"]["count"], 1)
+
+    def test_reset(self):
+        self.stats.incr("a")
+        self.stats.reset()
+        assert_equals(self.stats.snapshot()["counters"], {})
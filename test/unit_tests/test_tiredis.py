@@ -32,10 +32,69 @@ class TestTiRedis():
         num_left = self.r.get_num_providers_left("abcd")
         assert_equals(11, num_left)
 
+    def test_add_to_alias_queue(self):
+        self.r.add_to_alias_queue("abcd", {"doi":["10.1"]})
+        assert_equals(self.r.rpop("aliasqueue"), '["abcd", {"doi": ["10.1"]}, []]')
+
+    def test_add_to_alias_queue_low_priority(self):
+        self.r.add_to_alias_queue("abcd", {"doi":["10.1"]}, priority=tiredis.LOW_PRIORITY)
+        assert_equals(self.r.llen("aliasqueue"), 0)
+        assert_equals(self.r.rpop("aliasqueue_low"), '["abcd", {"doi": ["10.1"]}, [], "low"]')
+
+    def test_backend_stats(self):
+        self.r.set_backend_stats("host:123", {"counters": {"a": 1}}, 60)
+        self.r.set_backend_stats("host:456", {"counters": {"a": 2}}, 60)
+        assert_equals(self.r.get_backend_stats(), 
+            {"host:123": {"counters": {"a": 1}}, "host:456": {"counters": {"a": 2}}})
+
+    def test_backend_stats_drops_stale_processes(self):
+        self.r.set_backend_stats("host:123", {"counters": {"a": 1}}, 60)
+        self.r.set_backend_stats("host:456", {"counters": {"a": 2}}, -1)
+        assert_equals(self.r.get_backend_stats(), {"host:123": {"counters": {"a": 1}}})
+        assert_equals(self.r.hkeys("backend_stats"), ["host:123"])
+
+    def test_claim_in_flight(self):
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "pubmed", 60), True)
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "pubmed", 60), False)
+        assert_equals(self.r.claim_in_flight("abcd", "biblio", "pubmed", 60), True)
+        assert self.r.ttl("in_flight:abcd:metrics:pubmed") <= 60
+
+        self.r.release_in_flight("abcd", "metrics", "pubmed")
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "pubmed", 60), True)
+
+    def test_claim_in_flight_by_priority(self):
+        # the low priority updater has it queued, but someone is waiting on the page
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "pubmed", 60, tiredis.LOW_PRIORITY), True)
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "pubmed", 60, tiredis.HIGH_PRIORITY), True)
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "pubmed", 60, tiredis.HIGH_PRIORITY), False)
+
+        # a high priority job in flight covers low priority requests too
+        self.r.release_in_flight("abcd", "metrics", "pubmed")
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "pubmed", 60, tiredis.HIGH_PRIORITY), True)
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "pubmed", 60, tiredis.LOW_PRIORITY), False)
+
+    def test_clear_in_flight(self):
+        self.r.claim_in_flight("abcd", "metrics", "pubmed", 60)
+        self.r.set_num_providers_left("abcd", 2)
+        self.r.clear_in_flight()
+        assert_equals(self.r.claim_in_flight("abcd", "metrics", "pubmed", 60), True)
+        assert_equals(self.r.get_num_providers_left("abcd"), 2)
+
     def test_get_num_providers_left_is_none(self):
         num_left = self.r.get_num_providers_left("notinthedatabase")
         assert_equals(None, num_left)
 
+    def test_decr_num_providers_left_once_per_provider(self):
+        self.r.set_num_providers_left("abcd", 2)
+        assert_equals(self.r.decr_num_providers_left("abcd", "myprovider"), 1)
+        # the same provider again, say a job that ran twice, doesn't count
+        assert_equals(self.r.decr_num_providers_left("abcd", "myprovider"), 1)
+        assert_equals(self.r.decr_num_providers_left("abcd", "otherprovider"), 0)
+
+        # until the next update starts
+        self.r.set_num_providers_left("abcd", 2)
+        assert_equals(self.r.decr_num_providers_left("abcd", "myprovider"), 1)
+
     def test_decr_num_providers_left(self):
         self.r.set_num_providers_left("abcd", 11)
         assert_equals("11", self.r.get("num_providers_left:abcd"))
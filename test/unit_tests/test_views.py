@@ -228,6 +228,14 @@ class TestProvider(ViewsTester):
             assert md["delicious"]['metrics']["bookmarks"]["description"]
 
 
+class TestStats(ViewsTester):
+
+        def test_stats(self):
+            self.r.set_backend_stats("host:123", {"counters": {"queue:pubmed_queue:pushed": 3}}, 60)
+            resp = self.client.get("/stats")
+            assert_equals(resp.status_code, 200)
+            assert_equals(json.loads(resp.data), {"host:123": {"counters": {"queue:pubmed_queue:pushed": 3}}})
+
 
 class TestItem(ViewsTester):
 
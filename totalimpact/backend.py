@@ -1,17 +1,103 @@
 #!/usr/bin/env python
 
-import os, time, json, logging, threading, Queue, copy, sys, datetime
-from collections import defaultdict
+import os
+# the gevent engine has to patch sockets and threads before anything opens or starts one
+if __name__ == "__main__" and os.getenv("BACKEND_ENGINE") == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+import time, json, logging, threading, Queue, sys, datetime, uuid, functools, zlib, socket
+from collections import defaultdict, OrderedDict, namedtuple
 
 from totalimpact import dao, tiredis, default_settings
+from totalimpact.stats import backend_stats
 from totalimpact import item as item_module
-from totalimpact.providers.provider import ProviderFactory, ProviderError
+from totalimpact import cache as cache_module
+from totalimpact.providers import provider as provider_module
+from totalimpact.providers.provider import ProviderFactory, ProviderError, ProviderRateLimitError
+from totalimpact.providers.provider import ProviderTimeout, ProviderServerError, ProviderHttpError
 
 logger = logging.getLogger('ti.backend')
 logger.setLevel(logging.DEBUG)
 
 thread_count = defaultdict(dict)
 
+
+class FrozenAliases(dict):
+    """ Read-only alias dict, with each namespace's ids in a tuple.
+
+    Backend.run hands the same alias dict to every provider queue, so freezing
+    it lets the in-process queues pass it along without copying.  It compares
+    equal to the ordinary dict it was made from, and copy.deepcopy (which
+    merge_alias_dicts uses) gives back an ordinary mutable dict.
+    """
+    __slots__ = ()
+
+    def __init__(self, aliases_dict=None):
+        frozen = {}
+        for (namespace, ids) in (aliases_dict or {}).iteritems():
+            if not isinstance(ids, basestring): # dates are strings, not lists of ids
+                ids = tuple(ids)
+            frozen[namespace] = ids
+        dict.__init__(self, frozen)
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenAliases can't be changed, thaw() a copy instead")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def thaw(self):
+        thawed = {}
+        for (namespace, ids) in self.iteritems():
+            if not isinstance(ids, basestring):
+                ids = list(ids)
+            thawed[namespace] = ids
+        return thawed
+
+    def __eq__(self, other):
+        return self.thaw() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self.thaw()
+
+    def __reduce__(self):
+        return (FrozenAliases, (self.thaw(),))
+
+
+def couch_shard(tiid, num_shards):
+    """ Which of num_shards couch queues handles writes for this tiid.
+
+    Every write for a tiid goes through the same queue, so they are 
+    serialized.  crc32 rather than hash() so every backend process sharing
+    redis queues routes a tiid the same way.
+    """
+    return (zlib.crc32(tiid.encode("utf-8")) & 0xffffffff) % num_shards
+
+
+# Queue messages.  They are tuples, so they can't be changed in flight, index 
+# like the plain tuples and lists older code pushed, and go to redis as json lists.
+class AliasMessage(namedtuple("AliasMessage", "tiid alias_dict aliases_providers_run priority")):
+    __slots__ = ()
+
+class ProviderMessage(namedtuple("ProviderMessage", "tiid alias_dict method_name aliases_providers_run priority")):
+    __slots__ = ()
+
+class CouchMessage(namedtuple("CouchMessage", "tiid new_content method_name")):
+    __slots__ = ()
+
+
+class ClaimedMessage(list):
+    """ A message popped from a ReliableRedisQueue.  It carries its own claim,
+    so acking it needs no lookup table that could leak or mix messages up """
+    __slots__ = ("claim",)
+
+
 class RedisQueue(object):
     def __init__(self, queue_name, myredis):
         self.queue_name = queue_name
@@ -19,41 +105,334 @@ class RedisQueue(object):
         self.name = queue_name + "_queue"
 
     def push(self, message):
-        message_json = json.dumps(message)
+        message_json = self.encode(message)
         #logger.info("{:20}: >>>PUSHING to redis {message_json}".format(
         #    self.name, message_json=message_json))        
         self.myredis.lpush(self.queue_name, message_json)
+        backend_stats.incr("queue:"+self.queue_name+":pushed")
 
-    def pop(self):
+    def encode(self, message):
+        # the envelope says when the message was queued, for the wait time stats
+        return json.dumps({"queued_at": time.time(), "message": message})
+
+    def decode(self, message_json):
+        message = json.loads(message_json)
+        # messages from tiredis.add_to_alias_queue, or from older backends, aren't in an envelope
+        if isinstance(message, dict) and "queued_at" in message:
+            backend_stats.record("queue:"+self.queue_name+":wait", max(0, time.time() - message["queued_at"]))
+            message = message["message"]
+        backend_stats.incr("queue:"+self.queue_name+":popped")
+        return message
+
+    def depth(self):
+        return self.myredis.llen(self.queue_name)
+
+    def pop(self, timeout=5):
         #blocking pop
         message = None
-        received = self.myredis.brpop([self.queue_name], timeout=5) #maybe timeout not necessary
+        if timeout >= 1:
+            received = self.myredis.brpop([self.queue_name], timeout=int(timeout)) #maybe timeout not necessary
+        else:
+            # brpop only takes whole seconds, and 0 means wait forever
+            message_json = self.myredis.rpop(self.queue_name)
+            received = (self.queue_name, message_json) if message_json else None
         if received:
             queue, message_json = received
             try:
-                message = json.loads(message_json) 
-                logger.info("{:20}: <<<POPPED from redis, {message}".format(
-                    self.name, message=message))        
+                message = self.decode(message_json)
+                logger.debug("%-20s: <<<POPPED from redis, %s", self.name, message_json)
             except TypeError, KeyError:
-                logger.info("{:20}: error processing redis message {message_json}".format(
-                    self.name, message_json=message_json))
+                logger.info("%-20s: error processing redis message %s", self.name, message_json)
         return message
 
+    def ack(self, message):
+        # plain redis pops are not tracked, so there is nothing to acknowledge
+        pass
+
+    def requeue(self, message):
+        """ Puts a popped message back at the end of the queue for someone else. 
+        Returns False if it couldn't, and the popper still has to handle it """
+        self.push(message)
+        self.ack(message)
+        return True
+
+    def requeue_expired(self):
+        return 0
+
+    def touch(self, message):
+        """ Restarts the visibility timeout of a popped message.  Returns False if it
+        ran out already and the message has gone to someone else """
+        return True
+
+
+class ReliableRedisQueue(RedisQueue):
+    """ Redis queue where popped messages are kept until they are acked.
+
+    pop moves the message onto a processing list and records a claim in a
+    sorted set scored by when its visibility timeout runs out.  The popped
+    message is a ClaimedMessage holding the claim, and ack removes both.  requeue_expired puts messages whose claims have run out (because
+    the process handling them died, or is stuck) back on the queue, so any
+    backend process sharing this redis can pick them up.
+    """
+    claim_token_length = 32
+
+    def __init__(self, queue_name, myredis, visibility_timeout=60*5):
+        super(ReliableRedisQueue, self).__init__(queue_name, myredis)
+        self.processing_name = queue_name + "_processing"
+        self.claims_name = queue_name + "_claims"
+        self.visibility_timeout = visibility_timeout
+
+    def pop(self, timeout=5):
+        message = None
+        if timeout >= 1:
+            message_json = self.myredis.brpoplpush(self.queue_name, self.processing_name, timeout=int(timeout))
+        else:
+            message_json = self.myredis.rpoplpush(self.queue_name, self.processing_name)
+        if message_json:
+            # the token keeps claims on identical messages apart
+            claim = uuid.uuid4().hex + message_json
+            self.myredis.zadd(self.claims_name, **{claim: time.time() + self.visibility_timeout})
+            try:
+                message = ClaimedMessage(self.decode(message_json))
+                message.claim = claim
+            except (ValueError, TypeError):
+                logger.info("%-20s: error processing redis message %s", self.name, message_json)
+                self._remove_claim(claim)
+                message = None
+        return message
+
+    def _remove_claim(self, claim):
+        pipe = self.myredis.pipeline()
+        pipe.lrem(self.processing_name, claim[self.claim_token_length:], 1)
+        pipe.zrem(self.claims_name, claim)
+        pipe.execute()
+
+    def ack(self, message):
+        claim = getattr(message, "claim", None)
+        if claim:
+            self._remove_claim(claim)
+            message.claim = None
+
+    def touch(self, message):
+        claim = getattr(message, "claim", None)
+        if not claim:
+            return True
+        # XX only updates a claim that is still there, CH says whether it did.  Needs redis 3.0.2
+        return bool(self.myredis.execute_command("ZADD", self.claims_name, "XX", "CH", 
+            repr(time.time() + self.visibility_timeout), claim))
+
+    def requeue_expired(self):
+        num_requeued = 0
+        for claim in self.myredis.zrangebyscore(self.claims_name, 0, time.time()):
+            # only the process that manages to remove the claim requeues the message
+            if self.myredis.zrem(self.claims_name, claim):
+                message_json = claim[self.claim_token_length:]
+                pipe = self.myredis.pipeline()
+                pipe.lrem(self.processing_name, message_json, 1)
+                pipe.rpush(self.queue_name, message_json)  # rpush so it is the next one popped
+                pipe.execute()
+                num_requeued += 1
+        if num_requeued:
+            backend_stats.incr("queue:"+self.queue_name+":requeued", num_requeued)
+            logger.warning("{:20}: requeued {num} messages that were never acked".format(
+                self.name, num=num_requeued))
+        return num_requeued
+
+
+class RedisSemaphore(object):
+    """ Counting semaphore shared by every process using the same redis.
+
+    Holders are ranked by a counter rather than by time, so two processes
+    acquiring in the same instant can't both see themselves under the
+    limit.  Acquisition times live in a second sorted set, and a holder
+    that hasn't released after lease_timeout seconds is dropped, so a
+    crashed process can't keep its slots forever.
+    """
+    def __init__(self, name, myredis, limit, lease_timeout=60*5):
+        self.name = "semaphore:" + name
+        self.timestamps_name = self.name + ":timestamps"
+        self.counter_name = self.name + ":counter"
+        self.myredis = myredis
+        self.limit = limit
+        self.lease_timeout = lease_timeout
+
+    def try_acquire(self):
+        token = uuid.uuid4().hex
+        now = time.time()
+        pipe = self.myredis.pipeline()
+        pipe.zremrangebyscore(self.timestamps_name, "-inf", repr(now - self.lease_timeout))
+        # drop expired holders from the ranked set too
+        pipe.zinterstore(self.name, {self.name:1, self.timestamps_name:0})
+        pipe.incr(self.counter_name)
+        counter = pipe.execute()[-1]
+
+        pipe = self.myredis.pipeline()
+        pipe.zadd(self.timestamps_name, **{token: repr(now)})
+        pipe.zadd(self.name, **{token: counter})
+        pipe.zrank(self.name, token)
+        rank = pipe.execute()[-1]
+        if rank < self.limit:
+            return token
+        self.release(token)
+        return None
+
+    def acquire(self, polling_interval=0.1, max_polling_interval=2):
+        token = self.try_acquire()
+        while not token:
+            time.sleep(polling_interval)
+            # back off, so processes waiting on a busy provider don't flood redis
+            polling_interval = min(max_polling_interval, polling_interval * 2)
+            token = self.try_acquire()
+        return token
+
+    def release(self, token):
+        pipe = self.myredis.pipeline()
+        pipe.zrem(self.name, token)
+        pipe.zrem(self.timestamps_name, token)
+        pipe.execute()
+
+
+class AdaptiveLimiter(object):
+    """ Concurrency limit for one provider that follows how the provider is coping.
+
+    Additive increase, multiplicative decrease: each call that comes back
+    fine raises the limit by 1/limit, so about one more slot per round of
+    calls.  A timeout, a server error, or a call that is both slow_floor
+    seconds long and latency_tolerance times the provider's usual latency
+    cuts the limit by backoff_factor.  Cuts happen at most once per
+    cooldown, so one burst of failures only counts once.
+    """
+    def __init__(self, name, initial_limit, min_limit=1, max_limit=50, backoff_factor=0.5, 
+            latency_tolerance=3, slow_floor=2, cooldown=5):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.slow_floor = slow_floor
+        self.cooldown = cooldown
+        self.in_use = 0
+        self.usual_latency = None  # moving average of calls that didn't fail
+        self.last_backoff = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_use >= int(self.limit):
+                self.condition.wait()
+            self.in_use += 1
+
+    def release(self):
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+
+    def record(self, latency, overloaded=False):
+        with self.condition:
+            too_slow = (self.usual_latency is not None) and (latency > self.slow_floor) and \
+                (latency > self.latency_tolerance * self.usual_latency)
+            if not overloaded:
+                if self.usual_latency is None:
+                    self.usual_latency = latency
+                else:
+                    self.usual_latency = 0.9*self.usual_latency + 0.1*latency
+
+            if overloaded or too_slow:
+                now = time.time()
+                if now - self.last_backoff >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+                    self.last_backoff = now
+                    logger.info("%-20s: backing off to %i simultaneous requests", self.name, int(self.limit))
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0/self.limit)
+                self.condition.notify_all()
+            backend_stats.set_gauge("provider:"+self.name+":concurrency_limit", int(self.limit))
+
+
+class CircuitBreaker(object):
+    """ Stops calls to a provider that keeps timing out or erroring.
+
+    After failure_threshold failures in a row the circuit opens and allow()
+    says no, so callers fail fast.  After reset_timeout one call is let
+    through as a probe (half open): if it succeeds the circuit closes, if
+    it fails the circuit opens again.  A probe that never reports back is
+    replaced by another after reset_timeout.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.time()
+            if now - self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+                self.opened_at = now  # no other probe until this one has had its chance
+                return True
+            return False
+
+    def record(self, failed):
+        with self.lock:
+            if not failed:
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    logger.info("%-20s: circuit closed, provider is back", self.name)
+                    self._set_state(self.CLOSED)
+                return
+            self.failures += 1
+            if (self.state == self.HALF_OPEN) or (self.failures >= self.failure_threshold):
+                if self.state == self.CLOSED:
+                    logger.warning("%-20s: circuit open after %i failures in a row", self.name, self.failures)
+                    backend_stats.incr("provider:"+self.name+":circuit_opened")
+                self._set_state(self.OPEN)
+                self.opened_at = time.time()
+
+    def _set_state(self, state):
+        self.state = state
+        backend_stats.set_gauge("provider:"+self.name+":circuit", state)
+
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(provider_name):
+    with circuit_breakers_lock:
+        if provider_name not in circuit_breakers:
+            circuit_breakers[provider_name] = CircuitBreaker(provider_name)
+        return circuit_breakers[provider_name]
+
 
 class PythonQueue(object):
-    def __init__(self, queue_name):
+    def __init__(self, queue_name, maxsize=0):
         self.queue_name = queue_name
-        self.queue = Queue.Queue()
+        self.queue = Queue.Queue(maxsize)  # 0 means unbounded; bounded queues block on push when full
 
+    # messages are handed over as they are, not copied, so pushers must not
+    # change them afterwards.  Messages built by the backend are immutable.
     def push(self, message):
-        self.queue.put(copy.deepcopy(message))
+        self.queue.put((time.time(), message))
+        backend_stats.incr("queue:"+self.queue_name+":pushed")
         #logger.info("{:20}: >>>PUSHED".format(
         #        self.queue_name))
 
-    def pop(self):
+    def pop(self, timeout=5):
         try:
             # blocking pop
-            message = copy.deepcopy(self.queue.get(block=True, timeout=5)) #maybe timeout isn't necessary
+            (queued_at, message) = self.queue.get(block=True, timeout=timeout) #maybe timeout isn't necessary
+            backend_stats.record("queue:"+self.queue_name+":wait", time.time() - queued_at)
+            backend_stats.incr("queue:"+self.queue_name+":popped")
             self.queue.task_done()
             #logger.info("{:20}: <<<POPPED".format(
             #    self.queue_name))
@@ -61,18 +440,200 @@ class PythonQueue(object):
             message = None
         return message
 
+    def ack(self, message):
+        pass
+
+    def requeue(self, message):
+        # never blocks, so it can't deadlock pool threads that are the queue's only consumers
+        try:
+            self.queue.put((time.time(), message), block=False)
+        except Queue.Full:
+            return False
+        return True
+
+    def requeue_expired(self):
+        return 0
+
+    def touch(self, message):
+        return True
+
+    def depth(self):
+        return self.queue.qsize()
+
+
+class WeightedFairQueue(object):
+    """ One queue per priority class, dequeued by smooth weighted round robin.
+
+    A message's priority is read from position priority_index in the message;
+    messages too short to have one go in the default lane.  With weights of 
+    4 and 1, high priority messages get four pops for every low priority one
+    when both lanes have work, and either lane gets all the pops when the other
+    is empty.
+    """
+    def __init__(self, queue_name, lanes, weights, priority_index, default_priority=tiredis.HIGH_PRIORITY):
+        self.queue_name = queue_name
+        self.lanes = lanes  # priority -> queue
+        self.weights = weights
+        self.priority_index = priority_index
+        self.default_priority = default_priority
+        self.credits = dict((priority, 0) for priority in lanes)
+        self.lock = threading.Lock()
+
+    def priority_of(self, message):
+        try:
+            priority = message[self.priority_index]
+        except IndexError:
+            priority = self.default_priority
+        if priority not in self.lanes:
+            priority = self.default_priority
+        return priority
+
+    def push(self, message):
+        self.lanes[self.priority_of(message)].push(message)
+
+    def _lanes_in_turn_order(self):
+        with self.lock:
+            return sorted(self.lanes, key=lambda priority: self.credits[priority] + self.weights[priority], reverse=True)
+
+    def _charge(self, served_priority):
+        with self.lock:
+            for priority in self.credits:
+                self.credits[priority] += self.weights[priority]
+            self.credits[served_priority] -= sum(self.weights.values())
+
+    def pop(self, timeout=5):
+        for priority in self._lanes_in_turn_order():
+            message = self.lanes[priority].pop(timeout=0)
+            if message:
+                self._charge(priority)
+                return message
+
+        # nothing waiting anywhere, so block on the busiest lane for a bit
+        priority = max(self.weights, key=self.weights.get)
+        message = self.lanes[priority].pop(timeout=min(timeout, 1))
+        if message:
+            self._charge(priority)
+        return message
+
+    def ack(self, message):
+        self.lanes[self.priority_of(message)].ack(message)
+
+    def requeue(self, message):
+        return self.lanes[self.priority_of(message)].requeue(message)
+
+    def touch(self, message):
+        return self.lanes[self.priority_of(message)].touch(message)
+
+    def requeue_expired(self):
+        return sum([lane.requeue_expired() for lane in self.lanes.values()])
+
+    def depth(self):
+        return sum([lane.depth() for lane in self.lanes.values()])
+
 
 class Worker(object):
+    error_backoff = 1  # seconds to wait after run raises, before trying again
+
     def run_in_loop(self):
         while True:
-            self.run()
+            try:
+                self.run()
+            except Exception:
+                # a redis or couch hiccup shouldn't take the thread down for good
+                logger.exception("{:20}: unexpected error, backing off".format(self.name))
+                time.sleep(self.error_backoff)
 
     def spawn_and_loop(self):
         t = threading.Thread(target=self.run_in_loop, name=self.name+"_thread")
         t.daemon = True
         t.start()    
 
+
+class BufferedQueue(Worker):
+    """ Lets a pool of workers share one popper on a redis queue.
+
+    A pool member blocking in its own brpoplpush holds a redis connection
+    the whole time, so a pool per provider would need thousands of them
+    under gevent.  Instead one thread pops and hands each message over
+    through a small local queue.  Everything else goes straight to the
+    redis queue.
+    """
+    def __init__(self, queue, maxsize=1):
+        self.queue = queue
+        self.queue_name = queue.queue_name
+        self.name = queue.queue_name + "_buffer"
+        # kept small, so few messages sit here claimed but not being worked on
+        self.buffer = Queue.Queue(maxsize)
+
+    def run(self):
+        message = self.queue.pop()
+        if message:
+            self.buffer.put(message)  # waits until a pool member is free to take it
+
+    def push(self, message):
+        self.queue.push(message)
+
+    def pop(self, timeout=5):
+        try:
+            return self.buffer.get(block=True, timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def ack(self, message):
+        self.queue.ack(message)
+
+    def requeue(self, message):
+        return self.queue.requeue(message)
+
+    def requeue_expired(self):
+        return self.queue.requeue_expired()
+
+    def touch(self, message):
+        return self.queue.touch(message)
+
+    def depth(self):
+        return self.queue.depth() + self.buffer.qsize()
+
+
+class QueueReaper(Worker):
+    """ Puts messages back on reliable queues when their visibility timeout runs out """
+    def __init__(self, queues, interval=30):
+        self.queues = queues
+        self.interval = interval
+        self.name = "queue_reaper"
+
+    def run(self):
+        for queue in self.queues:
+            queue.requeue_expired()
+        time.sleep(self.interval)
+
+class StatsDumper(Worker):
+    """ Every interval, logs this process's pipeline stats and puts them in
+    redis, where the /stats endpoint picks them up. """
+    def __init__(self, queues, myredis, interval=60):
+        self.queues = queues
+        self.myredis = myredis
+        self.interval = interval
+        self.name = "stats_dumper"
+        self.process_name = "{host}:{pid}".format(host=socket.gethostname(), pid=os.getpid())
+
+    def run(self):
+        for queue in self.queues:
+            backend_stats.set_gauge("queue:"+queue.queue_name+":depth", queue.depth())
+        http_session_stats = provider_module.get_http_session_stats()
+        for counter in ["requests", "connections", "reused"]:
+            backend_stats.set_gauge("http:"+counter, http_session_stats[counter])
+        snapshot = backend_stats.snapshot()
+        logger.info("backend stats %s", json.dumps(snapshot, sort_keys=True))
+        # stats from a process that has stopped dumping expire after a few intervals
+        self.myredis.set_backend_stats(self.process_name, snapshot, max(self.interval*3, 60))
+        time.sleep(self.interval)
+
+
 class ProviderWorker(Worker):
+    # seconds before a message that ran into the provider's rate limit is tried again
+    rate_limit_retry_delay = 10
+
     def __init__(self, provider, polling_interval, alias_queue, provider_queue, couch_queues, wrapper, myredis):
         self.provider = provider
         self.provider_name = provider.provider_name
@@ -86,27 +647,99 @@ class ProviderWorker(Worker):
 
     # last variable is an artifact so it has same call signature as other callbacks
     def add_to_couch_queue_if_nonzero(self, tiid, new_content, method_name, dummy=None):
+        if method_name != "metrics":
+            # metrics stay in flight until the couch worker has counted them off in num_providers_left
+            self.myredis.release_in_flight(tiid, method_name, self.provider_name)
         if not new_content:
             #logger.info("{:20}: Not writing to couch: empty {method_name} from {tiid} for {provider_name}".format(
             #    "provider_worker", method_name=method_name, tiid=tiid, provider_name=self.provider_name))     
             if method_name=="metrics":
-                self.myredis.decr_num_providers_left(tiid, "(unknown)")
+                self.myredis.decr_num_providers_left(tiid, self.provider_name)
+                self.myredis.release_in_flight(tiid, method_name, self.provider_name)
             return
         else:
-            logger.info("Adding to couch queue {method_name} from {tiid} for {provider_name}".format(
-                method_name=method_name, tiid=tiid, provider_name=self.provider_name))     
-            couch_message = (tiid, new_content, method_name)
-            couch_queue_index = tiid[0] #index them by the first letter in the tiid
+            logger.debug("Adding to couch queue %s from %s for %s", method_name, tiid, self.provider_name)
+            couch_message = CouchMessage(tiid, new_content, method_name)
+            couch_queue_index = couch_shard(tiid, len(self.couch_queues))
             selected_couch_queue = self.couch_queues[couch_queue_index] 
             selected_couch_queue.push(couch_message)
 
-    def add_to_alias_and_couch_queues(self, tiid, alias_dict, method_name, aliases_providers_run):
+    def add_to_alias_and_couch_queues(self, tiid, alias_dict, method_name, aliases_providers_run, 
+            priority=tiredis.HIGH_PRIORITY):
         self.add_to_couch_queue_if_nonzero(tiid, alias_dict, method_name)
-        alias_message = [tiid, alias_dict, aliases_providers_run]
+        alias_message = AliasMessage(tiid, alias_dict, aliases_providers_run, priority)
         self.alias_queue.push(alias_message)
 
+    def unclaim(self, tiid, method_name):
+        """ For a job that ended without its callback being called, does what the
+        callback would have: counts metrics off and releases the in-flight claim """
+        if method_name == "metrics":
+            self.myredis.decr_num_providers_left(tiid, self.provider_name)
+        self.myredis.release_in_flight(tiid, method_name, self.provider_name)
+
+    def answer_with_nothing(self, tiid, alias_dict, method_name, aliases_providers_run, callback):
+        """ For a job whose provider call died unexpectedly: answers as if the provider had 
+        found nothing, so an item waiting on its aliases still goes on to biblio and metrics """
+        try:
+            self.respond(tiid, alias_dict, self.provider_name, method_name, None, aliases_providers_run, callback)
+        except Exception:
+            logger.exception("{:20}: couldn't answer {tiid} {method_name}".format(
+                self.name, tiid=tiid, method_name=method_name.upper()))
+            self.unclaim(tiid, method_name)
+
+    def retry_later(self, provider_message, delay=None):
+        """ Puts the message back on the provider queue after delay seconds.  It isn't
+        acked until then, so a reliable queue still has it if this process dies first """
+        if delay is None:
+            delay = self.rate_limit_retry_delay
+        def requeue():
+            self.provider_queue.push(provider_message)
+            self.provider_queue.ack(provider_message)
+        timer = threading.Timer(delay, requeue)
+        timer.daemon = True
+        timer.start()
+        backend_stats.incr("provider:"+self.provider_name+":retried")
+
+    def call_wrapper(self, tiid, alias_dict, method_name, aliases_providers_run, callback, **wrapper_options):
+        # the wrapper answers through the callback or retries, unless something unexpected raises first
+        answered = []
+        def answer(*args):
+            answered.append(True)
+            return callback(*args)
+        retry = wrapper_options.get("retry")
+        if retry:
+            def retry_instead():
+                answered.append(True)
+                return retry()
+            wrapper_options["retry"] = retry_instead
+        try:
+            return self.wrapper(tiid, alias_dict, self.provider, method_name, aliases_providers_run, answer, 
+                **wrapper_options)
+        finally:
+            if not answered:
+                self.answer_with_nothing(tiid, alias_dict, method_name, aliases_providers_run, callback)
+
+    def callback_for(self, method_name, priority=tiredis.HIGH_PRIORITY):
+        if method_name == "aliases":
+            # the item goes back through the alias queue in the same priority class
+            return functools.partial(self.add_to_alias_and_couch_queues, priority=priority)
+        return self.add_to_couch_queue_if_nonzero
+
+    @classmethod
+    def unpack_provider_message(cls, provider_message):
+        # provider messages from before priority classes don't have a priority
+        (tiid, alias_dict, method_name, aliases_providers_run) = provider_message[0:4]
+        try:
+            priority = provider_message[4]
+        except IndexError:
+            priority = tiredis.HIGH_PRIORITY
+        return (tiid, alias_dict, method_name, aliases_providers_run, priority)
+
     @classmethod
-    def wrapper(cls, tiid, input_aliases_dict, provider, method_name, aliases_providers_run, callback):
+    def wrapper(cls, tiid, input_aliases_dict, provider, method_name, aliases_providers_run, callback, 
+            limiter=None, retry=None):
+        """ Calls the provider and answers through callback.  If the call runs into the 
+        rate limit and there is a retry function, that is called instead, to try again later """
         #logger.info("{:20}: **Starting {tiid} {provider_name} {method_name} with {aliases}".format(
         #    "wrapper", tiid=tiid, provider_name=provider.provider_name, method_name=method_name, aliases=aliases))
 
@@ -116,16 +749,63 @@ class ProviderWorker(Worker):
         input_alias_tuples = item_module.alias_tuples_from_dict(input_aliases_dict)
         method = getattr(provider, method_name)
 
-        try:
-            method_response = method(input_alias_tuples)
-        except ProviderError:
+        stats_name = "provider:"+provider_name+":"+method_name
+        circuit_breaker = get_circuit_breaker(provider_name)
+        rate_limited = False
+        if not circuit_breaker.allow():
+            # the provider is down, so answer right away instead of tying up a thread on a timeout
             method_response = None
-            logger.info("{:20}: **ProviderError {tiid} {method_name} {provider_name} ".format(
+            backend_stats.incr(stats_name+":short_circuited")
+            logger.info("{:20}: **circuit open, skipping {tiid} {method_name} {provider_name} ".format(
                 worker_name, tiid=tiid, provider_name=provider_name.upper(), method_name=method_name.upper()))
+        else:
+            started = time.time()
+            overloaded = False
+            upstream_failed = False
+            try:
+                method_response = method(input_alias_tuples)
+            except ProviderRateLimitError:
+                method_response = None
+                overloaded = True
+                rate_limited = True
+                backend_stats.incr(stats_name+":rate_limited")
+                logger.info("{:20}: **ProviderRateLimitError {tiid} {method_name} {provider_name} ".format(
+                    worker_name, tiid=tiid, provider_name=provider_name.upper(), method_name=method_name.upper()))
+            except ProviderError, e:
+                method_response = None
+                upstream_failed = isinstance(e, (ProviderTimeout, ProviderServerError, ProviderHttpError))
+                overloaded = upstream_failed
+                backend_stats.incr(stats_name+":errors")
+                logger.info("{:20}: **ProviderError {tiid} {method_name} {provider_name} ".format(
+                    worker_name, tiid=tiid, provider_name=provider_name.upper(), method_name=method_name.upper()))
+            finally:
+                backend_stats.record(stats_name+":service", time.time() - started)
+            circuit_breaker.record(upstream_failed)
+            if limiter:
+                limiter.record(time.time() - started, overloaded)
+
+        if rate_limited and retry:
+            retry()
+            response = None
+        else:
+            response = cls.respond(tiid, input_aliases_dict, provider_name, method_name, method_response, 
+                aliases_providers_run, callback)
 
+        try:
+            del thread_count[provider_name][tiid+method_name]
+        except KeyError:  # thread isn't there when we call wrapper in unit tests
+            pass
+
+        return response
+
+    @classmethod
+    def respond(cls, tiid, input_aliases_dict, provider_name, method_name, method_response, 
+            aliases_providers_run, callback):
+        """ Hands the provider's answer for one item to the callback """
         if method_name == "aliases":
             # update aliases to include the old ones too
-            aliases_providers_run += [provider_name]
+            # a new list, because the one in the message is shared with the other providers
+            aliases_providers_run = list(aliases_providers_run) + [provider_name]
             if method_response:
                 new_aliases_dict = item_module.alias_dict_from_tuples(method_response)
                 new_canonical_aliases_dict = item_module.canonical_aliases(new_aliases_dict)
@@ -135,18 +815,77 @@ class ProviderWorker(Worker):
         else:
             response = method_response
 
-        logger.info("{:20}: RETURNED {tiid} {method_name} {provider_name} : {response}".format(
-            worker_name, tiid=tiid, method_name=method_name.upper(), 
-            provider_name=provider_name.upper(), response=response))
+        logger.debug("%-20s: RETURNED %s %s %s : %s", 
+            provider_name+"_worker", tiid, method_name.upper(), provider_name.upper(), response)
 
         callback(tiid, response, method_name, aliases_providers_run)
+        return response
 
-        try:
-            del thread_count[provider_name][tiid+method_name]
-        except KeyError:  # thread isn't there when we call wrapper in unit tests
-            pass
+    @classmethod
+    def batch_wrapper(cls, provider_messages, provider, method_name, callbacks, limiter=None, retries=None):
+        """ Like wrapper, for unpacked messages that all want the same method and are 
+        answered by one call to its batch version.  callbacks, and retries if given, 
+        have one function per message """
+        provider_name = provider.provider_name
+        worker_name = provider_name+"_worker"
+        tiids = [provider_message[0] for provider_message in provider_messages]
+        list_of_alias_tuples = [item_module.alias_tuples_from_dict(provider_message[1]) 
+            for provider_message in provider_messages]
+        method = getattr(provider, method_name+"_batch")
 
-        return response
+        stats_name = "provider:"+provider_name+":"+method_name
+        circuit_breaker = get_circuit_breaker(provider_name)
+        if not circuit_breaker.allow():
+            method_responses = [None] * len(provider_messages)
+            rate_limited = [False] * len(provider_messages)
+            backend_stats.incr(stats_name+":short_circuited", len(provider_messages))
+            logger.info("{:20}: **circuit open, skipping batch of {num} {method_name} {provider_name} ".format(
+                worker_name, num=len(provider_messages), provider_name=provider_name.upper(), 
+                method_name=method_name.upper()))
+        else:
+            started = time.time()
+            overloaded = False
+            upstream_failed = False
+            try:
+                method_responses = method(list_of_alias_tuples)
+            except ProviderError, e:
+                # the whole batch failed
+                method_responses = [e] * len(provider_messages)
+            finally:
+                backend_stats.record(stats_name+"_batch:service", time.time() - started)
+
+            # errors come back in place of the items they happened to
+            rate_limited = [isinstance(method_response, ProviderRateLimitError) for method_response in method_responses]
+            for (i, method_response) in enumerate(method_responses):
+                if isinstance(method_response, ProviderRateLimitError):
+                    overloaded = True
+                    backend_stats.incr(stats_name+":rate_limited")
+                elif isinstance(method_response, ProviderError):
+                    if isinstance(method_response, (ProviderTimeout, ProviderServerError, ProviderHttpError)):
+                        upstream_failed = True
+                        overloaded = True
+                    backend_stats.incr(stats_name+":errors")
+                    logger.info("{:20}: **ProviderError {tiid} {method_name} {provider_name} ".format(
+                        worker_name, tiid=tiids[i], provider_name=provider_name.upper(), 
+                        method_name=method_name.upper()))
+                else:
+                    continue
+                method_responses[i] = None
+            circuit_breaker.record(upstream_failed)
+            if limiter:
+                limiter.record(time.time() - started, overloaded)
+        backend_stats.incr(stats_name+"_batch:items", len(provider_messages))
+
+        responses = []
+        for (i, provider_message) in enumerate(provider_messages):
+            (tiid, alias_dict, message_method_name, aliases_providers_run, priority) = provider_message
+            if rate_limited[i] and retries:
+                retries[i]()
+                responses.append(None)
+                continue
+            responses.append(cls.respond(tiid, alias_dict, provider_name, method_name, method_responses[i], 
+                aliases_providers_run, callbacks[i]))
+        return responses
 
     def run(self):
         num_active_threads_for_this_provider = len(thread_count[self.provider.provider_name])
@@ -161,11 +900,8 @@ class ProviderWorker(Worker):
         if provider_message:
             #logger.info("POPPED from queue for {provider}".format(
             #    provider=self.provider_name))
-            (tiid, alias_dict, method_name, aliases_providers_run) = provider_message
-            if method_name == "aliases":
-                callback = self.add_to_alias_and_couch_queues
-            else:
-                callback = self.add_to_couch_queue_if_nonzero
+            (tiid, alias_dict, method_name, aliases_providers_run, priority) = self.unpack_provider_message(provider_message)
+            callback = self.callback_for(method_name, priority)
 
             #logger.info("BEFORE STARTING thread for {tiid} {method_name} {provider}".format(
             #    method_name=method_name.upper(), tiid=tiid, num=len(thread_count[self.provider.provider_name].keys()),
@@ -178,13 +914,203 @@ class ProviderWorker(Worker):
                 num_total=threading.active_count(),
                 provider=self.provider.provider_name.upper()))
 
-            t = threading.Thread(target=ProviderWorker.wrapper, 
-                args=(tiid, alias_dict, self.provider, method_name, aliases_providers_run, callback), 
+            t = threading.Thread(target=self.call_wrapper, 
+                args=(tiid, alias_dict, method_name, aliases_providers_run, callback), 
+                kwargs={"retry": functools.partial(self.retry_later, provider_message)},
                 name=self.provider_name+"-"+method_name.upper()+"-"+tiid[0:4])
             t.start()
             return
 
 
+class PooledProviderWorker(ProviderWorker):
+    """ Runs a fixed pool of long-lived threads for one provider.
+
+    Each pool thread blocks on the provider queue and calls the wrapper
+    itself, so the number of threads stays at max_simultaneous_requests no
+    matter how deep the queue gets, and there is no polling loop.  With an
+    AdaptiveLimiter the pool is as big as the limiter's maximum, and the
+    limiter decides how many of the threads can call the provider at once.
+
+    For methods where the provider has a batch size over 1 (see
+    Provider.get_batch_size), a thread that pops a message for the method
+    keeps popping for up to batch_window seconds and hands all the messages
+    for that method to one call of its batch version.
+    """
+    def __init__(self, provider, polling_interval, alias_queue, provider_queue, couch_queues, wrapper, myredis, 
+            semaphore=None, limiter=None, batch_window=0.5):
+        super(PooledProviderWorker, self).__init__(
+            provider, polling_interval, alias_queue, provider_queue, couch_queues, wrapper, myredis)
+        self.pool_size = provider.max_simultaneous_requests
+        # when several processes share the queues, a RedisSemaphore caps the provider's total concurrency
+        self.semaphore = semaphore
+        self.limiter = limiter
+        if limiter:
+            self.pool_size = limiter.max_limit
+        self.batch_window = batch_window
+
+    def spawn_and_loop(self):
+        for i in range(self.pool_size):
+            t = threading.Thread(target=self.run_in_loop, name="{name}_{i}_thread".format(
+                name=self.name, i=i))
+            t.daemon = True
+            t.start()
+        logger.info("launched {pool_size} pooled threads for {provider}".format(
+            pool_size=self.pool_size, provider=self.provider_name.upper()))
+
+    def run(self):
+        # pop before taking a slot, so threads waiting on an empty queue
+        # don't hold slots that other processes could be using
+        provider_message = self.provider_queue.pop()
+        if not provider_message:
+            return
+        token = None
+        if self.limiter:
+            self.limiter.acquire()
+        try:
+            if self.semaphore:
+                token = self.semaphore.acquire()
+            # the wait for a slot counts against the visibility timeout, so start it again
+            if not self.provider_queue.touch(provider_message):
+                logger.info("{:20}: waited so long for a slot that the message was requeued, dropping it".format(
+                    self.name))
+                backend_stats.incr("provider:"+self.provider_name+":expired_while_waiting")
+                return
+            self.run_one(provider_message)
+        except Exception:
+            if self.semaphore and not token:
+                # never got a slot, so give the message back rather than drop it
+                self.provider_queue.requeue(provider_message)
+            raise
+        finally:
+            if token:
+                self.semaphore.release(token)
+            if self.limiter:
+                self.limiter.release()
+
+    def pop_batch(self, first_message):
+        """ Pops until there is a full batch of messages for the first message's method,
+        batch_window has passed, or the queue has nothing more for the method.
+
+        Messages for other methods go straight back on the queue, for the other pool 
+        threads to run in parallel.  Returns the batch, and any other messages that
+        couldn't go back because the queue was full, to be run after it """
+        method_name = self.unpack_provider_message(first_message)[2]
+        batch_size = self.provider.get_batch_size(method_name)
+        batch_messages = [first_message]
+        requeued_messages = []
+        other_messages = []
+        deadline = time.time() + self.batch_window
+        while len(batch_messages) < batch_size:
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                break
+            provider_message = self.provider_queue.pop(timeout=time_left)
+            if not provider_message:
+                break
+            if not self.provider_queue.touch(provider_message):
+                continue  # sat in the buffer so long that it was requeued
+            if self.unpack_provider_message(provider_message)[2] == method_name:
+                batch_messages.append(provider_message)
+                continue
+            # popping one we put back means we've been all the way round the queue
+            seen_before = provider_message in requeued_messages
+            if self.provider_queue.requeue(provider_message):
+                requeued_messages.append(provider_message)
+            else:
+                other_messages.append(provider_message)
+            if seen_before:
+                break
+        return (batch_messages, other_messages)
+
+    def run_one(self, provider_message):
+        method_name = self.unpack_provider_message(provider_message)[2]
+        if self.provider.get_batch_size(method_name) > 1:
+            (batch_messages, other_messages) = self.pop_batch(provider_message)
+            self.run_batch(batch_messages)
+        else:
+            other_messages = [provider_message]
+        for provider_message in other_messages:
+            self.run_message(provider_message)
+
+    def run_message(self, provider_message):
+        (tiid, alias_dict, method_name, aliases_providers_run, priority) = self.unpack_provider_message(provider_message)
+        callback = self.callback_for(method_name, priority)
+        retried = []
+        def retry():
+            retried.append(True)
+            self.retry_later(provider_message)
+        try:
+            self.call_wrapper(tiid, alias_dict, method_name, aliases_providers_run, callback, 
+                limiter=self.limiter, retry=retry)
+        except Exception:
+            # don't let one bad message take a pool thread down with it
+            logger.exception("{:20}: unexpected error on {tiid} {method_name}".format(
+                self.name, tiid=tiid, method_name=method_name.upper()))
+        if not retried:
+            # a retried message is acked when it goes back on the queue
+            self.provider_queue.ack(provider_message)
+
+    def run_batch(self, provider_messages):
+        unpacked_messages = [self.unpack_provider_message(provider_message) for provider_message in provider_messages]
+        method_name = unpacked_messages[0][2]
+        answered_tiids = []
+        def answer_with(callback):
+            def answer(tiid, *args):
+                answered_tiids.append(tiid)
+                return callback(tiid, *args)
+            return answer
+        callbacks = [answer_with(self.callback_for(method_name, unpacked_message[4])) 
+            for unpacked_message in unpacked_messages]
+        retried_indexes = []
+        def retry_with(i):
+            def retry():
+                retried_indexes.append(i)
+                self.retry_later(provider_messages[i])
+            return retry
+        retries = [retry_with(i) for i in range(len(provider_messages))]
+        try:
+            self.batch_wrapper(unpacked_messages, self.provider, method_name, callbacks, 
+                limiter=self.limiter, retries=retries)
+        except Exception:
+            logger.exception("{:20}: unexpected error on batch of {num} {method_name}".format(
+                self.name, num=len(provider_messages), method_name=method_name.upper()))
+        finally:
+            for (i, unpacked_message) in enumerate(unpacked_messages):
+                if i in retried_indexes:
+                    continue
+                (tiid, alias_dict, message_method_name, aliases_providers_run, priority) = unpacked_message
+                if tiid not in answered_tiids:
+                    self.answer_with_nothing(tiid, alias_dict, method_name, aliases_providers_run, 
+                        self.callback_for(method_name, priority))
+                self.provider_queue.ack(provider_messages[i])
+
+
+class GreenletProviderWorker(PooledProviderWorker):
+    """ Pooled worker whose pool members are greenlets rather than threads.
+
+    Run with BACKEND_ENGINE=gevent, so the standard library is monkeypatched
+    and the blocking requests in http_get yield to other greenlets while they
+    wait on the network.  A greenlet costs a few KB instead of a thread stack,
+    so pool_size can be in the thousands.  Providers and their parsers run
+    unchanged.  main() raises the limiter and semaphore ceilings to the pool
+    size, and moves memcached calls onto gevent's threadpool, since pylibmc
+    would otherwise block the hub.
+    """
+    def __init__(self, provider, polling_interval, alias_queue, provider_queue, couch_queues, wrapper, myredis, 
+            semaphore=None, limiter=None, batch_window=0.5, pool_size=None):
+        super(GreenletProviderWorker, self).__init__(
+            provider, polling_interval, alias_queue, provider_queue, couch_queues, wrapper, myredis, 
+            semaphore, limiter, batch_window)
+        if pool_size:
+            self.pool_size = pool_size
+
+    def spawn_and_loop(self):
+        import gevent
+        self.greenlets = [gevent.spawn(self.run_in_loop) for i in range(self.pool_size)]
+        logger.info("launched {pool_size} pooled greenlets for {provider}".format(
+            pool_size=self.pool_size, provider=self.provider_name.upper()))
+
+
 class CouchWorker(Worker):
     def __init__(self, couch_queue, myredis, mydao):
         self.couch_queue = couch_queue
@@ -221,10 +1147,28 @@ class CouchWorker(Worker):
         if not provider_name:
             provider_name = "(unknown)"
         self.myredis.decr_num_providers_left(tiid, provider_name)
+        self.myredis.release_in_flight(tiid, "metrics", provider_name)
+
+    @classmethod
+    def update_item(cls, method_name, new_content, item):
+        # returns the updated item, or None if there was nothing to change
+        if method_name=="aliases":
+            updated_item = cls.update_item_with_new_aliases(new_content, item)
+        elif method_name=="biblio":
+            updated_item = cls.update_item_with_new_biblio(new_content, item)
+        elif method_name=="metrics":
+            updated_item = item
+            for metric_name in new_content:
+                updated_item = cls.update_item_with_new_metrics(metric_name, new_content[metric_name], updated_item)
+        else:
+            logger.warning("ack, supposed to save something i don't know about: " + str(new_content))
+            updated_item = None
+        return updated_item
 
     def run(self):
         couch_message = self.couch_queue.pop()
         if couch_message:
+            started = time.time()
             (tiid, new_content, method_name) = couch_message
             if not new_content:
                 logger.info("{:20}: blank doc, nothing to save".format(
@@ -233,21 +1177,12 @@ class CouchWorker(Worker):
                 item = self.mydao.get(tiid)
                 if not item:
                     if method_name=="metrics":
-                        self.myredis.decr_num_providers_left(tiid, "(unknown)")
+                        self.decr_num_providers_left(new_content.keys()[-1], tiid)
                     logger.error("Empty item from couch for tiid {tiid}, can't save {method_name}".format(
                         tiid=tiid, method_name=method_name))
+                    self.couch_queue.ack(couch_message)
                     return
-                if method_name=="aliases":
-                    updated_item = self.update_item_with_new_aliases(new_content, item)
-                elif method_name=="biblio":
-                    updated_item = self.update_item_with_new_biblio(new_content, item)
-                elif method_name=="metrics":
-                    updated_item = item
-                    for metric_name in new_content:
-                        updated_item = self.update_item_with_new_metrics(metric_name, new_content[metric_name], updated_item)
-                else:
-                    logger.warning("ack, supposed to save something i don't know about: " + str(new_content))
-                    updated_item = None
+                updated_item = self.update_item(method_name, new_content, item)
 
                 # now that is has been updated it, change last_modified and save
                 if updated_item:
@@ -257,19 +1192,145 @@ class CouchWorker(Worker):
                     self.mydao.save(updated_item)
 
                 if method_name=="metrics":
-                    self.decr_num_providers_left(metric_name, tiid) # have to do this after the item save
+                    self.decr_num_providers_left(new_content.keys()[-1], tiid) # have to do this after the item save
+            self.couch_queue.ack(couch_message)
+            backend_stats.record("couch:"+method_name+":service", time.time() - started)
         else:
             #time.sleep(0.1)  # is this necessary?
             pass
 
 
+class BatchingCouchWorker(CouchWorker):
+    """ Drains the couch queue for a short window and coalesces the writes.
+
+    All the aliases, biblio and metrics updates that arrive for one tiid
+    during the window are merged into a single read and a single write,
+    and all the changed items go to couch in one _bulk_docs request.
+    """
+    def __init__(self, couch_queue, myredis, mydao, batch_window=0.5, max_batch_size=100, max_tries=3):
+        super(BatchingCouchWorker, self).__init__(couch_queue, myredis, mydao)
+        self.batch_window = batch_window  # seconds to keep draining after the first message
+        self.max_batch_size = max_batch_size
+        self.max_tries = max_tries
+
+    def pop_batch(self):
+        couch_messages = []
+        couch_message = self.couch_queue.pop()
+        deadline = time.time() + self.batch_window
+        while couch_message:
+            couch_messages.append(couch_message)
+            time_left = deadline - time.time()
+            if (len(couch_messages) >= self.max_batch_size) or (time_left <= 0):
+                break
+            couch_message = self.couch_queue.pop(timeout=time_left)
+        return couch_messages
+
+    @classmethod
+    def group_by_tiid(cls, couch_messages):
+        # keeps the arrival order of the updates within each tiid
+        updates_by_tiid = OrderedDict()
+        for (tiid, new_content, method_name) in couch_messages:
+            if new_content:
+                updates_by_tiid.setdefault(tiid, []).append((method_name, new_content))
+        return updates_by_tiid
+
+    def merge_and_save(self, updates_by_tiid):
+        tiids_to_write = updates_by_tiid.keys()
+        for attempt in range(self.max_tries):
+            items = self.mydao.get_many(tiids_to_write) or {}  # Retry returns False if couch is unreachable
+            changed_items = []
+            for tiid in tiids_to_write:
+                item = items.get(tiid)
+                if not item:
+                    logger.error("Empty item from couch for tiid {tiid}, can't save {method_names}".format(
+                        tiid=tiid, method_names=[method_name for (method_name, new_content) in updates_by_tiid[tiid]]))
+                    continue
+                item_changed = False
+                for (method_name, new_content) in updates_by_tiid[tiid]:
+                    updated_item = self.update_item(method_name, new_content, item)
+                    if updated_item:
+                        item = updated_item
+                        item_changed = True
+                if item_changed:
+                    item["last_modified"] = datetime.datetime.now().isoformat()
+                    changed_items.append(item)
+
+            if not changed_items:
+                return
+            logger.info("{:20}: saving {num_items} items from {num_tiids} tiids in one bulk update".format(
+                self.name, num_items=len(changed_items), num_tiids=len(updates_by_tiid)))
+            response = self.mydao.save_many(changed_items)
+            if response is False:  # Retry gave up, couch is unreachable
+                logger.error("{:20}: couldn't save {tiids}, couch unreachable".format(
+                    self.name, tiids=[item["_id"] for item in changed_items]))
+                return
+
+            # re-read and re-merge only the docs that someone else changed under us
+            tiids_to_write = [tiid for (success, tiid, rev_or_exception) in response if not success]
+            if not tiids_to_write:
+                return
+            logger.info("{:20}: {num} conflicts in bulk update, retrying".format(
+                self.name, num=len(tiids_to_write)))
+
+        logger.error("{:20}: gave up saving {tiids} after {tries} tries".format(
+            self.name, tiids=tiids_to_write, tries=self.max_tries))
+
+    def run(self):
+        couch_messages = self.pop_batch()
+        if not couch_messages:
+            return
+        started = time.time()
+        try:
+            self.merge_and_save(self.group_by_tiid(couch_messages))
+        except Exception:
+            # the batch is lost, but keep this writer thread alive and still count the messages
+            logger.exception("{:20}: unexpected error saving batch of {num} messages".format(
+                self.name, num=len(couch_messages)))
+        backend_stats.record("couch:batch:service", time.time() - started)
+        backend_stats.incr("couch:batch:messages", len(couch_messages))
+
+        # one decrement per metrics message, same as the unbatched worker, after the save
+        for couch_message in couch_messages:
+            (tiid, new_content, method_name) = couch_message
+            if method_name=="metrics" and new_content:
+                self.decr_num_providers_left(new_content.keys()[-1], tiid)
+            self.couch_queue.ack(couch_message)
+
+
 class Backend(Worker):
-    def __init__(self, alias_queue, provider_queues, couch_queues, myredis):
+    def __init__(self, alias_queue, provider_queues, couch_queues, myredis, name="Backend"):
         self.alias_queue = alias_queue
         self.provider_queues = provider_queues
         self.couch_queues = couch_queues
         self.myredis = myredis
-        self.name = "Backend"
+        self.name = name
+        # a job that never finishes (its process died, say) stops blocking new ones after this long
+        self.in_flight_timeout = 60*60
+
+    # genre plans by the provider names in the config, see genre_plans
+    genre_plan_cache = {}
+
+    @classmethod
+    def genre_plans(cls, provider_config=default_settings.PROVIDERS):
+        """ Which providers each genre goes through, worked out once per
+        provider config so sniffing an item doesn't construct any providers.
+
+        Articles get their aliases from each of the "aliases" providers in
+        turn; other genres get them from their host.  Then everything gets
+        biblio and metrics.
+        """
+        key = tuple([provider_name for (provider_name, v) in provider_config])
+        if key not in cls.genre_plan_cache:
+            all_metrics_providers = ProviderFactory.get_provider_names(provider_config, "metrics")
+            cls.genre_plan_cache[key] = {
+                "article": {
+                    "aliases": ["pubmed", "crossref"],
+                    "biblio": ["pubmed", "crossref"],
+                    "metrics": all_metrics_providers},
+                "default": {
+                    "metrics": all_metrics_providers}
+            }
+        return cls.genre_plan_cache[key]
 
     @classmethod
     def sniffer(cls, item_aliases, aliases_providers_run, provider_config=default_settings.PROVIDERS):
@@ -278,8 +1339,7 @@ class Backend(Worker):
         biblio_providers = []
         metrics_providers = []
 
-        all_metrics_providers = [provider.provider_name for provider in 
-                        ProviderFactory.get_providers(provider_config, "metrics")]
+        genre_plans = cls.genre_plans(provider_config)
         (genre, host) = item_module.decide_genre(item_aliases)
 
         has_enough_alias_urls = ("url" in item_aliases)
@@ -288,13 +1348,12 @@ class Backend(Worker):
                 has_enough_alias_urls = (len([url for url in item_aliases["url"] if url.startswith("http://dx.doi.org")]) > 0)
 
         if (genre == "article"):
-            if not "pubmed" in aliases_providers_run:
-                aliases_providers = ["pubmed"]
-            elif not "crossref" in aliases_providers_run:
-                aliases_providers = ["crossref"]
-            else:
-                metrics_providers = all_metrics_providers
-                biblio_providers = ["pubmed", "crossref"]
+            plan = genre_plans["article"]
+            aliases_providers = [provider_name for provider_name in plan["aliases"] 
+                if provider_name not in aliases_providers_run][0:1]
+            if not aliases_providers:
+                metrics_providers = list(plan["metrics"])
+                biblio_providers = list(plan["biblio"])
         else:
             # relevant alias and biblio providers are always the same
             relevant_providers = [host]
@@ -303,7 +1362,7 @@ class Backend(Worker):
             # if all the relevant providers have already run, then all the aliases are done
             # or if it already has urls
             if has_enough_alias_urls or (set(relevant_providers) == set(aliases_providers_run)):
-                metrics_providers = all_metrics_providers
+                metrics_providers = list(genre_plans["default"]["metrics"])
                 biblio_providers = relevant_providers
             else:
                 aliases_providers = relevant_providers
@@ -316,22 +1375,39 @@ class Backend(Worker):
     def run(self):
         alias_message = self.alias_queue.pop()
         if alias_message:
-            logger.info("alias_message said {alias_message}".format(
-                alias_message=alias_message))            
-            (tiid, alias_dict, aliases_providers_run) = alias_message
+            started = time.time()
+            logger.debug("alias_message said %s", alias_message)
+            (tiid, alias_dict, aliases_providers_run) = alias_message[0:3]
+            try:
+                priority = alias_message[3]
+            except IndexError:
+                priority = tiredis.HIGH_PRIORITY
 
             relevant_provider_names = self.sniffer(alias_dict, aliases_providers_run)
-            logger.info("backend for {tiid} sniffer got input {alias_dict}".format(
-                tiid=tiid, alias_dict=alias_dict))
-            logger.info("backend for {tiid} sniffer returned {providers}".format(
-                tiid=tiid, providers=relevant_provider_names))
+            logger.debug("backend for %s sniffer got input %s", tiid, alias_dict)
+            logger.debug("backend for %s sniffer returned %s", tiid, relevant_provider_names)
+
+            # every provider message shares these, so freeze them once instead of copying per queue
+            alias_dict = FrozenAliases(alias_dict)
+            aliases_providers_run = tuple(aliases_providers_run)
 
             # list out the method names so they are run in that priority, biblio before metrics
             for method_name in ["aliases", "biblio", "metrics"]:
                 for provider_name in relevant_provider_names[method_name]:
+                    # the same update requested again while this one is still going joins it.
+                    # A new request resets num_providers_left, and each provider counts itself off
+                    # only once per reset, so a job that finishes between that reset and this
+                    # check and then runs again can't make the item look done early.
+                    if not self.myredis.claim_in_flight(tiid, method_name, provider_name, self.in_flight_timeout, 
+                            priority):
+                        logger.debug("%s %s %s is already queued or running, skipping", tiid, method_name, provider_name)
+                        backend_stats.incr("provider:"+provider_name+":"+method_name+":deduplicated")
+                        continue
 
-                    provider_message = (tiid, alias_dict, method_name, aliases_providers_run)
+                    provider_message = ProviderMessage(tiid, alias_dict, method_name, aliases_providers_run, priority)
                     self.provider_queues[provider_name].push(provider_message)
+            self.alias_queue.ack(alias_message)
+            backend_stats.record("alias:service", time.time() - started)
         else:
             #time.sleep(0.1)  # is this necessary?
             pass
@@ -339,42 +1415,159 @@ class Backend(Worker):
 
 
 def main():
+    # payloads are only logged at DEBUG, so INFO skips formatting them for every message
+    logger.setLevel(os.getenv("BACKEND_LOG_LEVEL", "INFO"))
+
     mydao = dao.Dao(os.environ["CLOUDANT_URL"], os.environ["CLOUDANT_DB"])
 
     myredis = tiredis.from_url(os.getenv("REDISTOGO_URL"))
-    alias_queue = RedisQueue("aliasqueue", myredis)
+    # share provider rate limits with every other backend process
+    provider_module.use_redis_for_rate_limits(myredis)
+
+    # "python" keeps provider and couch queues in this process, 
+    # "redis" keeps every stage in redis so several backend processes can share the work
+    queue_backend = os.getenv("QUEUE_BACKEND", "python")
+
+    # how many pops high priority work gets for each low priority one when both are waiting
+    priority_weights = {
+        tiredis.HIGH_PRIORITY: int(os.getenv("HIGH_PRIORITY_WEIGHT", 4)), 
+        tiredis.LOW_PRIORITY: 1
+    }
+
+    alias_lanes = {}
+    for priority in priority_weights:
+        if queue_backend == "redis":
+            alias_lanes[priority] = ReliableRedisQueue(tiredis.ALIAS_QUEUE_NAMES[priority], myredis)
+        else:
+            alias_lanes[priority] = RedisQueue(tiredis.ALIAS_QUEUE_NAMES[priority], myredis)
+    alias_queue = WeightedFairQueue("aliasqueue", alias_lanes, priority_weights, priority_index=3)
+    if queue_backend == "python":
+        # the jobs claimed by the last run went with its in-process queues
+        myredis.clear_in_flight()
     # to clear alias_queue:
     #import redis, os
     #myredis = redis.from_url(os.getenv("REDISTOGO_URL"))
     #myredis.delete(["aliasqueue"])
 
 
-    # these need to match the tiid alphabet defined in models:
-    couch_queues = {}
-    for i in "abcdefghijklmnopqrstuvwxyz1234567890":
-        couch_queues[i] = PythonQueue(i+"_couch_queue")
-        couch_worker = CouchWorker(couch_queues[i], myredis, mydao)
+    # "batched" coalesces the writes for each tiid into bulk saves, "single" saves every message
+    couch_worker_mode = os.getenv("COUCH_WORKER_MODE", "batched")
+    couch_batch_window = float(os.getenv("COUCH_BATCH_WINDOW", 0.5))
+
+    # one writer per shard, so tune this to what the couch cluster can take.
+    # With redis queues every backend process must use the same number, and 
+    # changing it strands messages left in the old shards' queues.
+    num_couch_shards = int(os.getenv("COUCH_SHARDS", 36))
+    couch_queues = []
+    for i in range(num_couch_shards):
+        couch_queue_name = "couch_queue_{i}".format(i=i)
+        if queue_backend == "redis":
+            couch_queues.append(ReliableRedisQueue(couch_queue_name, myredis, visibility_timeout=60))
+        else:
+            couch_queues.append(PythonQueue(couch_queue_name))
+        if couch_worker_mode == "batched":
+            couch_worker = BatchingCouchWorker(couch_queues[i], myredis, mydao, batch_window=couch_batch_window)
+        else:
+            couch_worker = CouchWorker(couch_queues[i], myredis, mydao)
         couch_worker.spawn_and_loop() 
-        logger.info("launched backend couch worker with {i}_couch_queue".format(
-            i=i))
+        logger.info("launched backend couch worker with {couch_queue_name}".format(
+            couch_queue_name=couch_queue_name))
+
 
+    # "gevent" runs provider calls as greenlets over monkeypatched sockets, 
+    # "threads" uses OS threads.  The gevent patching itself happens at the top of this file.
+    backend_engine = os.getenv("BACKEND_ENGINE", "threads")
+    greenlets_per_provider = int(os.getenv("GREENLETS_PER_PROVIDER", 500))
+
+    # "pooled" runs a fixed set of threads per provider, "threads" starts a thread per message
+    provider_worker_mode = os.getenv("PROVIDER_WORKER_MODE", "pooled")
+    if queue_backend == "redis" or backend_engine == "gevent":
+        provider_worker_mode = "pooled"  # only pooled workers ack messages and share concurrency caps
+    if backend_engine == "gevent":
+        provider_worker_class = functools.partial(GreenletProviderWorker, pool_size=greenlets_per_provider)
+        provider_queue_depth_per_thread = int(os.getenv("PROVIDER_QUEUE_DEPTH_PER_THREAD", 10))
+        cache_module.use_threadpool_for_memcached()
+    elif provider_worker_mode == "pooled":
+        provider_worker_class = PooledProviderWorker
+        provider_queue_depth_per_thread = int(os.getenv("PROVIDER_QUEUE_DEPTH_PER_THREAD", 50))
+    else:
+        provider_worker_class = ProviderWorker
+        provider_queue_depth_per_thread = 0  # unbounded
+
+    # "on" lets each provider's concurrency follow its latency and errors, 
+    # starting from max_simultaneous_requests, for pooled workers
+    adaptive_concurrency = (os.getenv("ADAPTIVE_CONCURRENCY", "on") == "on")
+    if backend_engine == "gevent":
+        adaptive_max_concurrency = int(os.getenv("ADAPTIVE_MAX_CONCURRENCY", greenlets_per_provider))
+    else:
+        adaptive_max_concurrency = int(os.getenv("ADAPTIVE_MAX_CONCURRENCY", 50))
+
+    # seconds a pooled worker waits to fill a batch, for provider methods with a batch size
+    provider_batch_window = float(os.getenv("PROVIDER_BATCH_WINDOW", 0.5))
 
     polling_interval = 0.1   # how many seconds between polling to talk to provider
     provider_queues = {}
     providers = ProviderFactory.get_providers(default_settings.PROVIDERS)
     for provider in providers:
-        provider_queues[provider.provider_name] = PythonQueue(provider.provider_name+"_queue")
-        provider_worker = ProviderWorker(
+        # the most calls to the provider this process's pool can make at once
+        if backend_engine == "gevent":
+            provider_concurrency = greenlets_per_provider
+        else:
+            provider_concurrency = provider.max_simultaneous_requests
+        provider_lanes = {}
+        for priority in priority_weights:
+            lane_name = provider.provider_name+"_queue"
+            if priority != tiredis.HIGH_PRIORITY:
+                lane_name += "_" + priority
+            if queue_backend == "redis":
+                provider_lanes[priority] = ReliableRedisQueue(lane_name, myredis)
+            else:
+                provider_lanes[priority] = PythonQueue(lane_name,
+                    maxsize=provider_queue_depth_per_thread * provider_concurrency)
+        provider_queues[provider.provider_name] = WeightedFairQueue(provider.provider_name+"_queue", 
+            provider_lanes, priority_weights, priority_index=4)
+        worker_options = {}
+        if provider_worker_mode == "pooled":
+            worker_options["batch_window"] = provider_batch_window
+        if adaptive_concurrency and provider_worker_mode == "pooled":
+            worker_options["limiter"] = AdaptiveLimiter(provider.provider_name, 
+                provider.max_simultaneous_requests, max_limit=adaptive_max_concurrency)
+        worker_provider_queue = provider_queues[provider.provider_name]
+        if queue_backend == "redis":
+            # one redis connection blocking on the queue per provider, not one per pool member
+            worker_provider_queue = BufferedQueue(worker_provider_queue)
+            worker_provider_queue.spawn_and_loop()
+        provider_worker = provider_worker_class(
             provider, 
             polling_interval, 
             alias_queue,
-            provider_queues[provider.provider_name], 
+            worker_provider_queue, 
             couch_queues,
             ProviderWorker.wrapper,
-            myredis)
+            myredis,
+            **worker_options)
+        if queue_backend == "redis":
+            provider_worker.semaphore = RedisSemaphore(provider.provider_name, myredis, 
+                provider_concurrency)
         provider_worker.spawn_and_loop()
 
-    backend = Backend(alias_queue, provider_queues, couch_queues, myredis)
+    if queue_backend == "redis":
+        reaper = QueueReaper([alias_queue] + provider_queues.values() + couch_queues)
+        reaper.spawn_and_loop()
+
+    stats_dumper = StatsDumper([alias_queue] + provider_queues.values() + couch_queues, myredis, 
+        interval=int(os.getenv("STATS_DUMP_INTERVAL", 60)))
+    stats_dumper.spawn_and_loop()
+
+    # one dispatcher per priority, each popping only its own alias lane.  Pushing to a 
+    # full provider lane blocks, so a scheduled batch filling a slow provider's low lane 
+    # holds up the low priority dispatcher but never the high priority items behind it.
+    for priority in priority_weights:
+        if priority != tiredis.HIGH_PRIORITY:
+            low_priority_backend = Backend(alias_lanes[priority], provider_queues, couch_queues, myredis, 
+                name="Backend_"+priority)
+            low_priority_backend.spawn_and_loop()
+    backend = Backend(alias_lanes[tiredis.HIGH_PRIORITY], provider_queues, couch_queues, myredis)
     try:
         backend.run_in_loop() # don't need to spawn this one
     except (KeyboardInterrupt, SystemExit): 
@@ -3,9 +3,17 @@ import pylibmc
 import hashlib
 import logging
 import json
+import threading
+import Queue
+import time
+import zlib
+import cPickle
+from collections import OrderedDict
+from contextlib import contextmanager
 from cPickle import PicklingError
 
 from totalimpact.utils import Retry
+from totalimpact.stats import backend_stats
 
 # set up logging
 logger = logging.getLogger("ti.cache")
@@ -13,46 +21,260 @@ logger = logging.getLogger("ti.cache")
 class CacheException(Exception):
     pass
 
+class MemcachedPool(object):
+    """ Memcached clients shared by every thread in the process, so a cache
+    lookup doesn't pay for a new connection and SASL handshake each time """
+
+    behaviors = {
+        "tcp_nodelay": True,
+        "tcp_keepalive": True,
+        "connect_timeout": 1000,  # milliseconds
+        "retry_timeout": 1  # seconds before trying a failed server again
+    }
+
+    def __init__(self, size=10):
+        self.size = size
+        self.clients = Queue.Queue(size)
+        # clients are built the first time they are needed
+        for i in range(size):
+            self.clients.put(None)
+
+    def _new_client(self):
+        mc = pylibmc.Client(
+            servers=[os.environ.get('MEMCACHE_SERVERS')],
+            username=os.environ.get('MEMCACHE_USERNAME'),
+            password=os.environ.get('MEMCACHE_PASSWORD'),
+            binary=True,
+            behaviors=self.behaviors)
+        return mc
+
+    @contextmanager
+    def reserve(self):
+        """ Lends out a client, waiting for one if they are all in use """
+        mc = self.clients.get()
+        if mc is None:
+            mc = self._new_client()
+        try:
+            yield mc
+        except pylibmc.Error:
+            # the connection may be broken, so the next borrower gets a new client
+            logger.info("memcached client error, dropping it from the pool")
+            mc = None
+            raise
+        finally:
+            self.clients.put(mc)
+
+
+# one pool per process
+memcached_pool = None
+memcached_pool_lock = threading.Lock()
+
+# set by use_threadpool_for_memcached under gevent
+memcached_threadpool = None
+
+def use_threadpool_for_memcached():
+    """ pylibmc is a C extension, so gevent's monkeypatching can't make its socket
+    calls yield, and each lookup would stall every greenlet in the process.  After
+    this, memcached calls run on the gevent hub's threadpool and only block the
+    greenlet that made them. """
+    global memcached_threadpool
+    import gevent
+    memcached_threadpool = gevent.get_hub().threadpool
+
+def call_memcached(method, *args, **kwargs):
+    if memcached_threadpool is None:
+        return method(*args, **kwargs)
+    return memcached_threadpool.apply(method, args, kwargs)
+
+def get_memcached_pool():
+    global memcached_pool
+    with memcached_pool_lock:
+        if memcached_pool is None:
+            memcached_pool = MemcachedPool(int(os.environ.get('MEMCACHE_POOL_SIZE', 10)))
+        return memcached_pool
+
+
+class LocalCache(object):
+    """ Bounded in-process LRU cache that sits in front of memcached.
+
+    Entries expire after the ttl they were stored with, and the least
+    recently used ones are evicted once the entries' total size passes max_bytes. """
+
+    def __init__(self, max_bytes=50*1000*1000, max_entries=10000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # hash_key: (expires, size, data), oldest first
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def sizeof(cls, data):
+        """ rough size of a cached response: its strings plus a bit of overhead """
+        if isinstance(data, dict):
+            return 100 + sum([cls.sizeof(value) for value in data.values()])
+        if isinstance(data, basestring):
+            return len(data)
+        return 8
+
+    def get(self, hash_key):
+        with self.lock:
+            entry = self.entries.pop(hash_key, None)
+            if entry is None:
+                return None
+            (expires, size, data) = entry
+            if expires < time.time():
+                self.num_bytes -= size
+                return None
+            # put it back at the most recently used end
+            self.entries[hash_key] = entry
+            return data
+
+    def set(self, hash_key, data, ttl):
+        size = self.sizeof(data)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old_entry = self.entries.pop(hash_key, None)
+            if old_entry:
+                self.num_bytes -= old_entry[1]
+            self.entries[hash_key] = (time.time() + ttl, size, data)
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes or len(self.entries) > self.max_entries:
+                (evicted_key, evicted_entry) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+
+# one local cache per process
+local_cache = None
+local_cache_lock = threading.Lock()
+
+def get_local_cache():
+    global local_cache
+    with local_cache_lock:
+        if local_cache is None:
+            local_cache = LocalCache(
+                max_bytes=int(os.environ.get('LOCAL_CACHE_MAX_BYTES', 50*1000*1000)),
+                max_entries=int(os.environ.get('LOCAL_CACHE_MAX_ENTRIES', 10000)))
+        return local_cache
+
+
 class Cache(object):
     """ Maintains a cache of URL responses in memcached """
 
+    # entries whose strings add up to more than this are pickled and zlib compressed
+    compress_threshold = 10*1000
+    # memcached refuses items over 1MB, so longer compressed entries are stored in chunks
+    chunk_size = 900*1000
+
     def _build_hash_key(self, key):
         json_key = json.dumps(key)
         hash_key = hashlib.md5(json_key.encode("utf-8")).hexdigest()
         return hash_key
 
-    def _get_memcached_client(self):
-        mc = pylibmc.Client(
-            servers=[os.environ.get('MEMCACHE_SERVERS')],
-            username=os.environ.get('MEMCACHE_USERNAME'),
-            password=os.environ.get('MEMCACHE_PASSWORD'),
-            binary=True)
-        return mc
- 
     def __init__(self, max_cache_age=60*60):  #one hour
         self.max_cache_age = max_cache_age
 
 
     def flush_cache(self):
         #empties the cache
-        mc = self._get_memcached_client()        
-        mc.flush_all()
+        get_local_cache().clear()
+        with get_memcached_pool().reserve() as mc:
+            call_memcached(mc.flush_all)
 
-    @Retry(3, pylibmc.Error, 0.1)
     def get_cache_entry(self, key):
         """ Get an entry from the cache, returns None if not found """
-        mc = self._get_memcached_client()
         hash_key = self._build_hash_key(key)
-        response = mc.get(hash_key)
+        response = get_local_cache().get(hash_key)
+        if response is not None:
+            backend_stats.incr("cache:local:hits")
+            return response
+        backend_stats.incr("cache:local:misses")
+
+        # False when memcached couldn't be reached, which is a miss too
+        entry = self._get_memcached_entry(hash_key)
+        if entry:
+            (response, expires) = entry
+            backend_stats.incr("cache:memcached:hits")
+            # only for what is left of the entry's term.  Entries stored before
+            # they carried their expiry get a full one
+            if expires is None:
+                ttl = self.max_cache_age
+            else:
+                ttl = expires - time.time()
+            if ttl > 0:
+                get_local_cache().set(hash_key, response, ttl)
+        else:
+            response = None
+            backend_stats.incr("cache:memcached:misses")
         return response
 
+    def _pack(self, hash_key, data, expires):
+        """ Returns a dict of the memcached keys and values to store data under hash_key, 
+        along with the time it expires """
+        if LocalCache.sizeof(data) < self.compress_threshold:
+            return {hash_key: {"_value": data, "_expires": expires}}
+        payload = zlib.compress(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+        backend_stats.incr("cache:memcached:compressed")
+        if len(payload) <= self.chunk_size:
+            return {hash_key: {"_compressed": payload, "_expires": expires}}
+
+        # chunk keys include a checksum of the payload, so a reader never mixes
+        # chunks from two different versions of the entry
+        backend_stats.incr("cache:memcached:chunked")
+        checksum = "%08x" % (zlib.crc32(payload) & 0xffffffff)
+        values = {}
+        chunk_keys = []
+        for (i, start) in enumerate(range(0, len(payload), self.chunk_size)):
+            chunk_key = "{hash_key}:{checksum}:{i}".format(hash_key=hash_key, checksum=checksum, i=i)
+            values[chunk_key] = payload[start:start+self.chunk_size]
+            chunk_keys.append(chunk_key)
+        values[hash_key] = {"_chunks": chunk_keys, "_expires": expires}
+        return values
+
+    def _unpack(self, mc, value):
+        """ Returns the data stored as value and when it expires, or None if there 
+        is no value or some of its chunks have been evicted """
+        if value is None:
+            return None
+        if not isinstance(value, dict) or "_expires" not in value:
+            # stored before entries carried their expiry
+            return (value, None)
+        expires = value["_expires"]
+        if "_chunks" in value:
+            chunks = call_memcached(mc.get_multi, value["_chunks"])
+            if len(chunks) < len(value["_chunks"]):
+                return None
+            value = {"_compressed": "".join([chunks[chunk_key] for chunk_key in value["_chunks"]])}
+        if "_compressed" in value:
+            return (cPickle.loads(zlib.decompress(value["_compressed"])), expires)
+        return (value["_value"], expires)
+
+    @Retry(3, pylibmc.Error, 0.1)
+    def _get_memcached_entry(self, hash_key):
+        """ Returns (data, expires) for hash_key, or None if memcached doesn't have it """
+        with get_memcached_pool().reserve() as mc:
+            entry = self._unpack(mc, call_memcached(mc.get, hash_key))
+        return entry
+
     @Retry(3, pylibmc.Error, 0.1)
-    def set_cache_entry(self, key, data):
-        """ Store a cache entry """
-        mc = self._get_memcached_client()
+    def set_cache_entry(self, key, data, max_cache_age=None):
+        """ Store a cache entry, for max_cache_age seconds if given instead of the default """
+        if max_cache_age is None:
+            max_cache_age = self.max_cache_age
         hash_key = self._build_hash_key(key)
+        get_local_cache().set(hash_key, data, max_cache_age)
         try:
-            set_response = mc.set(hash_key, data, time=self.max_cache_age)
+            values = self._pack(hash_key, data, time.time() + max_cache_age)
+            entry = values.pop(hash_key)
+            with get_memcached_pool().reserve() as mc:
+                # chunks go in before the entry that points at them
+                failed_keys = call_memcached(mc.set_multi, values, time=max_cache_age) if values else []
+                set_response = not failed_keys and call_memcached(mc.set, hash_key, entry, time=max_cache_age)
             if not set_response:
                 raise CacheException("Unable to store into Memcached. Make sure memcached server is running.")
         except PicklingError:
@@ -60,6 +282,3 @@ class Cache(object):
             logger.debug("In set_cache_entry but got PicklingError")
             set_response = None
         return (set_response)
-  
-        
-        
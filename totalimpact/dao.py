@@ -171,6 +171,22 @@ class Dao(object):
         logger.info("dao saved %s" %(doc["_id"]))
         return response
 
+    @Retry(3, Exception, 0.1)
+    def get_many(self, ids):
+        """ returns a dict of id to doc for the ids that exist, in one request """
+        rows = self.db.view("_all_docs", keys=list(ids), include_docs=True)
+        return dict((row.key, row.doc) for row in rows if row.doc)
+
+    @Retry(3, Exception, 0.1)
+    def save_many(self, docs):
+        """ saves docs with one _bulk_docs request.
+        returns a list of (success, docid, rev_or_exception) tuples """
+        for doc in docs:
+            if "_id" not in doc:
+                raise KeyError("tried to save doc with '_id' key unset.")
+        response = self.db.update(docs)
+        logger.info("dao bulk saved %i docs" %(len(docs)))
+        return response
        
     def view(self, viewname):
         return self.db.view(viewname)
@@ -7,6 +7,18 @@ USER_AGENT = "ImpactStory/0.4.0" # User-Agent string to use on HTTP requests
 VERSION = "cristhian" # version
 PROXY = "" # used with  providers-test-proxy.py script in the extras directory
 CACHE_ENABLED = True # Memcache server enabled
+# seconds to cache upstream errors that mean the item isn't there, by status code.
+# Kept short, since new items often 404 until the provider catches up, and never 
+# longer than the provider's max_cache_duration
+NEGATIVE_CACHE_DURATIONS = {
+    403: 60*5,  # forbidden; often a key or quota problem
+    404: 60*15,  # not found
+    410: 60*60  # gone
+}
+CACHE_REVALIDATION_WINDOW = 60*60*6 # at most this many seconds to keep stale entries with an ETag or Last-Modified, for conditional GETs
+EMPTY_METRICS_CACHE_DURATION = 60*15 # seconds to cache a 200 that has no metrics in it, at most max_cache_duration
+HTTP_MAX_CONNECTIONS_PER_HOST = 10 # idle keep-alive connections kept open to each provider host
+HTTP_MAX_POOLED_HOSTS = 100 # hosts to keep connection pools for, least recently used dropped first
 
 # List of desired providers and their configuration files
 # Alias methods will be called in the order of this list
@@ -4,7 +4,7 @@ import shortuuid, datetime, hashlib, threading, json, time, copy, re
 
 from totalimpact.providers.provider import ProviderFactory
 from totalimpact.providers.provider import ProviderTimeout, ProviderServerError
-from totalimpact import default_settings, mixpanel
+from totalimpact import default_settings, mixpanel, tiredis
 from totalimpact.utils import Retry
 
 # Master lock to ensure that only a single thread can write
@@ -244,7 +244,7 @@ def merge_alias_dicts(aliases1, aliases2):
 
 def get_metric_names(providers_config):
     full_metric_names = []
-    providers = ProviderFactory.get_providers(providers_config)
+    providers = ProviderFactory.get_registry(providers_config)
     for provider in providers:
         metric_names = provider.metric_names()
         for metric_name in metric_names:
@@ -450,7 +450,7 @@ def get_tiid_by_alias(ns, nid, mydao):
         tiid = None
     return tiid
 
-def start_item_update(tiids, myredis, mydao, sleep_in_seconds=0):
+def start_item_update(tiids, myredis, mydao, sleep_in_seconds=0, priority=tiredis.HIGH_PRIORITY):
     # put each of them on the update queue
     for tiid in tiids:
         logger.debug("In start_item_update with tiid " + tiid)
@@ -463,7 +463,7 @@ def start_item_update(tiids, myredis, mydao, sleep_in_seconds=0):
 
         item_doc = mydao.get(tiid)
         try:
-            myredis.add_to_alias_queue(item_doc["_id"], item_doc["aliases"])
+            myredis.add_to_alias_queue(item_doc["_id"], item_doc["aliases"], priority=priority)
         except (KeyError, TypeError):
             logger.debug("couldn't get item_doc for {tiid}. Skipping its update".format(
                 tiid=tiid))
@@ -16,6 +16,15 @@ class Crossref(Provider):
     descr = "An official Digital Object Identifier (DOI) Registration Agency of the International DOI Foundation."
     aliases_url_template = "http://dx.doi.org/%s"
     biblio_url_template = "http://dx.doi.org/%s"
+
+    biblio_json_extractor = provider.JsonExtractor({
+        'title' : ['title'],
+        'year' : ['issued'],
+        'repository' : ['publisher'],
+        'journal' : ['container-title'],
+        'authors_literal' : ['author']
+    })
+
     # example code to test 
     # curl -D - -L -H   "Accept: application/vnd.citationstyles.csl+json" "http://dx.doi.org/10.1021/np070361t" 
 
@@ -71,14 +80,7 @@ class Crossref(Provider):
         return biblio_dict
 
     def _extract_biblio(self, page, id=None):
-        dict_of_keylists = {
-            'title' : ['title'],
-            'year' : ['issued'],
-            'repository' : ['publisher'],
-            'journal' : ['container-title'],
-            'authors_literal' : ['author']
-        }
-        biblio_dict = provider._extract_from_json(page, dict_of_keylists)
+        biblio_dict = self.biblio_json_extractor.extract(page)
         if not biblio_dict:
           return {}
 
@@ -18,6 +18,12 @@ class Figshare(Provider):
     metrics_url_template = "http://api.figshare.com/v1/articles/%s"
     provenance_url_template = "http://dx.doi.org/%s"
 
+    metrics_json_extractor = provider.JsonExtractor({
+        'figshare:shares' : ['shares'],
+        'figshare:downloads' : ['downloads'],
+        'figshare:views' : ['views']
+    })
+
     static_meta_dict = {
         "shares": {
             "display_name": "shares",
@@ -90,11 +96,6 @@ class Figshare(Provider):
             else:
                 raise(self._get_error(status_code))
 
-        dict_of_keylists = {
-            'figshare:shares' : ['shares'],
-            'figshare:downloads' : ['downloads'],
-            'figshare:views' : ['views']
-        }
         item = self._extract_figshare_record(page, id)
-        metrics_dict = provider._extract_from_data_dict(item, dict_of_keylists)
+        metrics_dict = self.metrics_json_extractor.extract_from_data(item)
         return metrics_dict
@@ -12,12 +12,28 @@ class Github(Provider):
 
     url = "http://github.com"
     descr = "A social, online repository for open-source software."
+    rate_limit = (5000, 60*60)  # authenticated api quota is 5000 requests per hour
     member_items_url_template = "https://api.github.com/users/%s/repos?client_id=" + os.environ["GITHUB_CLIENT_ID"] + "&client_secret=" + os.environ["GITHUB_CLIENT_SECRET"]
     biblio_url_template = "https://api.github.com/repos/%s/%s?client_id=" + os.environ["GITHUB_CLIENT_ID"] + "&client_secret=" + os.environ["GITHUB_CLIENT_SECRET"]
     aliases_url_template = "https://api.github.com/repos/%s/%s?client_id=" + os.environ["GITHUB_CLIENT_ID"] + "&client_secret=" + os.environ["GITHUB_CLIENT_SECRET"]
     metrics_url_template = "https://api.github.com/repos/%s/%s?client_id=" + os.environ["GITHUB_CLIENT_ID"] + "&client_secret=" + os.environ["GITHUB_CLIENT_SECRET"]
     repo_url_template = "https://github.com/%s/%s"
 
+    biblio_json_extractor = provider.JsonExtractor({
+        'title' : ['name'],
+        'description' : ['description'],
+        'owner' : ['owner', 'login'],
+        'url' : ['svn_url'],
+        'last_push_date' : ['pushed_at'],
+        'create_date' : ['created_at']
+    })
+    aliases_json_extractor = provider.JsonExtractor({"url": ["svn_url"], 
+                                                     "title" : ["name"]})
+    metrics_json_extractor = provider.JsonExtractor({
+        'github:stars' : ['watchers'],
+        'github:forks' : ['forks']
+    })
+
     provenance_url_templates = {
         "github:stars" : "https://github.com/%s/%s/stargazers",
         "github:forks" : "https://github.com/%s/%s/network/members"
@@ -72,15 +88,7 @@ class Github(Provider):
         return(members)
 
     def _extract_biblio(self, page, id=None):
-        dict_of_keylists = {
-            'title' : ['name'],
-            'description' : ['description'],
-            'owner' : ['owner', 'login'],
-            'url' : ['svn_url'],
-            'last_push_date' : ['pushed_at'],
-            'create_date' : ['created_at']
-        }
-        biblio_dict = provider._extract_from_json(page, dict_of_keylists)
+        biblio_dict = self.biblio_json_extractor.extract(page)
         try:
             biblio_dict["year"] = biblio_dict["create_date"][0:4]
         except KeyError:
@@ -89,10 +97,7 @@ class Github(Provider):
         return biblio_dict    
        
     def _extract_aliases(self, page, id=None):
-        dict_of_keylists = {"url": ["svn_url"], 
-                            "title" : ["name"]}
-
-        aliases_dict = provider._extract_from_json(page, dict_of_keylists)
+        aliases_dict = self.aliases_json_extractor.extract(page)
         if aliases_dict:
             aliases_list = [(namespace, nid) for (namespace, nid) in aliases_dict.iteritems()]
         else:
@@ -110,12 +115,7 @@ class Github(Provider):
         if not "forks_count" in page:
             raise ProviderContentMalformedError
 
-        dict_of_keylists = {
-            'github:stars' : ['watchers'],
-            'github:forks' : ['forks']
-        }
-
-        metrics_dict = provider._extract_from_json(page, dict_of_keylists)
+        metrics_dict = self.metrics_json_extractor.extract(page)
 
         return metrics_dict
 
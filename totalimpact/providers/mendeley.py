@@ -17,6 +17,14 @@ class Mendeley(Provider):
     metrics_from_doi_template = "http://api.mendeley.com/oapi/documents/details/%s?type=doi&consumer_key=" + os.environ["MENDELEY_KEY"]
     metrics_from_pmid_template = "http://api.mendeley.com/oapi/documents/details/%s?type=pmid&consumer_key=" + os.environ["MENDELEY_KEY"]
 
+    metrics_json_extractor = provider.JsonExtractor({
+        "mendeley:readers": ["stats", "readers"], 
+        "mendeley:discipline": ["stats", "discipline"],
+        "mendeley:career_stage": ["stats", "status"],
+        "mendeley:country": ["stats", "country"],
+        "mendeley:groups" : ["groups"]
+    })
+
     static_meta_dict = {
         "readers": {
             "display_name": "readers",
@@ -70,13 +78,7 @@ class Mendeley(Provider):
         if not "identifiers" in page:
             raise ProviderContentMalformedError()
 
-        dict_of_keylists = {"mendeley:readers": ["stats", "readers"], 
-                            "mendeley:discipline": ["stats", "discipline"],
-                            "mendeley:career_stage": ["stats", "status"],
-                            "mendeley:country": ["stats", "country"],
-                            "mendeley:groups" : ["groups"]}
-
-        metrics_dict = provider._extract_from_json(page, dict_of_keylists)
+        metrics_dict = self.metrics_json_extractor.extract(page)
 
         # get count of groups
         try:
@@ -4,11 +4,20 @@ from totalimpact.cache import Cache
 from totalimpact import providers
 from totalimpact import default_settings
 from totalimpact import utils
+from totalimpact.stats import backend_stats
 
 import requests, os, time, threading, sys, traceback, importlib, urllib, logging, itertools
+from requests.packages.urllib3.poolmanager import PoolManager
 import simplejson
+try:
+    # much faster at decoding than simplejson.  It is in requirements.txt, but _load_json
+    # falls back to simplejson where it isn't installed
+    import ujson
+except ImportError:
+    ujson = None
 import BeautifulSoup
 from xml.dom import minidom 
+from xml.parsers import expat
 from xml.parsers.expat import ExpatError
 import re
 
@@ -19,6 +28,10 @@ requests_log = logging.getLogger("requests").setLevel(logging.WARNING)
 
 class ProviderFactory(object):
 
+    # provider instances built by get_registry, keyed by the provider names in the config
+    registry = {}
+    registry_lock = threading.Lock()
+
     @classmethod
     def get_provider(cls, provider_name):
         provider_module = importlib.import_module('totalimpact.providers.'+provider_name)
@@ -44,20 +57,41 @@ class ProviderFactory(object):
                 logger.error("Unable to configure provider ... skipping " + str(v))
         return providers
 
+    @classmethod
+    def get_registry(cls, config_providers):
+        """ Provider instances for the config, built the first time and shared after that.
+
+        Constructing providers means importing their modules, and some
+        constructors do real work, so anything that only reads provider
+        attributes should come here.  Use get_providers for instances of
+        your own to configure or run.
+        """
+        key = tuple([provider_name for (provider_name, v) in config_providers])
+        try:
+            return cls.registry[key]
+        except KeyError:
+            with cls.registry_lock:
+                if key not in cls.registry:
+                    cls.registry[key] = cls.get_providers(config_providers)
+            return cls.registry[key]
+
+    @classmethod
+    def get_provider_names(cls, config_providers, filter_by=None):
+        provider_names = []
+        for provider in cls.get_registry(config_providers):
+            if (filter_by is None) or getattr(provider, "provides_"+filter_by):
+                provider_names.append(provider.provider_name)
+        return provider_names
+
     @classmethod
     def num_providers_with_metrics(cls, config_providers):
-        providers = cls.get_providers(config_providers)
-        num_providers_with_metrics = 0
-        for provider in providers:
-            if provider.provides_metrics:
-                num_providers_with_metrics += 1
-        return num_providers_with_metrics
+        return len(cls.get_provider_names(config_providers, "metrics"))
 
     @classmethod
     def get_all_static_meta(cls, config_providers=default_settings.PROVIDERS):
         # this is now duplicating get_all_metadata below; not high refactoring priority, though.
         all_static_meta = {}
-        providers = cls.get_providers(config_providers)
+        providers = cls.get_registry(config_providers)
         for provider in providers:
             if provider.provides_metrics:
                 for metric_name in provider.static_meta_dict:
@@ -74,7 +108,7 @@ class ProviderFactory(object):
     @classmethod
     def get_all_metadata(cls, config_providers=default_settings.PROVIDERS):
         ret = {}
-        providers = cls.get_providers(config_providers)
+        providers = cls.get_registry(config_providers)
         for provider in providers:
             provider_data = {}
             provider_data["provides_metrics"] = provider.provides_metrics
@@ -95,8 +129,182 @@ class ProviderFactory(object):
 
 
         
+class TokenBucket(object):
+    """ Token bucket rate limiter shared by every thread in this process """
+
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.rate = float(rate)  # tokens added per second
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def refill(cls, tokens, timestamp, rate, capacity, now):
+        return min(capacity, tokens + (now - timestamp) * rate)
+
+    def _take(self):
+        """ Takes a token if there is one.  Returns 0, or how many seconds until the next one. """
+        with self.lock:
+            now = time.time()
+            self.tokens = self.refill(self.tokens, self.timestamp, self.rate, self.capacity, now)
+            self.timestamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def consume(self, max_wait):
+        """ Blocks until a token is available, or raises ProviderRateLimitError 
+        if that would take more than max_wait seconds in total """
+        waited = 0
+        wait = self._take()
+        while wait:
+            if waited + wait > max_wait:
+                raise ProviderRateLimitError("%s waited %.1f seconds for its rate limit" %(self.name, waited))
+            time.sleep(wait)
+            waited += wait
+            wait = self._take()
+
+
+class RedisTokenBucket(TokenBucket):
+    """ Token bucket kept in redis so all backend processes share one rate limit """
+
+    def __init__(self, name, rate, capacity, myredis):
+        super(RedisTokenBucket, self).__init__(name, rate, capacity)
+        self.myredis = myredis
+        self.key = "rate_limit:" + name
+
+    def _take(self):
+        result = {}
+        def take_in_transaction(pipe):
+            (tokens, timestamp) = pipe.hmget(self.key, ["tokens", "timestamp"])
+            now = time.time()
+            if tokens is None:
+                tokens = self.capacity
+            else:
+                tokens = self.refill(float(tokens), float(timestamp), self.rate, self.capacity, now)
+            if tokens >= 1:
+                tokens -= 1
+                result["wait"] = 0
+            else:
+                result["wait"] = (1 - tokens) / self.rate
+            pipe.multi()
+            pipe.hmset(self.key, {"tokens": repr(tokens), "timestamp": repr(now)})
+            pipe.expire(self.key, int(self.capacity / self.rate) + 60)
+        self.myredis.transaction(take_in_transaction, self.key)
+        return result["wait"]
+
+
+# one rate limiter per provider name, shared by all instances of the provider
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+rate_limiters_redis = None
+
+def use_redis_for_rate_limits(myredis):
+    """ Share provider rate limits with every process that uses this redis """
+    global rate_limiters_redis
+    with rate_limiters_lock:
+        rate_limiters_redis = myredis
+        rate_limiters.clear()
+
+def get_rate_limiter(provider_name, rate_limit):
+    with rate_limiters_lock:
+        if provider_name not in rate_limiters:
+            (num_requests, per_seconds) = rate_limit
+            rate = float(num_requests) / per_seconds
+            if rate_limiters_redis:
+                rate_limiters[provider_name] = RedisTokenBucket(provider_name, rate, num_requests, rate_limiters_redis)
+            else:
+                rate_limiters[provider_name] = TokenBucket(provider_name, rate, num_requests)
+        return rate_limiters[provider_name]
+
+
+class SharedPoolManager(PoolManager):
+    """ urllib3 PoolManager that can be shared by many threads.  Keeps one
+    keep-alive connection pool per host, holding up to maxsize idle connections. """
+
+    def __init__(self, num_pools=10, **connection_pool_kw):
+        super(SharedPoolManager, self).__init__(num_pools, **connection_pool_kw)
+        # the pool container's LRU bookkeeping isn't safe to mutate from several threads
+        self.lock = threading.Lock()
+
+    def connection_from_host(self, host, port=80, scheme='http'):
+        with self.lock:
+            return super(SharedPoolManager, self).connection_from_host(host, port, scheme)
+
+    def stats(self):
+        """ requests and new connections for each host currently pooled """
+        with self.lock:
+            pools = dict.items(self.pools)
+        response = {}
+        for ((scheme, host, port), pool) in pools:
+            response["{scheme}://{host}:{port}".format(scheme=scheme, host=host, port=port)] = {
+                "requests": pool.num_requests, 
+                "connections": pool.num_connections,
+                "reused": max(0, pool.num_requests - pool.num_connections)
+            }
+        return response
+
+
+class SharedSession(requests.sessions.Session):
+    """ requests session whose connections are kept alive and reused across calls """
+
+    def __init__(self, max_hosts=100, max_connections_per_host=10):
+        self.max_hosts = max_hosts
+        self.max_connections_per_host = max_connections_per_host
+        super(SharedSession, self).__init__(config={
+            "keep_alive": True,
+            # the session is shared by every provider and fetches arbitrary pages, 
+            # so don't let one host's cookies pile up and go along to all the others
+            "store_cookies": False,
+            "pool_connections": max_hosts,
+            "pool_maxsize": max_connections_per_host})
+
+    def init_poolmanager(self):
+        self.poolmanager = SharedPoolManager(
+            num_pools=self.max_hosts, 
+            maxsize=self.max_connections_per_host)
+
+
+# one session for every provider in the process, so they share connections to each host
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_http_session():
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            from totalimpact import app
+            http_session = SharedSession(
+                max_hosts=app.config.get("HTTP_MAX_POOLED_HOSTS", 100),
+                max_connections_per_host=app.config.get("HTTP_MAX_CONNECTIONS_PER_HOST", 10))
+        return http_session
+
+def reset_http_session():
+    global http_session
+    with http_session_lock:
+        http_session = None
+
+def get_http_session_stats():
+    """ connection reuse totals and per-host breakdown for the shared session """
+    with http_session_lock:
+        session = http_session
+    hosts = session.poolmanager.stats() if session else {}
+    response = {"hosts": hosts}
+    for counter in ["requests", "connections", "reused"]:
+        response[counter] = sum([host_stats[counter] for host_stats in hosts.values()])
+    return response
+
+        
 class Provider(object):
 
+    # upstream rate limit as (number of requests, per this many seconds), None for no limit.
+    # providers with a quota override this
+    rate_limit = None
+    rate_limit_max_wait = 30  # seconds to wait for the rate limit before raising ProviderRateLimitError
+
     def __init__(self, 
             max_cache_duration=60*60,  # one hour 
             max_retries=0, 
@@ -397,6 +605,49 @@ class Provider(object):
 
         return metrics_and_drilldown  
 
+    # Batch methods
+    # Each takes a list of alias lists, one per item, and returns a list of 
+    # responses in the same order.  An item whose lookup failed gets its 
+    # ProviderError in its place, so one bad item doesn't lose the rest of 
+    # the batch.  The defaults call the single-item method for each item; 
+    # providers whose upstream takes many ids in one request override them
+    # and raise the matching batch size.
+
+    aliases_batch_size = 1
+    biblio_batch_size = 1
+    metrics_batch_size = 1
+
+    def get_batch_size(self, method_name):
+        """ how many items the backend hands the method's batch version at once """
+        return getattr(self, method_name+"_batch_size", 1)
+
+    def _call_for_each_item(self, method, list_of_aliases, provider_url_template, cache_enabled):
+        responses = []
+        for aliases in list_of_aliases:
+            try:
+                responses.append(method(aliases, provider_url_template, cache_enabled))
+            except ProviderError, e:
+                responses.append(e)
+        return responses
+
+    def aliases_batch(self, 
+            list_of_aliases,
+            provider_url_template=None, 
+            cache_enabled=True):
+        return self._call_for_each_item(self.aliases, list_of_aliases, provider_url_template, cache_enabled)
+
+    def biblio_batch(self, 
+            list_of_aliases,
+            provider_url_template=None, 
+            cache_enabled=True):
+        return self._call_for_each_item(self.biblio, list_of_aliases, provider_url_template, cache_enabled)
+
+    def metrics_batch(self, 
+            list_of_aliases,
+            provider_url_template=None, 
+            cache_enabled=True):
+        return self._call_for_each_item(self.metrics, list_of_aliases, provider_url_template, cache_enabled)
+
 
     # default method; providers can override
     def get_metrics_for_id(self, 
@@ -424,6 +675,9 @@ class Provider(object):
         except (AttributeError, TypeError):  # throws type error if response.text is none
             metrics_dict = {}
 
+        if not metrics_dict:
+            self._cache_empty_metrics(response)
+
         return metrics_dict
 
     # ideally would aggregate all tweets from all urls.  
@@ -447,6 +701,79 @@ class Provider(object):
     # Core methods
     # These should be consistent for all providers
     
+    def _get_cache_key(self, url, headers=None, allow_redirects=False):
+        if headers:
+            cache_key = headers.copy()
+        else:
+            cache_key = {}
+        cache_key.update({"url":url, "allow_redirects":allow_redirects})
+        return cache_key
+
+    def _get_cache_duration(self, status_code):
+        """ how long to cache a response with this status, or None to not cache it """
+        from totalimpact import app
+        if status_code < 400:
+            return self.max_cache_duration
+        # upstreams say the same thing about missing or forbidden items for a while, 
+        # so remember that rather than asking again on every update, but not for 
+        # longer than a real answer would be kept
+        cache_duration = app.config["NEGATIVE_CACHE_DURATIONS"].get(status_code, None)
+        if cache_duration is None:
+            return None
+        return min(cache_duration, self.max_cache_duration)
+
+    def _get_cache_data(self, response, cache_duration):
+        """ What to cache for a live response: enough to rebuild a stripped down
+        response, when it goes stale, and the validators to revalidate it with """
+        return {'text' : response.text, 
+            'status_code' : response.status_code, 
+            'url': response.url,
+            'expires': time.time() + cache_duration,
+            'etag': response.headers.get("etag"),
+            'last_modified': response.headers.get("last-modified")}
+
+    def _set_cache_data(self, c, cache_key, cache_data, cache_duration):
+        from totalimpact import app
+        if cache_data.get("etag") or cache_data.get("last_modified"):
+            # keep it around after it goes stale, so it can be revalidated instead of fetched again.
+            # Only as long again as it was fresh, so it takes at most twice the memcached space
+            cache_duration += max(0, min(cache_duration, app.config["CACHE_REVALIDATION_WINDOW"]))
+        c.set_cache_entry(cache_key, cache_data, cache_duration)
+
+    def _cache_empty_metrics(self, response):
+        """ Re-stores a live response whose metrics came back empty, for the 
+        empty metrics duration if that is shorter than the usual one, so new 
+        items get another look soon """
+        from totalimpact import app
+        # only responses http_get has just fetched and cached carry their cache key
+        cache_key = getattr(response, "cache_key", None)
+        if not cache_key or response.status_code != 200:
+            return
+        cache_duration = min(app.config["EMPTY_METRICS_CACHE_DURATION"], self.max_cache_duration)
+        c = Cache(self.max_cache_duration)
+        self._set_cache_data(c, cache_key, self._get_cache_data(response, cache_duration), cache_duration)
+
+    def _get_cached_page(self, url):
+        """ The text http_get would return for url from the cache without a request, or None """
+        from totalimpact import app
+        if not app.config["CACHE_ENABLED"]:
+            return None
+        cache_data = Cache(self.max_cache_duration).get_cache_entry(self._get_cache_key(url))
+        if cache_data and (cache_data["status_code"] == 200) and (cache_data.get("expires", time.time()) >= time.time()):
+            return cache_data["text"]
+        return None
+
+    def _cache_page(self, url, text):
+        """ Caches text as if http_get had fetched it from url, for pages cut out of a bigger response """
+        from totalimpact import app
+        if not app.config["CACHE_ENABLED"]:
+            return
+        cache_data = {'text' : text, 
+            'status_code' : 200, 
+            'url': url,
+            'expires': time.time() + self.max_cache_duration}
+        Cache(self.max_cache_duration).set_cache_entry(self._get_cache_key(url), cache_data)
+
     def http_get(self, url, headers=None, timeout=20, cache_enabled=True, allow_redirects=False):
         """ Returns a requests.models.Response object or raises exception
             on failure. Will cache requests to the same URL. """
@@ -458,35 +785,51 @@ class Provider(object):
         use_cache = app.config["CACHE_ENABLED"] and cache_enabled
 
         cache_data = None
-        if headers:
-            cache_key = headers.copy()
-        else:
-            cache_key = {}
-        cache_key.update({"url":url, "allow_redirects":allow_redirects})
+        cache_key = self._get_cache_key(url, headers, allow_redirects)
         if use_cache:
             c = Cache(self.max_cache_duration)
             cache_data = c.get_cache_entry(cache_key)
-            if cache_data:
-                class CachedResponse:
-                    pass
-                r = CachedResponse()
-                r.status_code = cache_data['status_code']
-
-                # Return a stripped down equivalent of requests.models.Response
-                # We don't store headers or other information here. If we need
-                # that later, we can add it
-                # use it if it was a 200, otherwise go get it again
-                if (r.status_code == 200):
-                    r.url = cache_data['url']
-                    r.text = cache_data['text']
+            # use it if it was a 200 or a cacheable error, otherwise go get it again
+            if cache_data and ((cache_data['status_code'] == 200) 
+                    or (cache_data['status_code'] in app.config["NEGATIVE_CACHE_DURATIONS"])):
+                # entries cached before we kept expiry times are fresh until memcached drops them
+                if cache_data.get("expires", time.time()) >= time.time():
                     self.logger.debug("returning from cache: %s" %(url))
-                    return r
-            
-        # ensure that a user-agent string is set
-        if headers is None:
-            headers = {}
+                    return CachedResponse(cache_data)
+            else:
+                cache_data = None
+
+            # concurrent callers after the same thing wait for one request and share its response
+            flight_key = c._build_hash_key(cache_key)
+            return http_get_flights.do(flight_key, self._http_get_live, 
+                url, headers, timeout, allow_redirects, cache_key, cache_data)
+
+        return self._http_get_live(url, headers, timeout, allow_redirects)
+
+    def _http_get_live(self, url, headers, timeout, allow_redirects, cache_key=None, cache_data=None):
+        """ Does the GET for http_get, and caches the response if there is a cache_key.
+        cache_data is a stale cache entry to revalidate, if there is one """
+
+        from totalimpact import app
+
+        use_cache = cache_key is not None
+        if use_cache:
+            c = Cache(self.max_cache_duration)
+
+        # ensure that a user-agent string is set, without changing the caller's headers
+        headers = dict(headers or {})
         headers["User-Agent"] = app.config["USER_AGENT"]
+
+        # a stale entry with validators only needs the upstream to tell us it hasn't changed
+        if cache_data:
+            if cache_data.get("etag"):
+                headers["If-None-Match"] = cache_data["etag"]
+            if cache_data.get("last_modified"):
+                headers["If-Modified-Since"] = cache_data["last_modified"]
         
+        if self.rate_limit:
+            get_rate_limiter(self.provider_name, self.rate_limit).consume(self.rate_limit_max_wait)
+
         # make the request        
         try:
             from totalimpact import app
@@ -494,25 +837,95 @@ class Provider(object):
             if app.config["PROXY"]:
                 proxies = {'http' : app.config["PROXY"], 'https' : app.config["PROXY"]}
             self.logger.debug("LIVE %s" %(url))
-            r = requests.get(url, headers=headers, timeout=timeout, proxies=proxies, allow_redirects=allow_redirects, verify=False)
+            # prefetch so the connection goes straight back to the pool for the next call
+            r = get_http_session().get(url, headers=headers, timeout=timeout, proxies=proxies, 
+                allow_redirects=allow_redirects, verify=False, prefetch=True)
         except requests.exceptions.Timeout as e:
             self.logger.info("%s Attempt to connect to provider timed out during GET on %s" %(self.provider_name, url))
             raise ProviderTimeout("Attempt to connect to provider timed out during GET on " + url, e)
         except requests.exceptions.RequestException as e:
             raise ProviderHttpError("RequestException during GET on: " + url, e)
 
+        if r.status_code == 429:  # too many requests
+            self.logger.info("%s rate limited by upstream during GET on %s" %(self.provider_name, url))
+            raise ProviderRateLimitError("Rate limited by provider during GET on " + url)
+
+        if r.status_code == 304 and cache_data:
+            self.logger.debug("not modified, returning from cache: %s" %(url))
+            backend_stats.incr("http:not_modified")
+            cache_duration = self._get_cache_duration(cache_data["status_code"])
+            cache_data = dict(cache_data, expires=time.time() + cache_duration)
+            # the upstream may send new validators with a 304
+            cache_data["etag"] = r.headers.get("etag") or cache_data.get("etag")
+            cache_data["last_modified"] = r.headers.get("last-modified") or cache_data.get("last_modified")
+            self._set_cache_data(c, cache_key, cache_data, cache_duration)
+            return CachedResponse(cache_data)
+
         if not r.encoding:
             r.encoding = "utf-8"            
         
         # cache the response and return
-        if r and use_cache:
-            cache_data = {'text' : r.text, 
-                'status_code' : r.status_code, 
-                'url': r.url}
-            c.set_cache_entry(cache_key, cache_data)
+        cache_duration = self._get_cache_duration(r.status_code)
+        if cache_duration and use_cache:
+            self._set_cache_data(c, cache_key, self._get_cache_data(r, cache_duration), cache_duration)
+            r.cache_key = cache_key
         return r
 
 
+class SingleFlight(object):
+    """ Lets concurrent callers with the same key share the result of one call """
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exc_info = None
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.Call()
+                self.calls[key] = call
+
+        if not is_leader:
+            backend_stats.incr("http:coalesced")
+            call.done.wait()
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+# live GETs in flight in this process, keyed on the hash of their cache key
+http_get_flights = SingleFlight()
+
+
+class CachedResponse(object):
+    """ Stripped down equivalent of requests.models.Response, rebuilt from the cache.
+    We don't store headers or other information here. If we need that later, 
+    we can add it """
+
+    def __init__(self, cache_data):
+        self.status_code = cache_data['status_code']
+        self.url = cache_data['url']
+        self.text = cache_data['text']
+
+
 class ProviderError(Exception):
     def __init__(self, message="", inner=None):
         self._message = message  # naming it self.message raises DepreciationWarning
@@ -566,7 +979,34 @@ class ProviderValidationFailedError(ProviderError):
 class ProviderRateLimitError(ProviderError):
     pass
 
+def run_concurrently(calls):
+    """ Runs each (function, args) pair in its own thread and returns their results in order.
+    Once they have all finished, re-raises the first exception any of them raised.
+    Under the gevent backend engine the threads are greenlets. """
+    results = [None] * len(calls)
+    exc_infos = [None] * len(calls)
+    def run(i, function, args):
+        try:
+            results[i] = function(*args)
+        except Exception:
+            exc_infos[i] = sys.exc_info()
+    threads = [threading.Thread(target=run, args=(i, function, args)) 
+        for (i, (function, args)) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for exc_info in exc_infos:
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return results
+
 def _load_json(page):
+    if ujson:
+        try:
+            return ujson.loads(page)
+        except ValueError:
+            pass  # so simplejson can say what is wrong with it
     try:
         data = simplejson.loads(page) 
     except simplejson.JSONDecodeError, e:
@@ -583,22 +1023,51 @@ def _lookup_json(data, keylist):
     return(data)
 
 def _extract_from_data_dict(data, dict_of_keylists):
-    return_dict = {}
-    if dict_of_keylists:
-        for (metric, keylist) in dict_of_keylists.iteritems():
-            value = _lookup_json(data, keylist)
+    return JsonExtractor(dict_of_keylists).extract_from_data(data)
+
+def _extract_from_json(page, dict_of_keylists):
+    return JsonExtractor(dict_of_keylists).extract(page)
+
+def _compile_json_keylist(keylist):
+    """ A function that looks up keylist in data like _lookup_json does, 
+    with one try for the whole keylist instead of one per key """
+    keylist = tuple(keylist)
+    def lookup(data):
+        try:
+            for mykey in keylist:
+                data = data[mykey]
+        except (KeyError, TypeError):
+            return None
+        return data
+    return lookup
+
+class JsonExtractor(object):
+    """ A dict_of_keylists compiled once into lookup functions, for extracting 
+    from json pages or from data that has already been loaded.
+
+    Providers can build these once, as class attributes, and use them from 
+    any thread. """
+
+    def __init__(self, dict_of_keylists=None):
+        self.dict_of_keylists = dict_of_keylists or {}
+        self.lookups = tuple((name, _compile_json_keylist(keylist)) 
+            for (name, keylist) in self.dict_of_keylists.iteritems())
+
+    def extract_from_data(self, data):
+        return_dict = {}
+        for (name, lookup) in self.lookups:
+            value = lookup(data)
 
             # only set metrics for non-zero and non-null metrics
             if value:
-                return_dict[metric] = value
-    return return_dict
+                return_dict[name] = value
+        return return_dict
 
-def _extract_from_json(page, dict_of_keylists):
-    data = _load_json(page)
-    if not data:
-        return {}
-    return_dict = _extract_from_data_dict(data, dict_of_keylists)
-    return return_dict
+    def extract(self, page):
+        data = _load_json(page)
+        if not data:
+            return {}
+        return self.extract_from_data(data)
 
 def _get_doc_from_xml(page):
     try:
@@ -616,11 +1085,8 @@ def _get_doc_from_xml(page):
     return (doc, lookup_function)
 
 def _count_in_xml(page, mykey): 
-    doc_list = _find_all_in_xml(page, mykey)
-    if not doc_list:
-        return 0
-    count = len(doc_list)
-    return(count)
+    texts = XmlExtractor(dict_of_tags={"count": mykey}).extract(page).get("count", [])
+    return len(texts)
 
 def _find_all_in_xml(page, mykey):  
     (doc, lookup_function) = _get_doc_from_xml(page)  
@@ -682,11 +1148,86 @@ def _lookup_xml_from_soup(soup, keylist):
     return(response)
 
 def _extract_from_xml(page, dict_of_keylists):
-    (doc, lookup_function) = _get_doc_from_xml(page)
-    return_dict = {}
-    if dict_of_keylists:
-        for (metric, keylist) in dict_of_keylists.iteritems():
-            value = lookup_function(doc, keylist)
+    return XmlExtractor(dict_of_keylists).extract(page)
+
+
+class _XmlExtractionDone(Exception):
+    pass
+
+class XmlExtractor(object):
+    """ A dict_of_keylists compiled into one streaming pass over an xml page, 
+    with no dom built along the way.
+
+    Each keylist finds what _lookup_xml_from_dom finds: the first element with the
+    first key, the first element with the next key inside that one, and so on, 
+    and then the text the last element starts with.  dict_of_tags maps names to 
+    tags, and collects that starting text for every element with the tag.  
+    Parsing stops as soon as every keylist has its answer, unless there are tags 
+    to collect.  Pages expat can't parse go through BeautifulStoneSoup instead.
+
+    Providers can build these once, as class attributes: extract holds its 
+    parsing state in an _XmlExtraction, so one extractor can be shared by threads. """
+
+    def __init__(self, dict_of_keylists=None, dict_of_tags=None):
+        self.dict_of_keylists = dict((name, keylist) 
+            for (name, keylist) in (dict_of_keylists or {}).iteritems() if keylist)
+        self.dict_of_tags = dict_of_tags or {}
+
+        # so most elements cost a dict lookup and nothing more
+        self.keylist_names_by_tag = {}
+        for (name, keylist) in self.dict_of_keylists.iteritems():
+            for tag in set(keylist):
+                self.keylist_names_by_tag.setdefault(tag, []).append(name)
+        self.tag_names_by_tag = {}
+        for (name, tag) in self.dict_of_tags.iteritems():
+            self.tag_names_by_tag.setdefault(tag, []).append(name)
+
+    def parse(self, page):
+        """ Returns a dict of name to text for the keylists, and a dict of name 
+        to list of texts for the tags.  Texts are None for elements that don't
+        start with text.  Raises ExpatError for pages that aren't well-formed. """
+        page = page.strip()
+        try:
+            page = page.encode('utf-8')
+        except UnicodeDecodeError:
+            pass
+        extraction = _XmlExtraction(self)
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = extraction.start
+        parser.EndElementHandler = extraction.end
+        parser.CharacterDataHandler = extraction.data
+        try:
+            parser.Parse(page, True)
+        except _XmlExtractionDone:
+            pass
+        return (extraction.values, extraction.lists)
+
+    def _parse_soup(self, page):
+        soup = BeautifulSoup.BeautifulStoneSoup(page) 
+        if not soup:
+            raise ProviderContentMalformedError
+        values = dict((name, _lookup_xml_from_soup(soup, keylist)) 
+            for (name, keylist) in self.dict_of_keylists.iteritems())
+        # BeautifulSoup forces all tags to lowercase
+        lists = dict((name, [tag_soup.text for tag_soup in soup.findAll(tag.lower())]) 
+            for (name, tag) in self.dict_of_tags.iteritems())
+        return (values, lists)
+
+    def extract(self, page):
+        """ Returns what _extract_from_xml always has, plus a list of texts
+        for each name in dict_of_tags that matched any elements """
+        try:
+            (values, lists) = self.parse(page)
+        except ExpatError:
+            (values, lists) = self._parse_soup(page)
+
+        return_dict = {}
+        for (name, value) in values.iteritems():
+            try:
+                value = int(value)
+            except (ValueError, TypeError):
+                pass
 
             # only set metrics for non-zero and non-null metrics
             if value:
@@ -694,9 +1235,78 @@ def _extract_from_xml(page, dict_of_keylists):
                     value = value.strip()  #strip spaces if any
                 except AttributeError:
                     pass
-                return_dict[metric] = value
+                return_dict[name] = value
+
+        for (name, texts) in lists.iteritems():
+            if texts:
+                return_dict[name] = texts
+        return return_dict
+
+class _XmlExtraction(object):
+    """ The state of one XmlExtractor pass, with the expat handlers """
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.depth = 0
+        self.unresolved = set(extractor.dict_of_keylists)
+        self.matched_depths = dict((name, []) for name in extractor.dict_of_keylists)
+        # depth -> keylists that fail if the element open at that depth closes 
+        self.anchors = {}
+        self.values = {}
+        self.lists = dict((name, []) for name in extractor.dict_of_tags)
+        # (name, is_tag) for the elements whose starting text is coming in
+        self.collectors = []
+        self.texts = []
+
+    def start(self, tag, attributes):
+        if self.collectors:
+            # a child element ends its parent's starting text
+            self.finish_text()
+        self.depth += 1
+        for name in self.extractor.keylist_names_by_tag.get(tag, ()):
+            if name in self.unresolved:
+                keylist = self.extractor.dict_of_keylists[name]
+                matched_depths = self.matched_depths[name]
+                if (len(matched_depths) < len(keylist)) and (keylist[len(matched_depths)] == tag):
+                    matched_depths.append(self.depth)
+                    if len(matched_depths) == len(keylist):
+                        self.collectors.append((name, False))
+                    else:
+                        self.anchors.setdefault(self.depth, []).append(name)
+        for name in self.extractor.tag_names_by_tag.get(tag, ()):
+            self.collectors.append((name, True))
+
+    def end(self, tag):
+        if self.collectors:
+            self.finish_text()
+        # the rest of the keylist would have had to be inside this element
+        for name in self.anchors.pop(self.depth, ()):
+            if name in self.unresolved:
+                self.values[name] = None
+                self.unresolved.discard(name)
+        self.depth -= 1
+        self.check_done()
+
+    def data(self, text):
+        if self.collectors:
+            self.texts.append(text)
+
+    def finish_text(self):
+        text = "".join(self.texts) or None
+        for (name, is_tag) in self.collectors:
+            if is_tag:
+                self.lists[name].append(text)
+            else:
+                self.values[name] = text
+                self.unresolved.discard(name)
+        self.collectors = []
+        self.texts = []
+        self.check_done()
+
+    def check_done(self):
+        if not self.unresolved and not self.lists:
+            raise _XmlExtractionDone
 
-    return return_dict
 
 # given a url that has a doi embedded in it, return the doi
 def doi_from_url_string(url):
@@ -12,6 +12,12 @@ class Pubmed(Provider):
 
     url = "http://pubmed.gov"
     descr = "PubMed comprises more than 21 million citations for biomedical literature"
+    rate_limit = (3, 1)  # NCBI asks for no more than 3 eutils requests per second
+
+    # efetch and esearch take many ids at once, so the backend batches aliases and biblio
+    aliases_batch_size = 100
+    biblio_batch_size = 100
+    eutils_batch_size = 200  # ids per eutils request, to keep the GET url a reasonable length
     provenance_url_pmc_citations_template = "http://www.ncbi.nlm.nih.gov/pubmed?linkname=pubmed_pubmed_citedin&from_uid=%s"
     provenance_url_pmc_citations_filtered_template = "http://www.ncbi.nlm.nih.gov/pubmed?term=%s&cmd=DetailsSearch"
     provenance_url_f1000_template = "http://f1000.com/pubmed/%s"
@@ -24,10 +30,23 @@ class Pubmed(Provider):
     aliases_from_doi_url_template = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?term=%s&email=team@total-impact.org&tool=total-impact" 
     aliases_from_pmid_url_template = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=%s&retmode=xml&email=team@total-impact.org&tool=total-impact" 
 
+    aliases_from_dois_url_template = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&term=%s&retmax=%i&email=team@total-impact.org&tool=total-impact" 
+
     aliases_pubmed_url_template = "http://www.ncbi.nlm.nih.gov/pubmed/%s"
 
     biblio_url_template = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=%s&retmode=xml&email=team@total-impact.org&tool=total-impact" 
 
+    # compiled once, each parses a page in a single pass
+    biblio_xml_extractor = provider.XmlExtractor(
+        {"year": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleDate", "Year"], 
+        "month": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleDate", "Month"],
+        "day": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleDate", "Day"],
+        "title": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleTitle"],
+        "journal": ["PubmedArticleSet", "MedlineCitation", "Article", "Journal", "Title"]},
+        {"authors": "LastName"})
+    ids_xml_extractor = provider.XmlExtractor(dict_of_tags={"ids": "Id"})
+    pmcids_xml_extractor = provider.XmlExtractor(dict_of_tags={"pmcids": "PMCID"})
+
     static_meta_dict = {
         "pmc_citations": {
             "display_name": "citations",
@@ -79,18 +98,9 @@ class Pubmed(Provider):
         return True
 
     def _extract_biblio(self, page, id=None):
-        dict_of_keylists = {"year": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleDate", "Year"], 
-                            "month": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleDate", "Month"],
-                            "day": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleDate", "Day"],
-                            "title": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleTitle"],
-                            "journal": ["PubmedArticleSet", "MedlineCitation", "Article", "Journal", "Title"],
-                            }
-        biblio_dict = provider._extract_from_xml(page, dict_of_keylists)
-        dom_authors = provider._find_all_in_xml(page, "LastName")
-        try:
-            biblio_dict["authors"] = ", ".join([author.firstChild.data for author in dom_authors])
-        except (AttributeError, TypeError):
-            pass
+        biblio_dict = self.biblio_xml_extractor.extract(page)
+        if "authors" in biblio_dict:
+            biblio_dict["authors"] = ", ".join([author for author in biblio_dict["authors"] if author])
 
         try:
             datetime_published = datetime.datetime(year=biblio_dict["year"], 
@@ -169,31 +179,148 @@ class Pubmed(Provider):
                 # look up doi and other things on pubmed page
                 aliases_from_pmid_url = self.aliases_from_pmid_url_template %nid
                 page = self._get_eutils_page(nid, aliases_from_pmid_url, cache_enabled)
-                if page:
-                    new_aliases += self._extract_aliases_from_pmid(page, nid)
-                    biblio = self._extract_biblio(page, nid)
-                    if biblio:
-                        new_aliases += [("biblio", biblio)]
-                # also, add link to paper on pubmed
-                new_aliases += [("url", self.aliases_pubmed_url_template %nid)] 
+                new_aliases += self._aliases_from_pmid_page(page, nid)
 
+        return self._unique_aliases(new_aliases)
+
+    def _aliases_from_pmid_page(self, page, pmid):
+        new_aliases = []
+        if page:
+            new_aliases += self._extract_aliases_from_pmid(page, pmid)
+            biblio = self._extract_biblio(page, pmid)
+            if biblio:
+                new_aliases += [("biblio", biblio)]
+        # also, add link to paper on pubmed
+        new_aliases += [("url", self.aliases_pubmed_url_template %pmid)] 
+        return new_aliases
+
+    def _unique_aliases(self, new_aliases):
         # get uniques for things that are unhashable
-        new_aliases_unique = [k for k,v in itertools.groupby(sorted(new_aliases))]
+        return [k for k,v in itertools.groupby(sorted(new_aliases))]
 
-        return new_aliases_unique
+    def _split_article_set(self, page):
+        """ Cuts an efetch PubmedArticleSet into a one-article PubmedArticleSet page for each pmid """
+        (doc, lookup_function) = provider._get_doc_from_xml(page)
+        if lookup_function is not provider._lookup_xml_from_dom:
+            # minidom couldn't parse it, so it came back as soup
+            logger.warning("%20s couldn't split efetch page" % (self.provider_name))
+            raise ProviderContentMalformedError("couldn't parse efetch page")
+        article_doms = doc.getElementsByTagName("PubmedArticle")
+        article_pages = {}
+        for article_dom in article_doms:
+            try:
+                # the article's own PMID comes before any in its comments and corrections
+                pmid = str(article_dom.getElementsByTagName("PMID")[0].firstChild.data)
+            except (IndexError, AttributeError):
+                continue
+            article_pages[pmid] = u"<PubmedArticleSet>" + article_dom.toxml() + u"</PubmedArticleSet>"
+        return article_pages
+
+    def _get_pmid_pages(self, pmids, cache_enabled=True):
+        """ efetch pages for many pmids, by pmid.  Pmids that aren't cached already are 
+        fetched eutils_batch_size at a time, and each article is cached as if it had 
+        been fetched on its own """
+        pmid_pages = {}
+        pmids_to_fetch = []
+        for pmid in pmids:
+            page = None
+            if cache_enabled:
+                page = self._get_cached_page(self.aliases_from_pmid_url_template %pmid)
+            if page:
+                pmid_pages[pmid] = page
+            else:
+                pmids_to_fetch.append(pmid)
+
+        for start in range(0, len(pmids_to_fetch), self.eutils_batch_size):
+            pmids_string = ",".join(pmids_to_fetch[start:start+self.eutils_batch_size])
+            url = self.aliases_from_pmid_url_template %pmids_string
+            # the articles are cached one by one below, so don't cache the whole set too
+            page = self._get_eutils_page(pmids_string, url, cache_enabled=False)
+            if not page:
+                continue
+            fetched_pages = self._split_article_set(page)
+            if cache_enabled:
+                for (pmid, pmid_page) in fetched_pages.iteritems():
+                    self._cache_page(self.aliases_from_pmid_url_template %pmid, pmid_page)
+            pmid_pages.update(fetched_pages)
+        return pmid_pages
+
+    def _extract_pmids(self, page):
+        ids = self.ids_xml_extractor.extract(page).get("ids", [])
+        return [str(id) for id in ids if id]
+
+    def _get_pmids_from_dois(self, dois, cache_enabled=True):
+        """ Returns the pmid for each doi pubmed knows about, by lowercase doi """
+        pmids_by_doi = {}
+        for start in range(0, len(dois), self.eutils_batch_size):
+            dois_batch = dois[start:start+self.eutils_batch_size]
+            query_string = " OR ".join([doi + "[doi]" for doi in dois_batch])
+            # twice as many results as dois, in case a doi matches more than one record
+            url = self.aliases_from_dois_url_template %(urllib.quote(query_string), 2*len(dois_batch))
+            page = self._get_eutils_page(query_string, url, cache_enabled)
+            if not page:
+                continue
+            # esearch doesn't say which doi found which pmid, so read the dois off the articles
+            pmid_pages = self._get_pmid_pages(self._extract_pmids(page), cache_enabled)
+            for (pmid, pmid_page) in pmid_pages.iteritems():
+                for (namespace, doi) in self._extract_aliases_from_pmid(pmid_page, pmid):
+                    pmids_by_doi[doi.lower()] = pmid
+        return pmids_by_doi
+
+    # overriding so many items share a few eutils requests
+    def aliases_batch(self, 
+            list_of_aliases, 
+            provider_url_template=None,
+            cache_enabled=True):
+
+        dois = []
+        pmids = []
+        for aliases in list_of_aliases:
+            for (namespace, nid) in aliases:
+                if (namespace == "doi") and (nid not in dois):
+                    dois.append(nid)
+                if (namespace == "pmid") and (nid not in pmids):
+                    pmids.append(nid)
+        pmids_by_doi = self._get_pmids_from_dois(dois, cache_enabled)
+        pmid_pages = self._get_pmid_pages(pmids, cache_enabled)
+
+        aliases_responses = []
+        for aliases in list_of_aliases:
+            new_aliases = []
+            for (namespace, nid) in aliases:
+                if (namespace == "doi") and (nid.lower() in pmids_by_doi):
+                    new_aliases += [("pmid", pmids_by_doi[nid.lower()])]
+                if (namespace == "pmid"):
+                    new_aliases += self._aliases_from_pmid_page(pmid_pages.get(nid), nid)
+            aliases_responses.append(self._unique_aliases(new_aliases))
+        return aliases_responses
+
+    # overriding so many items share a few eutils requests
+    def biblio_batch(self, 
+            list_of_aliases, 
+            provider_url_template=None,
+            cache_enabled=True):
+
+        ids = [self.get_best_id(aliases) for aliases in list_of_aliases]
+        pmid_pages = self._get_pmid_pages(sorted(set([id for id in ids if id])), cache_enabled)
+
+        biblio_responses = []
+        for id in ids:
+            if not id:
+                biblio_responses.append(None)
+            elif id in pmid_pages:
+                biblio_responses.append(self._extract_biblio(pmid_pages[id], id))
+            else:
+                biblio_responses.append({})
+        return biblio_responses
 
     def _filter(self, id, citing_pmcids, filter_ptype):
         pmcids_string = " OR ".join(["PMC"+pmcid for pmcid in citing_pmcids])
         query_string = filter_ptype + "[ptyp] AND (" + pmcids_string + ")"
         pmcid_filter_url = self.metrics_pmc_filter_url_template %query_string
         page = self._get_eutils_page(id, pmcid_filter_url)
-        (doc, lookup_function) = provider._get_doc_from_xml(page)  
-        try:    
-            id_docs = doc.getElementsByTagName("Id")
-            pmids = [id_doc.firstChild.data for id_doc in id_docs]
-        except TypeError:
-            logger.warning("%20s no Id xml tags for %s" % (self.provider_name, id))
-            pmids = []
+        ids = self.ids_xml_extractor.extract(page).get("ids", [])
+        pmids = [pmid for pmid in ids if pmid]
         return pmids
 
     def _check_reviewed_by_f1000(self, id, cache_enabled):
@@ -206,45 +333,73 @@ class Pubmed(Provider):
             reviewed_by_f1000 = 0
         return reviewed_by_f1000
 
-    # override because multiple pages to get
-    def get_metrics_for_id(self, 
-            id, 
-            provider_url_template=None, 
-            cache_enabled=True):
-
+    def _get_metrics_and_context(self, id, cache_enabled=True):
+        """ Returns the metrics for id, and a context dict with the citing pmcids and 
+        filtered pmids they were counted from, for building provenance urls """
         logger.debug("%20s getting metrics for %s" % (self.provider_name, id))
         metrics_dict = {}
+        context = {"filtered_pmids": {}}
+
+        # the f1000 check and the citations lookup don't depend on each other
+        (reviewed_by_f1000, citing_pmcids) = provider.run_concurrently([
+            (self._check_reviewed_by_f1000, (id, cache_enabled)), 
+            (self._get_citing_pmcids, (id, cache_enabled))])
+        context["citing_pmcids"] = citing_pmcids
 
-        reviewed_by_f1000 = self._check_reviewed_by_f1000(id, cache_enabled)
         if reviewed_by_f1000:
             metrics_dict["pubmed:f1000"] = reviewed_by_f1000
 
-        citing_pmcids = self._get_citing_pmcids(id, cache_enabled)
         if (citing_pmcids):
             metrics_dict["pubmed:pmc_citations"] = len(citing_pmcids)
+
+            # and neither do the two filters of the citations
+            filter_ptypes = ["review", "editorial"]
+            filtered_pmids_lists = provider.run_concurrently([
+                (self._filter, (id, citing_pmcids, filter_ptype)) for filter_ptype in filter_ptypes])
+            context["filtered_pmids"] = dict(zip(filter_ptypes, filtered_pmids_lists))
     
-            number_review_pmids = len(self._filter(id, citing_pmcids, "review"))
+            number_review_pmids = len(context["filtered_pmids"]["review"])
             if number_review_pmids:
                 metrics_dict["pubmed:pmc_citations_reviews"] = number_review_pmids
     
-            number_editorial_pmids = len(self._filter(id, citing_pmcids, "editorial"))
+            number_editorial_pmids = len(context["filtered_pmids"]["editorial"])
             if number_editorial_pmids:
                 metrics_dict["pubmed:pmc_citations_editorials"] = number_editorial_pmids
-        # check for f1000
 
+        return (metrics_dict, context)
+
+    # override because multiple pages to get
+    def get_metrics_for_id(self, 
+            id, 
+            provider_url_template=None, 
+            cache_enabled=True):
+
+        (metrics_dict, context) = self._get_metrics_and_context(id, cache_enabled)
         return metrics_dict
 
+    # override so the provenance urls are built from the pages the metrics came from
+    def metrics(self, 
+            aliases,
+            provider_url_template=None, 
+            cache_enabled=True):
+
+        id = self.get_best_id(aliases)
+        if not id:
+            return {}
+
+        (metrics, context) = self._get_metrics_and_context(id, cache_enabled)
+        metrics_and_drilldown = {}
+        for metric_name in metrics:
+            drilldown_url = self._provenance_url_in_context(metric_name, id, context)
+            metrics_and_drilldown[metric_name] = (metrics[metric_name], drilldown_url)
+
+        return metrics_and_drilldown  
+
     def _extract_citing_pmcids(self, page):
         if (not "PubMedToPMCcitingformSET" in page):
             raise ProviderContentMalformedError()
-        dict_of_keylists = {"pubmed:pmc_citations": ["PubMedToPMCcitingformSET", "REFORM"]}
-        (doc, lookup_function) = provider._get_doc_from_xml(page)
-        try:
-            pmcid_doms = doc.getElementsByTagName("PMCID")
-            pmcids = [pmcid_dom.firstChild.data for pmcid_dom in pmcid_doms]
-        except TypeError:
-            logger.warning("%20s no PMCID xml tags for %s" % (self.provider_name, id))            
-            pmcids = []
+        pmcid_texts = self.pmcids_xml_extractor.extract(page).get("pmcids", [])
+        pmcids = [pmcid for pmcid in pmcid_texts if pmcid]
         return pmcids
 
     # documentation for pubmedtopmcciting: http://www.pubmedcentral.nih.gov/utils/entrez2pmcciting.cgi
@@ -262,6 +417,18 @@ class Pubmed(Provider):
             # not relevant to Pubmed
             return None
 
+        return self._provenance_url_in_context(metric_name, id, {})
+
+    def _get_filtered_pmids_in_context(self, id, filter_ptype, context):
+        """ filtered pmids from the context, looking up and adding to it whatever is missing """
+        filtered_pmids = context.setdefault("filtered_pmids", {})
+        if filter_ptype not in filtered_pmids:
+            if "citing_pmcids" not in context:
+                context["citing_pmcids"] = self._get_citing_pmcids(id)
+            filtered_pmids[filter_ptype] = self._filter(id, context["citing_pmcids"], filter_ptype)
+        return filtered_pmids[filter_ptype]
+
+    def _provenance_url_in_context(self, metric_name, id, context):
         url = None
         if (metric_name == "pubmed:pmc_citations"):
             url = self._get_templated_url(self.provenance_url_pmc_citations_template, id, "provenance")
@@ -270,20 +437,16 @@ class Pubmed(Provider):
             url = self._get_templated_url(self.provenance_url_f1000_template, id, "provenance")
 
         elif (metric_name == "pubmed:pmc_citations_reviews"):
-            citing_pmcids = self._get_citing_pmcids(id)
-            filtered_pmids = self._filter(id, citing_pmcids, "review")
+            filtered_pmids = self._get_filtered_pmids_in_context(id, "review", context)
             pmids_string = " OR ".join([pmid for pmid in filtered_pmids])
             url = self._get_templated_url(self.provenance_url_pmc_citations_filtered_template, 
                     urllib.quote(pmids_string), "provenance")
 
         elif (metric_name == "pubmed:pmc_citations_editorials"):
-            citing_pmcids = self._get_citing_pmcids(id)
-            filtered_pmids = self._filter(id,citing_pmcids, "editorial")
+            filtered_pmids = self._get_filtered_pmids_in_context(id, "editorial", context)
             pmids_string = " OR ".join([pmid for pmid in filtered_pmids])
             url = self._get_templated_url(self.provenance_url_pmc_citations_filtered_template, 
                     urllib.quote(pmids_string), "provenance")
 
         return url
 
-
-
@@ -15,6 +15,11 @@ class Topsy(Provider):
     metrics_url_template = 'http://otter.topsy.com/stats.json?url="%s"&apikey=' + os.environ["TOPSY_KEY"]
     provenance_url_template = 'http://topsy.com/%s?utm_source=otter'
 
+    metrics_json_extractor = provider.JsonExtractor({
+        'topsy:tweets' : ['response', 'all'],
+        'topsy:influential_tweets' : ['response', 'influential']
+    })
+
     static_meta_dict =  {
         "tweets": {
             "display_name": "tweets",
@@ -50,12 +55,7 @@ class Topsy(Provider):
             else:
                 raise(self._get_error(status_code))
 
-        dict_of_keylists = {
-            'topsy:tweets' : ['response', 'all'],
-            'topsy:influential_tweets' : ['response', 'influential']
-        }
-
-        metrics_dict = provider._extract_from_json(page, dict_of_keylists)
+        metrics_dict = self.metrics_json_extractor.extract(page)
 
         return metrics_dict
 
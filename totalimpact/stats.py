@@ -0,0 +1,98 @@
+import time, threading, bisect
+from collections import defaultdict
+
+# Counters, gauges and latency histograms for the backend pipeline.
+#
+# Names are colon-separated like redis keys, for example
+#   queue:pubmed_queue:wait            seconds a message sat in the queue
+#   provider:pubmed:metrics:service    seconds a wrapper call took
+#   provider:pubmed:metrics:errors     calls that raised a ProviderError
+# The backend process dumps a snapshot to the log and to redis every so
+# often (see StatsDumper in backend.py), and the /stats endpoint reads
+# them back.
+
+
+class Histogram(object):
+    # upper bounds in seconds; anything slower goes in the last, open-ended bucket
+    bucket_bounds = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(self.bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.bucket_counts[bisect.bisect_left(self.bucket_bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """ upper bound of the bucket the percentile falls in, so an overestimate """
+        if not self.count:
+            return None
+        needed = fraction * self.count
+        seen = 0
+        for (i, bucket_count) in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if seen >= needed:
+                break
+        if i < len(self.bucket_bounds):
+            return self.bucket_bounds[i]
+        return self.max
+
+    def snapshot(self):
+        buckets = {}
+        for (bound, bucket_count) in zip(self.bucket_bounds + ["inf"], self.bucket_counts):
+            if bucket_count:
+                buckets["<=" + str(bound)] = bucket_count
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "buckets": buckets
+        }
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = defaultdict(int)
+            self.gauges = {}
+            self.histograms = defaultdict(Histogram)
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.histograms[name].record(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "since": self.started,
+                "taken": time.time(),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": dict((name, histogram.snapshot())
+                    for (name, histogram) in self.histograms.iteritems())
+            }
+
+
+# everything in one process shares this
+backend_stats = Stats()
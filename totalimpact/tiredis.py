@@ -1,23 +1,48 @@
-import redis, logging, json
+import redis, logging, json, time
 
 
 logger = logging.getLogger("ti.tiredis")
 
+# priority classes for item updates: people waiting on a page go in HIGH_PRIORITY,
+# scheduled refreshes go in LOW_PRIORITY and get the leftover capacity
+HIGH_PRIORITY = "high"
+LOW_PRIORITY = "low"
+ALIAS_QUEUE_NAMES = {
+    HIGH_PRIORITY: "aliasqueue",
+    LOW_PRIORITY: "aliasqueue_low"
+}
+
 
 def from_url(url, db=0):
     r = redis.from_url(url, db)
     return r
 
+# counts a provider off only the first time it reports in after set_num_providers_left, 
+# so a job that runs twice for one update can't make the item look done too early
+DECR_NUM_PROVIDERS_LEFT_SCRIPT = """
+if redis.call("SADD", KEYS[2], ARGV[1]) == 1 then
+    redis.call("EXPIRE", KEYS[2], ARGV[2])
+    return redis.call("DECR", KEYS[1])
+end
+return tonumber(redis.call("GET", KEYS[1]))
+"""
+
 def decr_num_providers_left(self, item_id, provider_name):
-    num_providers_left = self.decr("num_providers_left:"+item_id)
+    num_providers_left = self.execute_command("EVAL", DECR_NUM_PROVIDERS_LEFT_SCRIPT, 2, 
+        "num_providers_left:"+item_id, "providers_done:"+item_id, provider_name, 60*60*24)
     logger.info("bumped providers_run for %s. %s left to run." % (
         item_id, num_providers_left))
+    if num_providers_left is None:
+        return None
     return int(num_providers_left)
 
-def add_to_alias_queue(self, tiid, aliases_dict, aliases_already_run=[]):
-    queue_string = json.dumps([tiid, aliases_dict, aliases_already_run])
-    logger.debug("adding item to queue ******* " + queue_string)
-    self.lpush("aliasqueue", queue_string)
+def add_to_alias_queue(self, tiid, aliases_dict, aliases_already_run=[], priority=HIGH_PRIORITY):
+    message = [tiid, aliases_dict, aliases_already_run]
+    if priority != HIGH_PRIORITY:
+        message.append(priority)  # messages without a priority are high priority
+    queue_string = json.dumps(message)
+    logger.debug("adding item to queue ******* %s", queue_string)
+    self.lpush(ALIAS_QUEUE_NAMES[priority], queue_string)
 
 def set_value(self, key, value, time_to_expire):
     json_value = json.dumps(value)
@@ -32,6 +57,58 @@ def get_value(self, key):
         value = None
     return value
 
+def set_backend_stats(self, process_name, stats, time_to_expire):
+    # one field per backend process in a single hash, so reading them all doesn't need KEYS.
+    # Fields can't expire by themselves, so each one says when it goes stale
+    value = {"expires": time.time() + time_to_expire, "stats": stats}
+    self.hset("backend_stats", process_name, json.dumps(value))
+
+def get_backend_stats(self):
+    # one entry per backend process that has dumped stats recently
+    stats = {}
+    stale_process_names = []
+    for (process_name, json_value) in self.hgetall("backend_stats").iteritems():
+        value = json.loads(json_value)
+        if value["expires"] < time.time():
+            stale_process_names.append(process_name)
+        else:
+            stats[process_name] = value["stats"]
+    for process_name in stale_process_names:
+        self.hdel("backend_stats", process_name)
+    return stats
+
+def _in_flight_key(tiid, method_name, provider_name, priority=HIGH_PRIORITY):
+    key = "in_flight:{tiid}:{method_name}:{provider_name}".format(
+        tiid=tiid, method_name=method_name, provider_name=provider_name)
+    if priority != HIGH_PRIORITY:
+        key += ":" + priority
+    return key
+
+def claim_in_flight(self, tiid, method_name, provider_name, time_to_expire, priority=HIGH_PRIORITY):
+    # returns False if this job is already queued or running at this priority or a higher one.
+    # A job queued in the low lane doesn't hold up someone waiting on the page, 
+    # who gets a high priority job of their own
+    if priority != HIGH_PRIORITY and self.exists(_in_flight_key(tiid, method_name, provider_name)):
+        return False
+    key = _in_flight_key(tiid, method_name, provider_name, priority)
+    # one atomic SET NX EX, so a crash can't leave a claim with no expiry.  Needs redis 2.6.12
+    return bool(self.execute_command("SET", key, 1, "NX", "EX", time_to_expire))
+
+def release_in_flight(self, tiid, method_name, provider_name):
+    # whichever priority's job finishes first has done the work for both
+    self.delete(*[_in_flight_key(tiid, method_name, provider_name, priority) 
+        for priority in ALIAS_QUEUE_NAMES])
+
+def clear_in_flight(self):
+    # for startup, when the queues the claimed jobs were on didn't survive the restart
+    cursor = 0
+    while True:
+        (cursor, keys) = self.execute_command("SCAN", cursor, "MATCH", "in_flight:*", "COUNT", 1000)
+        if keys:
+            self.delete(*keys)
+        if int(cursor) == 0:
+            break
+
 def set_num_providers_left(self, item_id, num_providers_left):
     logger.debug("setting {num} providers left to update for item '{tiid}'.".format(
         num=num_providers_left,
@@ -39,7 +116,12 @@ def set_num_providers_left(self, item_id, num_providers_left):
     ))
     key = "num_providers_left:"+item_id
     expire = 60*60*24  # for a day    
-    self.set_value(key, num_providers_left, expire)
+    pipe = self.pipeline()
+    pipe.set(key, json.dumps(num_providers_left))
+    pipe.expire(key, expire)
+    # a new update, so every provider counts off again
+    pipe.delete("providers_done:"+item_id)
+    pipe.execute()
 
 def get_num_providers_left(self, item_id):
     key = "num_providers_left:"+item_id
@@ -109,6 +191,11 @@ redis.Redis.set_reference_histogram_dict = set_reference_histogram_dict
 redis.Redis.get_reference_histogram_dict = get_reference_histogram_dict
 redis.Redis.set_reference_lookup_dict = set_reference_lookup_dict
 redis.Redis.get_reference_lookup_dict = get_reference_lookup_dict
+redis.Redis.set_backend_stats = set_backend_stats
+redis.Redis.get_backend_stats = get_backend_stats
+redis.Redis.claim_in_flight = claim_in_flight
+redis.Redis.release_in_flight = release_in_flight
+redis.Redis.clear_in_flight = clear_in_flight
 
 
 
@@ -153,7 +153,8 @@ def update_active_publisher_items(number_to_update, myredis, mydao):
     print "updating {number_to_update} of them now".format(number_to_update=number_to_update)
     QUEUE_DELAY_IN_SECONDS = 0.25
     mixpanel.track("Trigger:Update", {"Number Items":len(tiids_to_update), "Update Type":"Scheduled Registered"})
-    item.start_item_update(tiids_to_update, myredis, mydao, sleep_in_seconds=QUEUE_DELAY_IN_SECONDS)
+    item.start_item_update(tiids_to_update, myredis, mydao, sleep_in_seconds=QUEUE_DELAY_IN_SECONDS, 
+        priority=tiredis.LOW_PRIORITY)
 
     return tiids_to_update
 
@@ -183,7 +184,8 @@ def update_least_recently_updated(number_to_update, myredis, mydao):
     update_docs_with_updater_timestamp(docs, mydao)
     QUEUE_DELAY_IN_SECONDS = 0.25
     mixpanel.track("Trigger:Update", {"Number Items":len(tiids_to_update), "Update Type":"Scheduled Least Recently"})
-    item.start_item_update(tiids_to_update, myredis, mydao, sleep_in_seconds=QUEUE_DELAY_IN_SECONDS)
+    item.start_item_update(tiids_to_update, myredis, mydao, sleep_in_seconds=QUEUE_DELAY_IN_SECONDS, 
+        priority=tiredis.LOW_PRIORITY)
     return tiids_to_update
 
 def main(action_type, number_to_update=35):
@@ -201,6 +201,15 @@ def provider():
 
     return resp
 
+@app.route('/stats', methods=['GET'])
+def backend_stats():
+    # queue, provider and couch stats from every backend process that dumped them recently
+    ret = myredis.get_backend_stats()
+    resp = make_response(json.dumps(ret, sort_keys=True, indent=4), 200)
+    resp.mimetype = "application/json"
+
+    return resp
+
 @app.route('/provider/<provider_name>/memberitems', methods=['POST'])
 @app.route('/v1/provider/<provider_name>/memberitems', methods=['POST'])
 def provider_memberitems(provider_name):